@@ -0,0 +1,145 @@
+import queue
+import time
+from threading import Thread
+from .database import Database
+from .metrics import metrics
+from .config import settings
+from .sharding import current_shard, use_shard
+from .breaker import CONNECTION_ERRNOS
+
+STOP = object()
+
+#Writes the client does not need to wait for. Requests enqueue units of (sql, values) statements;
+#one worker thread runs them in the order they were queued, folding consecutive runs of the same
+#statement into one executemany, and commits once per batch. A unit is never split across batches,
+#so a write and its change entry commit together. Each unit keeps the shard of the request that
+#queued it (see app/sharding.py).
+class WriteQueue:
+    def __init__(self, max_size: int, batch_size: int, flush_seconds: float):
+        self.queue = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="write-queue", daemon=True)
+        self.thread.start()
+
+    #Drains what is already queued before returning
+    def stop(self, timeout: float = 10):
+        if not self.thread:
+            return
+
+        self.queue.put(STOP)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def submit(self, *statements: tuple) -> bool:
+        try:
+            self.queue.put_nowait((current_shard.get(), statements))
+        except queue.Full:
+            metrics.increment("write_queue.dropped")
+            return False
+
+        metrics.increment("write_queue.enqueued")
+        return True
+
+    def run(self):
+        db = None
+        stopping = False
+
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_seconds
+
+            # Flush on size or on time, whichever comes first
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+                if item is STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            if stopping:
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not STOP:
+                        batch.append(item)
+
+            if batch:
+                db = self.flush(db, batch)
+
+        if db:
+            db.close()
+
+    #Returns the connection for the next batch: None after it could not be opened, so the next
+    #flush tries again instead of the worker dying with the database. A batch one of its statements
+    #failed in is run again a unit at a time, so a bad row only loses its own unit.
+    def flush(self, db: Database, batch: list):
+        db, committed, rejected = self.write(db, batch)
+        if committed:
+            metrics.increment("write_queue.flushed", len(batch))
+            return db
+
+        if not rejected or len(batch) == 1:
+            metrics.increment("write_queue.failed", len(batch))
+            return db
+
+        metrics.increment("write_queue.isolated")
+        for unit in batch:
+            db, committed, _ = self.write(db, [unit])
+            metrics.increment("write_queue.flushed" if committed else "write_queue.failed")
+        return db
+
+    #Runs units in one transaction. Returns the connection, whether it committed, and whether a
+    #statement itself was rejected (as opposed to the connection failing under it)
+    def write(self, db: Database, units: list) -> tuple:
+        runs = []
+        for shard, unit in units:
+            for sql, values in unit:
+                if runs and runs[-1][:2] == (shard, sql):
+                    runs[-1][2].append(values)
+                else:
+                    runs.append((shard, sql, [values]))
+
+        # A connection lost before the commit is reconnected and the units run once more
+        for attempt in range(2):
+            committing = False
+            try:
+                if db is None:
+                    db = Database()
+
+                for shard, sql, rows in runs:
+                    with use_shard(shard):
+                        db.cursor.executemany(sql, rows)
+                committing = True
+                db.conn.commit()
+
+                metrics.increment("write_queue.batches")
+                return db, True, False
+
+            except Exception as e:
+                print(f"Write queue flush failed: {e}")
+                lost = getattr(e, "errno", None) in CONNECTION_ERRNOS
+                try:
+                    if db:
+                        db.conn.rollback()
+                        if lost:
+                            db.reconnect()
+                except Exception as error:
+                    print(f"Write queue reconnect failed: {error}")
+
+                if not lost or committing or attempt:
+                    return db, False, db is not None and not lost and not committing
+                metrics.increment("write_queue.retried")
+
+        return db, False, False
+
+write_queue = WriteQueue(settings.write_queue_size, settings.write_batch_size, settings.write_flush_seconds)
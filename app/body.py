@@ -1,5 +1,8 @@
-from pydantic import BaseModel, EmailStr
-from typing import Literal, Optional
+from pydantic import BaseModel, EmailStr, Field, field_validator
+from typing import Literal, Optional, List, Union, Annotated
+from datetime import datetime
+from uuid import UUID
+from .money import Money
 
 #POST/PUT
 class Customer(BaseModel):
@@ -9,11 +12,11 @@ class Customer(BaseModel):
     last_name: str
 
 class Balance(BaseModel):
-    total: float
+    total: Money
 
 class Transaction(BaseModel):
     type: Literal["withdraw", "deposit"] = "deposit"
-    amount: float
+    amount: Money = Field(gt=0)
 
 class Order(BaseModel):
     payment_method: Literal["cash", "balance"] = "cash"
@@ -22,8 +25,8 @@ class Order(BaseModel):
 class Item(BaseModel):
     name: str
     quantity: int
-    orig_price: float
-    selling_price: float
+    orig_price: Money
+    selling_price: Money
 
 class OrderItem(BaseModel):
     item_id: int
@@ -37,11 +40,11 @@ class CustomerPatch(BaseModel):
     last_name: Optional[str] = None
 
 class BalancePatch(BaseModel):
-    total: Optional[float] = None
+    total: Optional[Money] = None
 
 class TransactionPatch(BaseModel):
     type: Optional[Literal["withdraw", "deposit"]] = "deposit"
-    amount: Optional[float] = None
+    amount: Optional[Money] = Field(None, gt=0)
 
 class OrderPatch(BaseModel):
     payment_method: Optional[Literal["cash", "balance"]] = "cash"
@@ -50,13 +53,55 @@ class OrderPatch(BaseModel):
 class ItemPatch(BaseModel):
     name: Optional[str] = None
     quantity: Optional[int] = None
-    orig_price: Optional[float] = None
-    selling_price: Optional[float] = None
+    orig_price: Optional[Money] = None
+    selling_price: Optional[Money] = None
 
 class OrderItemPatch(BaseModel):
     item_id: Optional[int] = None
     quantity: Optional[int] = None
 
+#BULK
+class ItemBulkUpdate(BaseModel):
+    id: int
+    quantity_delta: Optional[int] = None
+    quantity: Optional[int] = None
+    orig_price: Optional[Money] = None
+    selling_price: Optional[Money] = None
+
+#SYNC (store-and-forward from terminals)
+# client_id is generated on the terminal and makes a resent operation a no-op; created_at is when it happened there
+class SyncOperation(BaseModel):
+    client_id: UUID
+    created_at: datetime
+    customer_id: int
+
+    # Stored like the server's own timestamps: local time without an offset
+    @field_validator("created_at")
+    @classmethod
+    def local_time(cls, value: datetime) -> datetime:
+        return value.astimezone().replace(tzinfo=None) if value.tzinfo else value
+
+class SyncOrder(SyncOperation):
+    kind: Literal["order"]
+    payment_method: Literal["cash", "balance"] = "cash"
+    note: str
+
+class SyncOrderItem(SyncOperation):
+    kind: Literal["order_item"]
+    order_id: Optional[int] = None
+    order_client_id: Optional[UUID] = None      # an order created earlier in the same or a previous batch
+    item_id: int
+    quantity: int = Field(gt=0)
+
+class SyncTransaction(SyncOperation):
+    kind: Literal["transaction"]
+    balance_id: int
+    type: Literal["withdraw", "deposit"] = "deposit"
+    amount: Money = Field(gt=0)
+
+class SyncBatch(BaseModel):
+    operations: List[Annotated[Union[SyncOrder, SyncOrderItem, SyncTransaction], Field(discriminator="kind")]]
+
 
 
 #Token
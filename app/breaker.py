@@ -0,0 +1,70 @@
+import time
+from threading import Lock
+from fastapi import HTTPException, status
+from .config import settings
+from .metrics import metrics
+
+#Statement timeouts and lost/refused connections. A lock wait timeout (1205) is contention on a
+#few rows, not an unavailable database: run_in_transaction retries it and the breaker ignores it
+BREAKER_ERRNOS = {3024, 2002, 2003, 2006, 2013, 2055}
+#Of those, the ones that leave the connection dead (a client read/write timeout is a 2013 too)
+CONNECTION_ERRNOS = {2002, 2003, 2006, 2013, 2055}
+
+#An HTTPException, so the routers' "except HTTPException: raise" passes it through as a 503
+class DatabaseUnavailable(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Database temporarily unavailable",
+            headers={"Retry-After": str(int(settings.breaker_reset_seconds))}
+        )
+
+#Opens after breaker_failure_threshold consecutive timeouts/connection errors and fails every
+#statement fast; after breaker_reset_seconds one probe statement is let through (half-open) and
+#its outcome closes or re-opens the breaker.
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = Lock()
+
+    #True when this statement is the half-open probe
+    def before(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if self.probing or time.monotonic() - self.opened_at < self.reset_seconds:
+                metrics.increment("breaker.rejected")
+                raise DatabaseUnavailable()
+            self.probing = True
+            return True
+
+    def success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                metrics.increment("breaker.closed")
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self, error: Exception, probing: bool = False):
+        if getattr(error, "errno", None) not in BREAKER_ERRNOS:
+            # Not a DB availability problem (e.g. a constraint error). Only the probe's answer says
+            # anything about an open breaker; any other statement leaves the state as it is
+            if probing:
+                self.success()
+            return
+
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    metrics.increment("breaker.opened")
+                self.opened_at = time.monotonic()
+
+
+breaker = CircuitBreaker(settings.breaker_failure_threshold, settings.breaker_reset_seconds)
@@ -8,6 +8,77 @@ class Settings(BaseSettings):
     secret_key: str         
     algorithm: str          
     token_minutes: int      
+
+    database_pool_size: int = 8
+    database_use_pure: bool = False             # the C extension is used when installed
+    database_prepared_statements: bool = True
+
+    #Storage backend: "mysql", or "sqlite" for single-terminal stores (the database_* MySQL settings are then unused)
+    database_backend: str = "mysql"
+    sqlite_path: str = "sari_sari.db"
+
+    #Sharding (MySQL): customer-owned rows live on database_shards[customer_id % len(database_shards)],
+    #customers and items on the database above. Each entry overrides host/user/password/database, e.g.
+    #[{"host": "db-1", "database": "sari_sari_0"}, {"host": "db-2", "database": "sari_sari_1"}]. Empty: not sharded.
+    database_shards: list = []
+
+    #Transactions partitioning/retention
+    transactions_partitioning: bool = False
+    transactions_partitions_ahead: int = 3
+    transactions_retention_months: int = 0      # 0 keeps every partition
+    transactions_archive_expired: bool = True
+
+    #Change feed
+    change_log_retention_days: int = 7      # 0 keeps every change
+
+    #Background write queue
+    write_queue_size: int = 10000
+    write_batch_size: int = 200
+    write_flush_seconds: float = 0.5
+
+    #Response compression
+    compression_min_bytes: int = 1024
+    compression_threadpool_bytes: int = 65536       # bodies this big are compressed off the event loop
+
+    #Admission control (per worker): maximum in-flight requests per route class
+    admission_control: bool = True
+    admission_limits: dict = {"auth": 32, "read": 128, "write": 64, "admin": 8}
+    admission_target_db_ms: float = 50.0
+    threadpool_headroom: int = 16       # threads beyond the admission limits (unlimited routes, compression, profiles)
+
+    #Statement time limits: SELECTs get a MAX_EXECUTION_TIME hint for the route class they run under,
+    #writes are bounded by the lock wait timeout and the client socket timeout (keep the latter above every read limit)
+    read_timeouts_ms: dict = {"auth": 1000, "read": 2000, "write": 3000, "admin": 15000}
+    default_read_timeout_ms: int = 5000
+    lock_wait_timeout_seconds: int = 5
+    write_timeout_seconds: int = 20
+
+    #Deadlock/lock wait retries for write transactions (see app/unit_of_work.py)
+    transaction_attempts: int = 3
+    transaction_backoff_ms: int = 20
+
+    #DB circuit breaker
+    breaker_failure_threshold: int = 5
+    breaker_reset_seconds: float = 10.0
+
+    #Slow-query log (opt-in: 0 disables)
+    slow_query_ms: float = 0
+    slow_query_buffer: int = 500
+    slow_query_max_statements: int = 200
+
+    #Request profiling: a sampled fraction of requests, or any admin request sending X-Profile
+    profile_sample_rate: float = 0.0
+    profile_dir: str = "profiles"
+    profile_keep: int = 50
+
+    #Best-seller leaderboard (per worker, see app/leaderboard.py); 0 reconciles only at startup
+    leaderboard_size: int = 10
+    leaderboard_reconcile_seconds: float = 60.0
+
+    #Server-Sent Events (per worker)
+    events_max_connections: int = 500
+    events_queue_size: int = 100
+    events_heartbeat_seconds: int = 15
     
     class Config:
         env_file = ".env"
@@ -1,36 +1,135 @@
 import mysql.connector
-from mysql.connector import Error
-from mysql.connector.cursor import MySQLCursorDict
+import re
+from mysql.connector import Error, pooling
+from datetime import date
+from threading import Lock
 from .config import settings
+from .statements import Statements
+from .instrumentation import TimedCursor
+from .sqlite_database import SQLiteDatabase
+from .sharding import ShardedDatabase, sharding_enabled, shard_count, SHARED_TABLES
 
-conn = mysql.connector.connect(
-    host=settings.database_host,
-    user=settings.database_user,
-    password=settings.database_password,
-)
+#Connection settings for the home database (shard None) or one shard; a shard entry in
+#settings.database_shards only needs the keys that differ from the home database
+def connection_settings(shard: int = None) -> dict:
+    config = {
+        "host": settings.database_host,
+        "user": settings.database_user,
+        "password": settings.database_password,
+        "database": settings.database_name,
+    }
+    if shard is not None:
+        config.update(settings.database_shards[shard])
+    return config
 
-cursor = conn.cursor()
-cursor.execute("CREATE DATABASE IF NOT EXISTS yagudjob")
-conn.commit()
+if settings.database_backend == "mysql":
+    conn = mysql.connector.connect(
+        host=settings.database_host,
+        user=settings.database_user,
+        password=settings.database_password,
+    )
 
-class Database:
-    def __init__(self):
-        try:
-            self.conn = mysql.connector.connect(
-                host=settings.database_host,
-                user=settings.database_user,
-                password=settings.database_password,
-                database=settings.database_name,
-                use_pure=True
+    cursor = conn.cursor()
+    cursor.execute("CREATE DATABASE IF NOT EXISTS yagudjob")
+    conn.commit()
+
+    for shard in range(shard_count()):
+        config = connection_settings(shard)
+        shard_conn = mysql.connector.connect(host=config["host"], user=config["user"], password=config["password"])
+        shard_conn.cursor().execute(f"CREATE DATABASE IF NOT EXISTS {config['database']}")
+        shard_conn.close()
+
+#connection_timeout only bounds connecting under the C extension (and every read under the pure
+#driver), so reads and writes get their own socket timeouts: a hung server fails the statement
+#(errno 2013) instead of blocking the worker thread
+def connection_options(shard: int = None) -> dict:
+    return {
+        "connection_timeout": settings.write_timeout_seconds,
+        "read_timeout": settings.write_timeout_seconds,
+        "write_timeout": settings.write_timeout_seconds,
+        **connection_settings(shard)
+    }
+
+pools = {}
+pool_lock = Lock()
+
+#Shared pool (one per shard) for work that needs its own connection (e.g. queries run concurrently)
+def get_pool(shard: int = None):
+    with pool_lock:
+        if shard not in pools:
+            pools[shard] = pooling.MySQLConnectionPool(
+                pool_name="sari_sari" if shard is None else f"sari_sari_{shard}",
+                pool_size=settings.database_pool_size,
+                use_pure=settings.database_use_pure,
+                **connection_options(shard)
             )
+    return pools[shard]
+
+#Foreign keys to the shared tables, which are not on the shards
+SHARED_FOREIGN_KEY = re.compile(r",\s*FOREIGN KEY \(\w+\) REFERENCES (?:customers|items)\(id\)\s*ON UPDATE CASCADE ON DELETE CASCADE")
+
+class MySQLDatabase:
+    #use_pure/prepared default to the settings; the benchmarks override them per run.
+    #shard connects to that entry of settings.database_shards instead of the home database.
+    def __init__(self, pooled: bool = False, use_pure: bool = None, prepared: bool = None, shard: int = None):
+        if use_pure is None:
+            use_pure = settings.database_use_pure
+        if prepared is None:
+            prepared = settings.database_prepared_statements
+
+        self.shard = shard
+        self.database_name = connection_settings(shard)["database"]
+
+        try:
+            if pooled:
+                self.conn = get_pool(shard).get_connection()
+            else:
+                # use_pure=False picks the C extension and falls back to pure Python when it is not installed
+                self.conn = mysql.connector.connect(
+                    use_pure=use_pure,
+                    **connection_options(shard)
+                )
 
 
-            self.cursor = self.conn.cursor(cursor_class=MySQLCursorDict, buffered=True)
+            self.cursor = TimedCursor(self.conn.cursor(dictionary=True, buffered=True), self.reconnect)
+            self.statements = Statements(self.conn, self.reconnect) if prepared else None
+            self.start_session()
 
         except Error as e:
             print(f"Database connection error: {e}")
             raise
 
+    #Per session, so it is set again on pooled connections (the pool resets sessions) and after a reconnect
+    def start_session(self):
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute("SET SESSION innodb_lock_wait_timeout = %s", (settings.lock_wait_timeout_seconds,))
+
+            # Interleaved auto-increments keep ids unique across shards (shard k hands out k+1, k+1+N, ...),
+            # so an id alone still names one row for the identity map, the change feed and the events
+            if self.shard is not None:
+                cursor.execute("SET SESSION auto_increment_increment = %s, auto_increment_offset = %s", (shard_count(), self.shard + 1))
+        finally:
+            cursor.close()
+
+    #A lost connection (server restart, wait_timeout, a client read/write timeout) stays dead until
+    #reconnected; the cursors are bound to the connection object, so they keep working after this
+    def reconnect(self):
+        if self.conn.is_connected():
+            return
+
+        self.conn.reconnect(attempts=1)
+        if self.statements:
+            self.statements.forget()
+        self.start_session()
+
+    #Pooled connections go back to the pool
+    def close(self):
+        if self.statements:
+            self.statements.close()
+        self.cursor.close()
+        self.conn.close()
+
     def create_tables(self):
         commands = (
             """
@@ -143,14 +242,252 @@ class Database:
                 FOREIGN KEY (item_id) REFERENCES items(id)
                 ON UPDATE CASCADE ON DELETE CASCADE
             );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS change_log (
+                seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+                table_name VARCHAR(30) NOT NULL,
+                row_id INT NULL,
+                operation ENUM('insert', 'update', 'soft_delete', 'delete') NOT NULL,
+                data JSON NULL,
+                changed_by VARCHAR(30),
+
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                INDEX idx_change_log_created (created_at)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS balance_statements (
+                balance_id INT NOT NULL,
+                customer_id INT NOT NULL,
+                period DATE NOT NULL,
+                deposits DECIMAL(12, 2) NOT NULL DEFAULT 0.00,
+                withdrawals DECIMAL(12, 2) NOT NULL DEFAULT 0.00,
+                balance_orders DECIMAL(12, 2) NOT NULL DEFAULT 0.00,
+                closing_balance DECIMAL(12, 2) NULL,
+
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                PRIMARY KEY (balance_id, period),
+                INDEX idx_balance_statements_customer (customer_id, period)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS sync_operations (
+                client_id CHAR(36) PRIMARY KEY,
+                kind ENUM('order', 'order_item', 'transaction') NOT NULL,
+                status ENUM('applied', 'conflict') NOT NULL,
+                row_id INT NULL,
+                detail VARCHAR(255) NULL,
+                client_created_at TIMESTAMP NULL,
+                synced_by VARCHAR(30),
+
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
             """
         )
         for command in commands:
+            # Shards hold only the customer-owned tables, without the foreign keys to the shared ones
+            if self.shard is not None:
+                if re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", command).group(1) in SHARED_TABLES:
+                    continue
+                command = SHARED_FOREIGN_KEY.sub("", command)
+
             self.cursor.execute(command)
 
         self.conn.commit()
+
+        self.create_columns()
+        self.create_indexes()
+
+        if settings.transactions_partitioning:
+            self.maintain_transaction_partitions()
+
+        self.purge_change_log()
+
         self.conn.close()
 
+    #CHANGE LOG RETENTION
+    def purge_change_log(self):
+        if settings.change_log_retention_days <= 0:
+            return
+
+        # In batches so a large backlog does not hold one long-running delete
+        while True:
+            self.cursor.execute("DELETE FROM change_log WHERE created_at < NOW() - INTERVAL %s DAY LIMIT 5000", (
+                settings.change_log_retention_days,
+            ))
+            self.conn.commit()
+            if self.cursor.rowcount < 5000:
+                break
+
+    #COLUMNS
+    # Added after the table was first shipped; existing databases get them with ALTER TABLE
+    columns = (
+        ("balance_statements", "closing_balance", "closing_balance DECIMAL(12, 2) NULL AFTER balance_orders"),
+    )
+
+    def create_columns(self):
+        for table, name, definition in self.columns:
+            if self.shard is not None and table in SHARED_TABLES:
+                continue
+
+            self.cursor.execute("""
+                SELECT 1 FROM information_schema.COLUMNS
+                WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s LIMIT 1
+            """, (self.database_name, table, name))
+            if self.cursor.fetchone():
+                continue
+
+            self.cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+
+        self.conn.commit()
+
+    #INDEXES
+    # Added with ALTER TABLE (not in CREATE TABLE) so existing databases pick them up too
+    indexes = (
+        ("items", "idx_items_name", "INDEX idx_items_name (name)"),
+        ("items", "ft_items_name", "FULLTEXT INDEX ft_items_name (name)"),
+        ("customers", "idx_customers_first_name", "INDEX idx_customers_first_name (first_name)"),
+        ("customers", "idx_customers_last_name", "INDEX idx_customers_last_name (last_name)"),
+        ("transactions", "idx_transactions_customer_created", "INDEX idx_transactions_customer_created (customer_id, balance_id, created_at)"),
+        ("orders", "idx_orders_customer_created", "INDEX idx_orders_customer_created (customer_id, created_at)"),
+        ("order_items", "idx_order_items_created", "INDEX idx_order_items_created (created_at, item_id, quantity, deleted_at)"),
+    )
+
+    def create_indexes(self):
+        for table, name, definition in self.indexes:
+            if self.shard is not None and table in SHARED_TABLES:
+                continue
+
+            self.cursor.execute("""
+                SELECT 1 FROM information_schema.STATISTICS
+                WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME = %s LIMIT 1
+            """, (self.database_name, table, name))
+            if self.cursor.fetchone():
+                continue
+
+            self.cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+
+        self.conn.commit()
+
+    #TRANSACTIONS PARTITIONING
+    # MySQL does not allow foreign keys on partitioned tables, so once transactions is partitioned
+    # its customer_id/balance_id rules are enforced by the application instead:
+    #   - the transactions router validates the customer and the balance (and that the balance
+    #     belongs to the customer) before every insert
+    #   - hard deleting a customer or a balance deletes its transactions (Queries.cascade_transactions)
+    #   - ids are never updated, so ON UPDATE CASCADE has nothing to replace
+    def maintain_transaction_partitions(self):
+        partitions = self.transaction_partitions()
+        if not partitions:
+            self.partition_transactions()
+            partitions = self.transaction_partitions()
+
+        # Create the partitions for the months ahead by splitting the catch-all pmax
+        current_month = month_start(date.today())
+        last_month = month_start(current_month, settings.transactions_partitions_ahead)
+        month = month_start(current_month, 1) if not partitions else month_start(max(partitions.values()), 1)
+
+        new_partitions = []
+        while month <= last_month:
+            new_partitions.append(partition_definition(month))
+            month = month_start(month, 1)
+
+        if new_partitions:
+            new_partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+            self.cursor.execute(f"ALTER TABLE transactions REORGANIZE PARTITION pmax INTO ({', '.join(new_partitions)})")
+
+        # Archive and drop the partitions that fell out of the retention window
+        if settings.transactions_retention_months > 0:
+            cutoff = month_start(current_month, -settings.transactions_retention_months)
+
+            expired = [name for name, month in partitions.items() if month < cutoff]
+
+            if expired and settings.transactions_archive_expired:
+                self.create_transactions_archive()
+
+            for name in expired:
+                if settings.transactions_archive_expired:
+                    self.cursor.execute(f"INSERT INTO transactions_archive SELECT * FROM transactions PARTITION ({name})")
+
+                self.cursor.execute(f"ALTER TABLE transactions DROP PARTITION {name}")
+
+        self.conn.commit()
+
+    def transaction_partitions(self) -> dict:
+        self.cursor.execute("""
+            SELECT PARTITION_NAME AS name FROM information_schema.PARTITIONS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'transactions' AND PARTITION_NAME IS NOT NULL
+        """, (self.database_name,))
+
+        # pYYYYMM -> first day of the month the partition holds (pmax is left out)
+        return {
+            row["name"]: date(int(row["name"][1:5]), int(row["name"][5:7]), 1)
+            for row in self.cursor.fetchall()
+            if row["name"] != "pmax"
+        }
+
+    def create_transactions_archive(self):
+        self.cursor.execute("""
+            SELECT 1 FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'transactions_archive'
+        """, (self.database_name,))
+        if self.cursor.fetchone():
+            return
+
+        self.cursor.execute("CREATE TABLE transactions_archive LIKE transactions")
+        self.cursor.execute("ALTER TABLE transactions_archive REMOVE PARTITIONING")
+
+    def partition_transactions(self):
+        self.cursor.execute("""
+            SELECT CONSTRAINT_NAME AS name FROM information_schema.TABLE_CONSTRAINTS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'transactions' AND CONSTRAINT_TYPE = 'FOREIGN KEY'
+        """, (self.database_name,))
+        for row in self.cursor.fetchall():
+            self.cursor.execute(f"ALTER TABLE transactions DROP FOREIGN KEY {row['name']}")
+
+        # The partitioning column has to be part of every unique key
+        self.cursor.execute("""
+            ALTER TABLE transactions
+            MODIFY created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            DROP PRIMARY KEY,
+            ADD PRIMARY KEY (id, created_at)
+        """)
+
+        # Start at the oldest stored month so existing rows land in a monthly partition
+        self.cursor.execute("SELECT MIN(created_at) AS oldest FROM transactions")
+        oldest = self.cursor.fetchone()["oldest"]
+        month = month_start(oldest.date() if oldest else date.today())
+
+        definitions = []
+        while month <= month_start(date.today()):
+            definitions.append(partition_definition(month))
+            month = month_start(month, 1)
+        definitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+
+        self.cursor.execute(f"ALTER TABLE transactions PARTITION BY RANGE (UNIX_TIMESTAMP(created_at)) ({', '.join(definitions)})")
+        self.conn.commit()
+
+
+def month_start(day: date, offset: int = 0) -> date:
+    index = day.year * 12 + day.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+def partition_definition(month: date) -> str:
+    upper = month_start(month, 1)
+    return f"PARTITION p{month:%Y%m} VALUES LESS THAN (UNIX_TIMESTAMP('{upper:%Y-%m-%d} 00:00:00'))"
+
+#Storage backend picked by settings.database_backend; both take the same SQL (see app/sqlite_database.py).
+#MySQL with settings.database_shards spreads customer-owned rows over the shards (see app/sharding.py).
+if settings.database_backend == "sqlite":
+    Database = SQLiteDatabase
+elif sharding_enabled():
+    Database = ShardedDatabase
+else:
+    Database = MySQLDatabase
+
 db = Database()
 db.create_tables()
 print("Database connected successfully")
\ No newline at end of file
@@ -0,0 +1,124 @@
+import csv
+import gzip
+import io
+import json
+from fastapi import Request, Response
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware.base import BaseHTTPMiddleware
+from .config import settings
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#LIST FORMATS
+#List endpoints return negotiated_response(request, models); JSON stays FastAPI's default path
+def negotiated_response(request: Request, content: list):
+    accept = request.headers.get("accept", "")
+
+    if msgpack and ("application/msgpack" in accept or "application/x-msgpack" in accept):
+        return Response(encode_msgpack(content), media_type="application/msgpack")
+    if "text/csv" in accept:
+        return Response(encode_csv(content), media_type="text/csv")
+
+    return content
+
+def rows(content: list) -> list:
+    return [row.model_dump(mode="json") if hasattr(row, "model_dump") else row for row in content]
+
+def encode_msgpack(content: list) -> bytes:
+    return msgpack.packb(rows(content), use_bin_type=True)
+
+def encode_csv(content: list) -> str:
+    content = rows(content)
+    output = io.StringIO()
+    if content:
+        writer = csv.DictWriter(output, fieldnames=list(content[0].keys()), extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(content)
+    return output.getvalue()
+
+def encode_json(content: list) -> bytes:
+    return json.dumps(rows(content), separators=(",", ":")).encode()
+
+
+#COMPRESSION
+COMPRESSIBLE_TYPES = ("application/json", "application/msgpack", "text/csv")
+
+#Accept-Encoding as {coding: q}; a coding the client lists with q=0 (e.g. "br;q=0") is refused
+def accepted_encodings(header: str) -> dict:
+    accepted = {}
+    for part in header.split(","):
+        coding, *params = [token.strip() for token in part.split(";")]
+        if not coding:
+            continue
+
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding.lower()] = q
+    return accepted
+
+#br over gzip when both are acceptable; "*" covers a coding the client does not list
+def choose_encoding(header: str):
+    accepted = accepted_encodings(header)
+    for encoding in ("br", "gzip"):
+        if encoding == "br" and not brotli:
+            continue
+        if accepted.get(encoding, accepted.get("*", 0)) > 0:
+            return encoding
+    return None
+
+#Adds Accept-Encoding to whatever Vary the endpoint already set
+def vary_on_encoding(vary: str) -> str:
+    values = [value.strip() for value in vary.split(",") if value.strip()]
+    if "*" in values or "accept-encoding" in (value.lower() for value in values):
+        return ", ".join(values)
+    return ", ".join(values + ["Accept-Encoding"])
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=5)
+
+#gzip/brotli above a size threshold; large bodies are compressed in the threadpool so the
+#event loop keeps serving other requests. Streams (e.g. text/event-stream) pass through untouched.
+class CompressionMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        response = await call_next(request)
+
+        content_type = response.headers.get("content-type", "")
+        if "content-encoding" in response.headers or not content_type.startswith(COMPRESSIBLE_TYPES):
+            return response
+
+        # Whether or not this one is compressed, the body depends on Accept-Encoding
+        response.headers["vary"] = vary_on_encoding(response.headers.get("vary", ""))
+
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+        if encoding is None:
+            return response
+
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        headers = {key: value for key, value in response.headers.items() if key != "content-length"}
+
+        if len(body) < settings.compression_min_bytes:
+            return Response(body, status_code=response.status_code, headers=headers)
+
+        if len(body) >= settings.compression_threadpool_bytes:
+            body = await run_in_threadpool(compress, body, encoding)
+        else:
+            body = compress(body, encoding)
+
+        headers["content-encoding"] = encoding
+        return Response(body, status_code=response.status_code, headers=headers)
@@ -0,0 +1,68 @@
+import asyncio
+import json
+from threading import Lock
+from fastapi import HTTPException, status
+from .config import settings
+from .money import json_default
+
+#In-process pub/sub for the per-customer event streams.
+#Routers publish from worker threads after committing; subscribers are asyncio queues on the event loop.
+class EventBroker:
+    def __init__(self, max_connections: int, queue_size: int):
+        self.max_connections = max_connections
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.connections = 0
+        self.lock = Lock()
+        self.loop = None
+
+    def subscribe(self, customer_id: int) -> asyncio.Queue:
+        with self.lock:
+            if self.connections >= self.max_connections:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many open event streams",
+                    headers={"Retry-After": "5"}
+                )
+
+            self.loop = asyncio.get_running_loop()
+            queue = asyncio.Queue(maxsize=self.queue_size)
+            self.subscribers.setdefault(customer_id, set()).add(queue)
+            self.connections += 1
+
+        return queue
+
+    def unsubscribe(self, customer_id: int, queue: asyncio.Queue):
+        with self.lock:
+            queues = self.subscribers.get(customer_id)
+            if queues and queue in queues:
+                queues.discard(queue)
+                self.connections -= 1
+                if not queues:
+                    del self.subscribers[customer_id]
+
+    def publish(self, customer_id: int, event: str, data: dict):
+        with self.lock:
+            queues = list(self.subscribers.get(customer_id, ()))
+            loop = self.loop
+
+        if not queues or loop is None:
+            return
+
+        message = f"event: {event}\ndata: {json.dumps(data, default=json_default)}\n\n"
+        for queue in queues:
+            loop.call_soon_threadsafe(self.deliver, queue, message)
+
+    #Runs on the event loop. A subscriber that fell behind loses its backlog and is told to refetch,
+    #so a slow client never makes publishers wait or grows memory.
+    def deliver(self, queue: asyncio.Queue, message: str):
+        if queue.full():
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait("event: resync\ndata: {}\n\n")
+            return
+
+        queue.put_nowait(message)
+
+
+broker = EventBroker(settings.events_max_connections, settings.events_queue_size)
@@ -0,0 +1,83 @@
+from contextvars import ContextVar
+from datetime import datetime
+from decimal import Decimal
+
+#Rows read during the current request, keyed by (table, id). None outside a request (write queue,
+#maintenance, EXPLAIN worker), where nothing is cached.
+identity_map = ContextVar("identity_map", default=None)
+
+#Columns that feed a generated column: a write to one of them makes the cached row stale, so it is dropped
+GENERATED_INPUTS = {
+    "items": {"quantity", "orig_price", "selling_price"},
+    "order_items": {"quantity", "unit_price"},
+}
+
+#Copies go in and out, so a caller mutating a row (e.g. adjust_balance_total) never edits the cache
+def cached(table: str, table_id: int):
+    rows = identity_map.get()
+    if rows is None:
+        return None
+
+    row = rows.get((table, table_id))
+    return dict(row) if row else None
+
+def remember(table: str, row: dict):
+    rows = identity_map.get()
+    if rows is not None and row:
+        rows[(table, row["id"])] = dict(row)
+
+def forget(table: str, table_id: int = None):
+    rows = identity_map.get()
+    if rows is None:
+        return
+
+    if table_id is None:
+        for key in [key for key in rows if key[0] == table]:
+            del rows[key]
+    else:
+        rows.pop((table, table_id), None)
+
+def clear():
+    rows = identity_map.get()
+    if rows is not None:
+        rows.clear()
+
+#Applies an UPDATE's values to the cached row instead of re-reading it. Values that are not plain
+#columns (e.g. quantity_delta) or that feed a generated column drop the row instead.
+def merge(table: str, table_id: int, values: dict, changed_by: int = None):
+    rows = identity_map.get()
+    if rows is None or (table, table_id) not in rows:
+        return
+
+    row = rows[(table, table_id)]
+    if not values or not values.keys() <= row.keys() or values.keys() & GENERATED_INPUTS.get(table, set()):
+        del rows[(table, table_id)]
+        return
+
+    for column, value in values.items():
+        # DECIMAL columns come back as Decimal; keep it that way for later arithmetic
+        if isinstance(row[column], Decimal) and value is not None and not isinstance(value, Decimal):
+            value = Decimal(str(value)).quantize(row[column])
+        row[column] = value
+
+    # Every UPDATE that records a change also sets updated_at (and updated_by when it knows the user)
+    row["updated_at"] = datetime.now().replace(microsecond=0)
+    if changed_by is not None:
+        row["updated_by"] = str(changed_by)
+
+
+#Gives every HTTP request its own identity map. The dict is shared with the threadpool thread that
+#runs a sync endpoint (and parallel_queries workers) through the copied context.
+class IdentityMapMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        token = identity_map.set({})
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            identity_map.reset(token)
@@ -0,0 +1,77 @@
+import re
+import time
+from contextvars import ContextVar
+from .breaker import breaker, CONNECTION_ERRNOS
+from .config import settings
+
+#Callables observer(sql, values, seconds) notified after every statement run through a TimedCursor
+query_observers = []
+
+#Route class and "METHOD /path" of the request being served (set by the admission control middleware)
+current_route_class = ContextVar("current_route_class", default=None)
+current_route = ContextVar("current_route", default=None)
+
+SELECT = re.compile(r"^\s*SELECT\b", re.IGNORECASE)
+
+#Adds the MAX_EXECUTION_TIME hint of the current route class to SELECT statements
+def with_timeout(sql: str) -> str:
+    if not SELECT.match(sql) or "MAX_EXECUTION_TIME" in sql:
+        return sql
+
+    timeout_ms = settings.read_timeouts_ms.get(current_route_class.get(), settings.default_read_timeout_ms)
+    return SELECT.sub(f"SELECT /*+ MAX_EXECUTION_TIME({int(timeout_ms)}) */", sql, count=1)
+
+#Wraps a mysql.connector cursor: applies the read time limit, goes through the circuit breaker
+#and times execute/executemany; everything else is passed through.
+#reconnect() (if given) revives the cursor's connection: after an error that left it dead, so the
+#next statement does not fail the same way, and before the breaker's half-open probe.
+class TimedCursor:
+    def __init__(self, cursor, reconnect=None):
+        self._cursor = cursor
+        self.reconnect = reconnect
+
+    def execute(self, sql, values=()):
+        return self.run(self._cursor.execute, with_timeout(sql), values)
+
+    def executemany(self, sql, rows):
+        return self.run(self._cursor.executemany, sql, rows)
+
+    def run(self, method, sql, values):
+        probing = breaker.before()
+
+        start = time.perf_counter()
+        try:
+            if probing and self.reconnect:
+                self.reconnect()
+            result = method(sql, values)
+        except Exception as e:
+            breaker.failure(e, probing)
+            if self.reconnect and getattr(e, "errno", None) in CONNECTION_ERRNOS:
+                self.revive()
+            raise
+        else:
+            breaker.success()
+            return result
+        finally:
+            observe(sql, values, time.perf_counter() - start)
+
+    # The statement's own error is what the caller sees; a failed reconnect is retried by the next one
+    def revive(self):
+        try:
+            self.reconnect()
+        except Exception as e:
+            print(f"Database reconnect failed: {e}")
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+def observe(sql, values, seconds: float):
+    for observer in query_observers:
+        try:
+            observer(sql, values, seconds)
+        except Exception as e:
+            print(f"Query observer failed: {e}")
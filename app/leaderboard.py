@@ -0,0 +1,178 @@
+import bisect
+import heapq
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from threading import Condition, Event, Lock, Thread
+from .queries import items_sold_since
+from .metrics import metrics
+from .config import settings
+
+PERIODS = ("today", "week")
+
+def period_start(period: str, day: date) -> date:
+    return day if period == "today" else day - timedelta(days=day.weekday())
+
+#Top sellers per period, kept in memory so the cashier's quick-add buttons never run the GROUP BY.
+#Order item writes record their quantity change after they commit; the counts are rebuilt from the
+#database at startup and every leaderboard_reconcile_seconds, which also picks up what the writes
+#here do not see (other workers' sales, cascaded deletes, a write lost between commit and record).
+#
+#A write's commit and its record() run inside recording() (see commit()); reconcile waits for the
+#ones in flight and holds new ones back while it reads, so every sale is either in the database read (and recorded
+#on the board being replaced) or recorded on the new board, never both. Writers pause for the
+#read, an indexed GROUP BY every leaderboard_reconcile_seconds.
+#
+#Each period keeps every item's count plus its top entries as a sorted list of (-sold, item_id), so
+#a read copies at most size entries. Increases re-rank in O(size). A top item dropping below the old
+#last entry may let an item outside the top in; that marks the list stale and the next read rebuilds
+#it from the counts.
+class Leaderboard:
+    def __init__(self, size: int, reconcile_seconds: float):
+        self.size = size
+        self.reconcile_seconds = reconcile_seconds
+        self.lock = Lock()
+        self.writes = Condition()
+        self.writing = 0
+        self.reading = False
+        self.boards = {}
+        self.stopping = Event()
+        self.thread = None
+
+    def start(self):
+        self.reconcile()
+
+        if self.reconcile_seconds > 0:
+            self.stopping.clear()
+            self.thread = Thread(target=self.run, name="leaderboard", daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout: float = 10):
+        if not self.thread:
+            return
+
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.reconcile_seconds):
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"Leaderboard reconcile failed: {e}")
+                metrics.increment("leaderboard.reconcile_failed")
+
+    @contextmanager
+    def recording(self):
+        with self.writes:
+            while self.reading:
+                self.writes.wait()
+            self.writing += 1
+        try:
+            yield
+        finally:
+            with self.writes:
+                self.writing -= 1
+                if not self.writing:
+                    self.writes.notify_all()
+
+    #Commits db and records its sales, (item_id, quantity, sold_at) each, as one step for reconcile.
+    #Only the commit is held: lock waits and retries happen before it, outside recording().
+    def commit(self, db, sales):
+        with self.recording():
+            db.conn.commit()
+            for item_id, quantity, sold_at in sales:
+                self.record(item_id, quantity, sold_at)
+
+    def reconcile(self):
+        with self.writes:
+            while self.reading:
+                self.writes.wait()
+            self.reading = True
+            while self.writing:
+                self.writes.wait()
+
+        try:
+            today = date.today()
+            counts = {period: (period_start(period, today), items_sold_since(period_start(period, today))) for period in PERIODS}
+
+            with self.lock:
+                for period, (since, sold) in counts.items():
+                    self.boards[period] = {"since": since, "counts": sold, "top": None}
+        finally:
+            with self.writes:
+                self.reading = False
+                self.writes.notify_all()
+
+        metrics.increment("leaderboard.reconciled")
+
+    #A board whose period has ended starts over empty
+    def board(self, period: str) -> dict:
+        since = period_start(period, date.today())
+        board = self.boards.get(period)
+        if board is None or board["since"] != since:
+            board = self.boards[period] = {"since": since, "counts": {}, "top": []}
+        return board
+
+    #quantity is the change in units sold (negative for returns and edits down); sold_at is the
+    #order item's created_at, so editing last week's sale leaves today's board alone
+    def record(self, item_id: int, quantity: int, sold_at: datetime):
+        if not quantity:
+            return
+
+        with self.lock:
+            for period in PERIODS:
+                board = self.board(period)
+                if sold_at.date() < board["since"]:
+                    continue
+
+                counts = board["counts"]
+                sold = counts.get(item_id, 0) + quantity
+                if sold > 0:
+                    counts[item_id] = sold
+                else:
+                    counts.pop(item_id, None)
+
+                self.rerank(board, item_id, sold, quantity)
+
+    #A hard-deleted item leaves every board; the next read rebuilds a top it was in
+    def forget(self, item_id: int):
+        with self.lock:
+            for board in self.boards.values():
+                board["counts"].pop(item_id, None)
+                if board["top"] and any(entry[1] == item_id for entry in board["top"]):
+                    board["top"] = None
+
+    def rerank(self, board: dict, item_id: int, sold: int, quantity: int):
+        top = board["top"]
+        if top is None:
+            return
+
+        entries = [entry for entry in top if entry[1] != item_id]
+        ranked = len(entries) != len(top)
+        if not ranked and quantity < 0:
+            return
+
+        if sold > 0:
+            bisect.insort(entries, (-sold, item_id))
+        del entries[self.size:]
+
+        # Items outside the top sold at most as many as the old last entry; one may now outrank this one
+        if ranked and quantity < 0 and sold < -top[-1][0] and len(board["counts"]) > len(entries):
+            board["top"] = None
+            return
+
+        board["top"] = entries
+
+    #[(item_id, sold), ...] best first, and the day the period started
+    def top(self, period: str) -> tuple:
+        with self.lock:
+            board = self.board(period)
+            if board["top"] is None:
+                board["top"] = sorted((-sold, item_id) for item_id, sold in heapq.nlargest(self.size, board["counts"].items(), key=lambda entry: entry[1]))
+                metrics.increment("leaderboard.reranked")
+
+            return [(item_id, -sold) for sold, item_id in board["top"]], board["since"]
+
+
+leaderboard = Leaderboard(settings.leaderboard_size, settings.leaderboard_reconcile_seconds)
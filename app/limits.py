@@ -0,0 +1,117 @@
+import time
+from threading import Lock
+from anyio import to_thread
+from fastapi.responses import JSONResponse
+from .config import settings
+from .instrumentation import query_observers, current_route_class, current_route
+import re
+from .metrics import metrics
+
+#Smoothed DB statement latency, fed by every TimedCursor
+class LatencyTracker:
+    def __init__(self, alpha: float = 0.05):
+        self.alpha = alpha
+        self.average = 0.0
+        self.lock = Lock()
+
+    def __call__(self, sql, values, seconds: float):
+        with self.lock:
+            self.average += self.alpha * (seconds * 1000 - self.average)
+
+
+#In-flight cap for one route class. The cap grows by one while the DB is under the latency
+#target and shrinks by a tenth when it is over (AIMD), between a floor of 2 and the configured max.
+class AdaptiveLimiter:
+    def __init__(self, name: str, maximum: int, minimum: int = 2):
+        self.name = name
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.limit = maximum
+        self.in_flight = 0
+        self.adjusted_at = time.monotonic()
+        self.lock = Lock()
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, db_latency_ms: float):
+        with self.lock:
+            self.in_flight -= 1
+
+            now = time.monotonic()
+            if now - self.adjusted_at < 1:
+                return
+            self.adjusted_at = now
+
+            if db_latency_ms > settings.admission_target_db_ms:
+                self.limit = max(self.minimum, int(self.limit * 0.9))
+            else:
+                self.limit = min(self.maximum, self.limit + 1)
+
+        metrics.set(f"admission.{self.name}.limit", self.limit)
+
+
+ADMIN_PREFIXES = ("/metrics", "/changes", "/slow-queries", "/customers/search", "/items/import", "/items/bulk")
+UNLIMITED_SUFFIXES = ("/events", "/events/")
+
+def route_class(scope) -> str:
+    path = scope["path"]
+    if path.endswith(UNLIMITED_SUFFIXES):
+        return None     # long-lived streams have their own cap
+    if path.startswith("/login"):
+        return "auth"
+    if path.startswith(ADMIN_PREFIXES) or path.endswith(("/statement", "/statement/")):
+        return "admin"
+    if scope["method"] in ("GET", "HEAD", "OPTIONS"):
+        return "read"
+    return "write"
+
+
+#Sync endpoints hold a threadpool thread each, so the pool has to fit every admitted request:
+#anyio's default of 40 would queue requests admission control already let in. Run at startup, on the loop.
+def size_threadpool():
+    limiter = to_thread.current_default_thread_limiter()
+    limiter.total_tokens = max(limiter.total_tokens, sum(settings.admission_limits.values()) + settings.threadpool_headroom)
+    metrics.set("threadpool.size", limiter.total_tokens)
+
+
+db_latency = LatencyTracker()
+query_observers.append(db_latency)
+
+limiters = {name: AdaptiveLimiter(name, maximum) for name, maximum in settings.admission_limits.items()}
+
+#Fails fast with 503 + Retry-After when a route class is at its limit, instead of queueing in the threadpool
+class AdmissionControlMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        # Also picks the statement time limits for this request (see instrumentation.with_timeout)
+        request_class = route_class(scope)
+        current_route_class.set(request_class)
+        current_route.set(f"{scope['method']} {re.sub(r'/[0-9]+', '/{id}', scope['path'])}")
+
+        limiter = limiters.get(request_class) if settings.admission_control else None
+        if limiter is None:
+            return await self.app(scope, receive, send)
+
+        if not limiter.try_acquire():
+            metrics.increment(f"admission.{limiter.name}.rejected")
+            response = JSONResponse(
+                {"detail": "Server is busy, try again shortly"},
+                status_code=503,
+                headers={"Retry-After": "1"}
+            )
+            return await response(scope, receive, send)
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(db_latency.average)
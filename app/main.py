@@ -1,9 +1,22 @@
 from fastapi import FastAPI
 from .database import Database
-from .routers import customers, login, balances, transactions, items, orders, order_items
+from .background import write_queue
+from .leaderboard import leaderboard
+from .encoding import CompressionMiddleware
+from .limits import AdmissionControlMiddleware, size_threadpool
+from .profiling import ProfilingMiddleware
+from .identity import IdentityMapMiddleware
+from .sharding import ShardMiddleware
+from .routers import customers, login, balances, transactions, items, orders, order_items, changes, events, metrics, slow_queries, sync
 
 app = FastAPI()
 
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(ShardMiddleware)
+app.add_middleware(IdentityMapMiddleware)
+app.add_middleware(AdmissionControlMiddleware)
+
 app.include_router(login.router)
 app.include_router(customers.router)
 app.include_router(balances.router)
@@ -11,6 +24,11 @@ app.include_router(transactions.router)
 app.include_router(items.router)
 app.include_router(orders.router)
 app.include_router(order_items.router)
+app.include_router(changes.router)
+app.include_router(events.router)
+app.include_router(metrics.router)
+app.include_router(slow_queries.router)
+app.include_router(sync.router)
 
 #TODO items table remove generated as
 #TODO orders put/patch todo
@@ -18,5 +36,13 @@ app.include_router(order_items.router)
 
 @app.on_event("startup")
 def startup():
+    size_threadpool()
     db = Database()
-    db.create_tables()
\ No newline at end of file
+    db.create_tables()
+    write_queue.start()
+    leaderboard.start()
+
+@app.on_event("shutdown")
+def shutdown():
+    leaderboard.stop()
+    write_queue.stop()
@@ -0,0 +1,16 @@
+from .database import Database
+from .config import settings
+
+#Run periodically (e.g. daily cron: python -m app.maintenance) so future partitions
+#exist before they are needed, expired ones are archived/dropped and old changes are purged
+if __name__ == "__main__":
+    db = Database()
+
+    if settings.transactions_partitioning:
+        db.maintain_transaction_partitions()
+        print("Transactions partitions maintained")
+
+    db.purge_change_log()
+    print("Change log purged")
+
+    db.conn.close()
@@ -0,0 +1,22 @@
+from threading import Lock
+
+#Process-wide counters and gauges, read by the admin /metrics endpoint
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.lock = Lock()
+
+    def increment(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value):
+        with self.lock:
+            self.counters[name] = value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+
+metrics = Metrics()
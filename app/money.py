@@ -0,0 +1,29 @@
+from decimal import Decimal
+from typing import Annotated
+from pydantic import Field, PlainSerializer
+
+#Money is DECIMAL(10, 2) in the database and Decimal everywhere in between: never float on the way
+#in (a JSON number is validated from its digits), never int on the way out.
+
+#Request amounts: a third decimal place or an eleventh digit is a 422, not a silent rounding
+Money = Annotated[Decimal, Field(max_digits=10, decimal_places=2)]
+
+#Response amounts stay JSON numbers. DECIMAL(10, 2) has at most 10 significant digits, which a
+#float prints back exactly, so the conversion happens once, at serialization, and loses nothing.
+MoneyOut = Annotated[Decimal, PlainSerializer(float, return_type=float, when_used="json")]
+
+#For json.dumps (change feed, events): amounts as numbers, anything else (dates) as text
+def json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+ZERO = Decimal("0.00")
+
+#Sums and running totals (statements, sync batches) stay Decimal: the driver already returns
+#DECIMAL columns as Decimal, and adding them is cheaper than converting each one to int cents and
+#back (benchmarks/money.py). Aggregates with no rows come back as NULL, or as an int 0 from a literal.
+def as_money(value) -> Decimal:
+    if isinstance(value, Decimal):
+        return value
+    return ZERO if value is None else Decimal(str(value))
@@ -0,0 +1,168 @@
+import asyncio
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import re
+import time
+import tracemalloc
+from contextvars import ContextVar
+from threading import Lock, get_ident
+from fastapi import HTTPException
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from .config import settings
+from .oauth2 import verify_token
+
+PROFILE_HEADER = b"x-profile"
+
+#Profiles of the request being profiled, if any; None (the common case) costs one lookup per call
+active_profile = ContextVar("active_profile", default=None)
+
+#One profiled request at a time: tracemalloc is process-wide
+profile_lock = Lock()
+
+#The request's profilers: the event loop's, plus one for a sync endpoint in the threadpool
+class ProfileSession:
+    def __init__(self):
+        self.profiles = []
+        self.lock = Lock()
+        self.loop_thread = get_ident()
+
+    #An enabled profiler for the calling thread, or None when the loop's profiler already sees it:
+    #on the loop thread itself (a second enable/disable there would stop the loop's profiler), and
+    #on 3.12+, where cProfile profiles every thread and only one may be active ("Another profiling
+    #tool is already active")
+    def enable(self):
+        if get_ident() == self.loop_thread:
+            return None
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return None
+
+        with self.lock:
+            self.profiles.append(profiler)
+        return profiler
+
+#Route class for the routers: sync endpoints run in the threadpool, and before 3.12 cProfile only
+#sees the thread it was enabled on, so the endpoint call itself is profiled where it runs. Async
+#endpoints run on the loop and are covered by ProfilingMiddleware's profiler.
+class ProfiledRoute(APIRoute):
+    def get_route_handler(self):
+        if not asyncio.iscoroutinefunction(self.dependant.call):
+            self.dependant.call = profiled(self.dependant.call)
+        return super().get_route_handler()
+
+def profiled(call):
+    @functools.wraps(call)
+    def profiled_call(**kwargs):
+        session = active_profile.get()
+        profiler = session.enable() if session is not None else None
+        if profiler is None:
+            return call(**kwargs)
+        try:
+            return call(**kwargs)
+        finally:
+            profiler.disable()
+
+    return profiled_call
+
+
+def admin_requested(scope) -> bool:
+    headers = dict(scope["headers"])
+    if PROFILE_HEADER not in headers:
+        return False
+
+    authorization = headers.get(b"authorization", b"").decode()
+    if not authorization.lower().startswith("bearer "):
+        return False
+    try:
+        return verify_token(authorization[7:], HTTPException(status_code=401)).role == "admin"
+    except HTTPException:
+        return False
+
+#Profiles sampled requests (profile_sample_rate) and admin requests carrying X-Profile with cProfile
+#and tracemalloc. The event loop side (routing, response serialization) is profiled here; the
+#endpoint body by ProfiledRoute. Traces go to profile_dir, newest profile_keep kept.
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        sampled = settings.profile_sample_rate > 0 and random.random() < settings.profile_sample_rate
+        if not (sampled or admin_requested(scope)) or not profile_lock.acquire(blocking=False):
+            return await self.app(scope, receive, send)
+
+        session = ProfileSession()
+        token = active_profile.set(session)
+        tracemalloc.start()
+        loop_profiler = cProfile.Profile()
+        start = time.perf_counter()
+        status_code = []
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status_code.append(message["status"])
+            await send(message)
+
+        try:
+            try:
+                loop_profiler.enable()
+            except ValueError:
+                # Another profiler (a debugger, a profiled run of the whole server) owns the process
+                loop_profiler = None
+
+            if loop_profiler is None:
+                await self.app(scope, receive, send_status)
+            else:
+                session.profiles.append(loop_profiler)
+                try:
+                    await self.app(scope, receive, send_status)
+                finally:
+                    loop_profiler.disable()
+        finally:
+            duration_ms = (time.perf_counter() - start) * 1000
+            allocations = tracemalloc.take_snapshot().statistics("lineno")[:25]
+            tracemalloc.stop()
+            active_profile.reset(token)
+            profile_lock.release()
+
+            route = f"{scope['method']} {scope['path']}"
+            await run_in_threadpool(write_profile, session, route, duration_ms, status_code[0] if status_code else 500, allocations)
+
+
+def write_profile(session: ProfileSession, route: str, duration_ms: float, status_code: int, allocations: list):
+    os.makedirs(settings.profile_dir, exist_ok=True)
+
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_')}-{int(duration_ms)}ms"
+    path = os.path.join(settings.profile_dir, name)
+
+    stats = pstats.Stats(*session.profiles)
+    stats.dump_stats(f"{path}.prof")
+
+    summary = io.StringIO()
+    summary.write(f"route: {route}\nstatus: {status_code}\nduration_ms: {duration_ms:.2f}\n\n")
+    pstats.Stats(*session.profiles, stream=summary).sort_stats("cumulative").print_stats(40)
+    summary.write("\ntop allocations:\n")
+    for statistic in allocations:
+        summary.write(f"{statistic}\n")
+
+    with open(f"{path}.txt", "w") as file:
+        file.write(summary.getvalue())
+
+    # Bounded retention: drop the oldest traces
+    traces = sorted(entry for entry in os.listdir(settings.profile_dir) if entry.endswith(".prof"))
+    for trace in traces[:-settings.profile_keep]:
+        for extension in (".prof", ".txt"):
+            try:
+                os.remove(os.path.join(settings.profile_dir, trace[:-5] + extension))
+            except FileNotFoundError:
+                pass
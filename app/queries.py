@@ -1,10 +1,46 @@
 from fastapi import HTTPException, status
 from decimal import Decimal
+from datetime import datetime, date
+from .database import Database, month_start
+from .background import write_queue
+from .identity import cached, remember, forget, merge
+from .money import json_default, as_money, ZERO
+from .config import settings
+from .sharding import sharding_enabled, shard_count, shard_for, use_shard
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+import json
+import re
 
 class Queries:
     def __init__(self, db):
         self.cursor = db.cursor
         self.conn = db.conn
+        self.statements = getattr(db, "statements", None)
+
+    #Fixed hot queries go through prepared statements when the connection has them
+    def fetch_one(self, sql: str, values: tuple = ()):
+        if self.statements:
+            return self.statements.fetchone(sql, values)
+        self.cursor.execute(sql, values)
+        return self.cursor.fetchone()
+
+    def fetch_all(self, sql: str, values: tuple = ()) -> list:
+        if self.statements:
+            return self.statements.fetchall(sql, values)
+        self.cursor.execute(sql, values)
+        return self.cursor.fetchall()
+
+    #Reads of one row by id go through the request's identity map (app/identity.py), so a row is
+    #read at most once per request. scope re-applies the query's other filters to a cached row.
+    def fetch_row(self, table: str, table_id: int, sql: str, values: tuple, **scope):
+        row = cached(table, table_id)
+        if row is None:
+            row = self.fetch_one(sql, values)
+            remember(table, row)
+            return row
+
+        return row if all(row[column] == value for column, value in scope.items()) else None
         
     #RESPONSE LIST/INDIV
     def response(self, current_user, unpack, user_response, admin_response):
@@ -43,61 +79,469 @@ class Queries:
             values = tuple(data.values()) + (table_id,)
 
         self.cursor.execute(sql, values)
+        if self.cursor.rowcount:
+            self.record_change(table, "update", table_id, data, updated_by)
 
 
     #GET ALL/BY_ID
     def get_request(self, table: str, table_id: int = None):
         if table_id:
-            self.cursor.execute(f"SELECT * FROM {table} WHERE id = %s AND deleted_at IS NULL", (table_id,))
-            return self.cursor.fetchone()
+            return self.fetch_row(table, table_id, f"SELECT * FROM {table} WHERE id = %s AND deleted_at IS NULL", (table_id,))
         else:
-            self.cursor.execute(f"SELECT * FROM {table} WHERE deleted_at IS NULL")
-            return self.cursor.fetchall()
+            return self.fetch_all(f"SELECT * FROM {table} WHERE deleted_at IS NULL")
 
-    def get_transactions(self, table_id: int = None, customer_id: int = None, balance_id: int = None):
+    def get_transactions(self, table_id: int = None, customer_id: int = None, balance_id: int = None, created_from: datetime = None, created_to: datetime = None,
+                         type: str = None, min_amount: Decimal = None, max_amount: Decimal = None, sort: str = "created_at", direction: str = "desc", limit: int = None):
         if table_id:
-            self.cursor.execute(f"SELECT * FROM transactions WHERE id = %s AND customer_id = %s AND balance_id = %s AND deleted_at IS NULL", (
-                table_id, customer_id, balance_id)
+            return self.fetch_row("transactions", table_id, "SELECT * FROM transactions WHERE id = %s AND customer_id = %s AND balance_id = %s AND deleted_at IS NULL", (
+                table_id, customer_id, balance_id), customer_id=customer_id, balance_id=balance_id
             )
-            return self.cursor.fetchone()
         else:
-            self.cursor.execute(f"SELECT * FROM transactions WHERE customer_id = %s AND balance_id = %s AND deleted_at IS NULL", (customer_id, balance_id))
+            # Plain range comparisons on created_at so idx_transactions_customer_created serves the
+            # range (and MySQL can prune monthly partitions)
+            sql, values = add_conditions(
+                "SELECT * FROM transactions WHERE customer_id = %s AND deleted_at IS NULL",
+                (customer_id,),
+                (
+                    ("balance_id = %s", balance_id),
+                    ("created_at >= %s", created_from),
+                    ("created_at < %s", created_to),
+                    ("type = %s", type),
+                    ("amount >= %s", min_amount),
+                    ("amount <= %s", max_amount),
+                )
+            )
+            sql += order_by("transactions", sort, direction)
+            if limit:
+                sql += " LIMIT %s"
+                values += (limit,)
+
+            self.cursor.execute(sql, values)
             return self.cursor.fetchall()
     
-    def get_orders(self, table_id: int = None, customer_id: int = None):
+    def get_orders(self, table_id: int = None, customer_id: int = None, created_from: datetime = None, created_to: datetime = None,
+                   payment_method: str = None, min_total: Decimal = None, max_total: Decimal = None, sort: str = "created_at", direction: str = "desc", limit: int = None):
         if table_id:
-            self.cursor.execute("SELECT * FROM orders WHERE id = %s AND customer_id = %s AND deleted_at IS NULL", (table_id, customer_id))
-            return self.cursor.fetchone()
+            return self.fetch_row("orders", table_id, "SELECT * FROM orders WHERE id = %s AND customer_id = %s AND deleted_at IS NULL", (table_id, customer_id), customer_id=customer_id)
         else:
-            self.cursor.execute("SELECT * FROM orders WHERE customer_id = %s AND deleted_at IS NULL", (customer_id,))
+            # Without a customer_id: every customer's orders (the admin listing, see recent_orders)
+            sql, values = add_conditions(
+                "SELECT * FROM orders WHERE deleted_at IS NULL",
+                (),
+                (
+                    ("customer_id = %s", customer_id),
+                    ("created_at >= %s", created_from),
+                    ("created_at < %s", created_to),
+                    ("payment_method = %s", payment_method),
+                    ("total >= %s", min_total),
+                    ("total <= %s", max_total),
+                )
+            )
+            sql += order_by("orders", sort, direction)
+            if limit:
+                sql += " LIMIT %s"
+                values += (limit,)
+
+            self.cursor.execute(sql, values)
             return self.cursor.fetchall()
 
     def get_order_items(self, table_id: int = None, order_id: int = None):
         if table_id:
-            self.cursor.execute("SELECT * FROM order_items WHERE id = %s AND order_id = %s AND deleted_at IS NULL", (table_id, order_id))
-            return self.cursor.fetchone()
+            return self.fetch_row("order_items", table_id, "SELECT * FROM order_items WHERE id = %s AND order_id = %s AND deleted_at IS NULL", (table_id, order_id), order_id=order_id)
         else:
-            self.cursor.execute("SELECT * FROM order_items WHERE order_id = %s AND deleted_at IS NULL", (order_id,))
-            return self.cursor.fetchall()
+            return self.fetch_all("SELECT * FROM order_items WHERE order_id = %s AND deleted_at IS NULL", (order_id,))
         
+    def get_customer_balance(self, customer_id: int):
+        return self.fetch_one("SELECT * FROM balances WHERE customer_id = %s AND deleted_at IS NULL ORDER BY id LIMIT 1", (customer_id,))
+
+    #ORDER DETAILS
+    def get_order_detail(self, order_id: int, customer_id: int):
+        if sharding_enabled():
+            return self.get_sharded_order_detail(order_id, customer_id)
+
+        # Customer, order, line items and item names in one round trip
+        columns = ", ".join(f"oi.{column} AS oi_{column}" for column in ORDER_ITEM_COLUMNS)
+        self.cursor.execute(f"""
+            SELECT o.*, {columns}, i.name AS oi_item_name, i.selling_price AS oi_item_selling_price
+            FROM orders o
+            JOIN customers c ON c.id = o.customer_id AND c.deleted_at IS NULL
+            LEFT JOIN order_items oi ON oi.order_id = o.id AND oi.deleted_at IS NULL
+            LEFT JOIN items i ON i.id = oi.item_id
+            WHERE o.id = %s AND o.customer_id = %s AND o.deleted_at IS NULL
+            ORDER BY oi.id
+        """, (order_id, customer_id))
+        rows = self.cursor.fetchall()
+
+        if not rows:
+            return None
+
+        order = {key: value for key, value in rows[0].items() if not key.startswith("oi_")}
+        order["order_items"] = [
+            {key[3:]: value for key, value in row.items() if key.startswith("oi_")}
+            for row in rows if row["oi_id"] is not None
+        ]
+        return order
+
+    #Sharded: the order and its line items come from the customer's shard, the customer and the
+    #item names from the home database
+    def get_sharded_order_detail(self, order_id: int, customer_id: int):
+        if not self.get_request("customers", customer_id):
+            return None
+
+        columns = ", ".join(f"oi.{column} AS oi_{column}" for column in ORDER_ITEM_COLUMNS)
+        self.cursor.execute(f"""
+            SELECT o.*, {columns}
+            FROM orders o
+            LEFT JOIN order_items oi ON oi.order_id = o.id AND oi.deleted_at IS NULL
+            WHERE o.id = %s AND o.customer_id = %s AND o.deleted_at IS NULL
+            ORDER BY oi.id
+        """, (order_id, customer_id))
+        rows = self.cursor.fetchall()
+
+        if not rows:
+            return None
+
+        order = {key: value for key, value in rows[0].items() if not key.startswith("oi_")}
+        order["order_items"] = self.attach_item_details([
+            {key[3:]: value for key, value in row.items() if key.startswith("oi_")}
+            for row in rows if row["oi_id"] is not None
+        ])
+        return order
+
+    def attach_order_items(self, orders: list) -> list:
+        if not orders:
+            return orders
+
+        # One IN (...) query for every order instead of one query per order
+        placeholders = ", ".join(["%s"] * len(orders))
+        if sharding_enabled():
+            self.cursor.execute(f"""
+                SELECT * FROM order_items
+                WHERE order_id IN ({placeholders}) AND deleted_at IS NULL
+                ORDER BY id
+            """, tuple(order["id"] for order in orders))
+            rows = self.attach_item_details(self.cursor.fetchall())
+        else:
+            self.cursor.execute(f"""
+                SELECT oi.*, i.name AS item_name, i.selling_price AS item_selling_price
+                FROM order_items oi
+                LEFT JOIN items i ON i.id = oi.item_id
+                WHERE oi.order_id IN ({placeholders}) AND oi.deleted_at IS NULL
+                ORDER BY oi.id
+            """, tuple(order["id"] for order in orders))
+            rows = self.cursor.fetchall()
+
+        order_items = {order["id"]: [] for order in orders}
+        for row in rows:
+            order_items[row["order_id"]].append(row)
+
+        for order in orders:
+            order["order_items"] = order_items[order["id"]]
+
+        return orders
+
+    #What the items JOIN adds on a single database: one IN (...) query on the home database
+    def attach_item_details(self, order_items: list) -> list:
+        item_ids = sorted({order_item["item_id"] for order_item in order_items})
+        items = {}
+        if item_ids:
+            placeholders = ", ".join(["%s"] * len(item_ids))
+            self.cursor.execute(f"SELECT id, name, selling_price FROM items WHERE id IN ({placeholders})", tuple(item_ids))
+            items = {row["id"]: row for row in self.cursor.fetchall()}
+
+        for order_item in order_items:
+            item = items.get(order_item["item_id"], {})
+            order_item["item_name"] = item.get("name")
+            order_item["item_selling_price"] = item.get("selling_price")
+
+        return order_items
+
+    #SEARCH
+    def search_items(self, search: str, mode: str = "prefix", min_quantity: int = None, min_price: Decimal = None, max_price: Decimal = None, limit: int = 20, offset: int = 0):
+        if mode == "fulltext":
+            # Every word has to match, as a prefix, in BOOLEAN MODE; operators typed by the user are dropped
+            terms = re.sub(r'[+\-<>()~*"@]', " ", search).split()
+            match = " ".join(f"+{term}*" for term in terms)
+
+            sql = "SELECT *, MATCH(name) AGAINST (%s IN BOOLEAN MODE) AS score FROM items WHERE MATCH(name) AGAINST (%s IN BOOLEAN MODE) AND deleted_at IS NULL"
+            values = (match, match)
+            order_by = " ORDER BY score DESC, name"
+        else:
+            sql = "SELECT * FROM items WHERE name LIKE %s AND deleted_at IS NULL"
+            values = (like_prefix(search),)
+            order_by = " ORDER BY name"
+
+        if min_quantity is not None:
+            sql += " AND quantity >= %s"
+            values += (min_quantity,)
+        if min_price is not None:
+            sql += " AND selling_price >= %s"
+            values += (min_price,)
+        if max_price is not None:
+            sql += " AND selling_price <= %s"
+            values += (max_price,)
+
+        sql += order_by + " LIMIT %s OFFSET %s"
+        values += (limit, offset)
+
+        self.cursor.execute(sql, values)
+        return self.cursor.fetchall()
+
+    def search_customers(self, email: str = None, first_name: str = None, last_name: str = None, limit: int = 20, offset: int = 0):
+        if sharding_enabled():
+            sql = "SELECT c.* FROM customers c WHERE c.deleted_at IS NULL"
+        else:
+            # One row per customer: the first balance, as customer_balances picks when sharded
+            sql = """
+                SELECT c.*, b.id AS balance_id, b.total AS balance_total
+                FROM customers c
+                LEFT JOIN balances b ON b.id = (
+                    SELECT MIN(fb.id) FROM balances fb WHERE fb.customer_id = c.id AND fb.deleted_at IS NULL
+                )
+                WHERE c.deleted_at IS NULL
+            """
+        values = ()
+
+        for column, search in (("email", email), ("first_name", first_name), ("last_name", last_name)):
+            if search:
+                sql += f" AND c.{column} LIKE %s"
+                values += (like_prefix(search),)
+
+        sql += " ORDER BY c.last_name, c.first_name, c.id LIMIT %s OFFSET %s"
+        values += (limit, offset)
+
+        self.cursor.execute(sql, values)
+        customers = self.cursor.fetchall()
+
+        if sharding_enabled():
+            balances = customer_balances([customer["id"] for customer in customers])
+            for customer in customers:
+                balance = balances.get(customer["id"])
+                customer["balance_id"] = balance["id"] if balance else None
+                customer["balance_total"] = balance["total"] if balance else None
+
+        return customers
+
+    def get_balances_for(self, customer_ids: list) -> list:
+        placeholders = ", ".join(["%s"] * len(customer_ids))
+        self.cursor.execute(f"SELECT id, customer_id, total FROM balances WHERE customer_id IN ({placeholders}) AND deleted_at IS NULL ORDER BY id", tuple(customer_ids))
+        return self.cursor.fetchall()
+
+    #STATEMENTS
+    def balance_statement(self, balance: dict, months: int) -> list:
+        current_month = month_start(date.today())
+        first_month = month_start(current_month, -(months - 1))
+
+        # Closed months come from balance_statements with the balance they closed at, so a later direct
+        # edit of the total cannot rewrite them; the ones not cached yet are computed once and stored
+        self.cursor.execute("SELECT * FROM balance_statements WHERE balance_id = %s AND period >= %s AND period < %s", (
+            balance["id"], first_month, current_month
+        ))
+        cached = self.cursor.fetchall()
+        # Movements are (deposits, withdrawals, balance_orders) from here on
+        movements = {row["period"]: movement(row) for row in cached}
+        closings = {row["period"]: as_money(row["closing_balance"]) for row in cached if row["closing_balance"] is not None}
+
+        closed_months = [month_start(first_month, offset) for offset in range(months - 1)]
+        missing = [month for month in closed_months if month not in movements]
+        if missing:
+            computed = self.period_movements(balance, missing[0], current_month)
+            for month in missing:
+                movements[month] = computed.get(month, NO_MOVEMENT)
+
+        # The current month is always live
+        movements[current_month] = self.period_movements(balance, current_month, month_start(current_month, 1)).get(current_month, NO_MOVEMENT)
+
+        # Walk back from the live total: each month closes at its stored balance, or else at what the
+        # next month opened with, and opens at that minus its own movements
+        statement = []
+        closing = as_money(balance["total"])
+        for month in reversed(closed_months + [current_month]):
+            deposits, withdrawals, balance_orders = movements.get(month, NO_MOVEMENT)
+            closing = closings.get(month, closing)
+            opening = closing - deposits + withdrawals + balance_orders
+
+            statement.append({
+                "period": month,
+                "opening_balance": opening,
+                "deposits": deposits,
+                "withdrawals": withdrawals,
+                "balance_orders": balance_orders,
+                "adjustments": ZERO,
+                "closing_balance": closing
+            })
+            closing = opening
+        statement.reverse()
+
+        # What the movements do not explain (a direct PUT/PATCH of the total) is the month's adjustment:
+        # each month opens at the previous month's close
+        for previous, period in zip(statement, statement[1:]):
+            period["adjustments"] = period["opening_balance"] - previous["closing_balance"]
+            period["opening_balance"] = previous["closing_balance"]
+
+        if missing:
+            closed = {period["period"]: period for period in statement}
+            self.cursor.executemany("""
+                INSERT IGNORE INTO balance_statements (balance_id, customer_id, period, deposits, withdrawals, balance_orders, closing_balance)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, [(balance["id"], balance["customer_id"], month, *movements[month], closed[month]["closing_balance"]) for month in missing])
+            self.conn.commit()
+
+        return statement
+
+    def period_movements(self, balance: dict, start: date, end: date) -> dict:
+        self.cursor.execute("""
+            SELECT YEAR(created_at) AS year, MONTH(created_at) AS month,
+                SUM(CASE WHEN type = 'deposit' THEN amount ELSE 0 END) AS deposits,
+                SUM(CASE WHEN type = 'withdraw' THEN amount ELSE 0 END) AS withdrawals,
+                0 AS balance_orders
+            FROM transactions
+            WHERE customer_id = %s AND balance_id = %s AND deleted_at IS NULL AND created_at >= %s AND created_at < %s
+            GROUP BY year, month
+            UNION ALL
+            SELECT YEAR(created_at), MONTH(created_at), 0, 0, SUM(total)
+            FROM orders
+            WHERE customer_id = %s AND payment_method = 'balance' AND deleted_at IS NULL AND created_at >= %s AND created_at < %s
+            GROUP BY 1, 2
+        """, (balance["customer_id"], balance["id"], start, end, balance["customer_id"], start, end))
+
+        # A month has one transactions row and one orders row; they add up
+        movements = {}
+        for row in self.cursor.fetchall():
+            month = date(row["year"], row["month"], 1)
+            movements[month] = tuple(map(sum, zip(movements.get(month, NO_MOVEMENT), movement(row))))
+
+        return movements
+
+    #Cached statements from the changed month on no longer add up
+    def invalidate_statements(self, customer_id: int, changed_at: datetime):
+        self.cursor.execute("DELETE FROM balance_statements WHERE customer_id = %s AND period >= %s", (
+            customer_id, month_start(changed_at.date())
+        ))
+
+    #BULK
+    def bulk_update_items(self, updates: list, updated_by: int) -> list:
+        ids = sorted({update["id"] for update in updates})
+        placeholders = ", ".join(["%s"] * len(ids))
+
+        # Lock every touched row up front, in id order, so concurrent bulk updates cannot deadlock
+        self.cursor.execute(f"SELECT id, quantity FROM items WHERE id IN ({placeholders}) AND deleted_at IS NULL ORDER BY id FOR UPDATE", tuple(ids))
+        quantities = {row["id"]: row["quantity"] for row in self.cursor.fetchall()}
+
+        results = []
+        merged = {}
+        for update in updates:
+            item_id = update["id"]
+            if item_id not in quantities:
+                results.append({"id": item_id, "status": "not_found", "detail": f"Item with id {item_id} was not found"})
+                continue
+
+            values = {column: update[column] for column in BULK_ITEM_COLUMNS if update.get(column) is not None}
+
+            if update.get("quantity_delta") is not None:
+                if "quantity" in values:
+                    results.append({"id": item_id, "status": "invalid", "detail": "Send either quantity or quantity_delta"})
+                    continue
+                values["quantity"] = quantities[item_id] + update["quantity_delta"]
+
+            if not values:
+                results.append({"id": item_id, "status": "invalid", "detail": "No data was found for the update"})
+                continue
+            if values.get("quantity", 0) < 0:
+                results.append({"id": item_id, "status": "invalid", "detail": "Quantity cannot go below zero"})
+                continue
+            if any(values.get(column, 0) < 0 for column in ("orig_price", "selling_price")):
+                results.append({"id": item_id, "status": "invalid", "detail": "Prices cannot be negative"})
+                continue
+
+            # Later rows for the same item build on the earlier ones and are merged into one final
+            # update per item, so the result does not depend on how the statements are grouped
+            quantities[item_id] = values.get("quantity", quantities[item_id])
+            merged.setdefault(item_id, {}).update(values)
+            results.append({"id": item_id, "status": "updated", "quantity": quantities[item_id]})
+
+        # Items setting the same columns share one executemany statement
+        statements = {}
+        for item_id, values in merged.items():
+            columns = tuple(sorted(values))
+            statements.setdefault(columns, []).append(tuple(values[column] for column in columns) + (updated_by, item_id))
+
+        for columns, rows in statements.items():
+            set_clause = ", ".join(f"{column} = %s" for column in columns)
+            self.cursor.executemany(
+                f"UPDATE items SET {set_clause}, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND deleted_at IS NULL",
+                rows
+            )
+            self.cursor.executemany(CHANGE_LOG_INSERT, [
+                change_values("items", "update", row[-1], dict(zip(columns, row)), updated_by) for row in rows
+            ])
+
+        return results
+
+    #Upsert by name: existing (not deleted) items are updated, the rest inserted. Returns (inserted, updated).
+    def upsert_items(self, items: dict, updated_by: int) -> tuple:
+        names = tuple(items.keys())
+        placeholders = ", ".join(["%s"] * len(names))
+
+        self.cursor.execute(f"SELECT id, name FROM items WHERE name IN ({placeholders}) AND deleted_at IS NULL FOR UPDATE", names)
+        existing = {row["name"]: row["id"] for row in self.cursor.fetchall()}
+
+        updates = [
+            (item.quantity, item.orig_price, item.selling_price, updated_by, existing[name])
+            for name, item in items.items() if name in existing
+        ]
+        inserts = [
+            (item.name, item.quantity, item.orig_price, item.selling_price)
+            for name, item in items.items() if name not in existing
+        ]
+
+        if updates:
+            self.cursor.executemany(
+                "UPDATE items SET quantity = %s, orig_price = %s, selling_price = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                updates
+            )
+        if inserts:
+            # executemany turns this into one multi-row INSERT
+            self.cursor.executemany("INSERT INTO items (name, quantity, orig_price, selling_price) VALUES (%s, %s, %s, %s)", inserts)
+            self.cursor.execute(f"SELECT id, name FROM items WHERE name IN ({placeholders}) AND deleted_at IS NULL", names)
+            ids = {row["name"]: row["id"] for row in self.cursor.fetchall()}
+        else:
+            ids = existing
+
+        self.cursor.executemany(CHANGE_LOG_INSERT, [
+            change_values("items", "update" if name in existing else "insert", ids.get(name), item.dict(), updated_by)
+            for name, item in items.items()
+        ])
+
+        return len(inserts), len(updates)
+
     #POST/CREATE REQUEST
-    def created_request(self, table: str):
-        self.cursor.execute(f"SELECT * FROM {table} WHERE id = LAST_INSERT_ID()")
-        return self.cursor.fetchone()
+    def created_request(self, table: str, table_id: int = None):
+        # Prefer the id captured from cursor.lastrowid: LAST_INSERT_ID() moves with every later insert (e.g. change_log)
+        if table_id:
+            created = self.fetch_one(f"SELECT * FROM {table} WHERE id = %s", (table_id,))
+            remember(table, created)
+            return created
+        else:
+            self.cursor.execute(f"SELECT * FROM {table} WHERE id = LAST_INSERT_ID()")
+            return self.cursor.fetchone()
     
     #PUT REQUEST
-    def update_balance_total(self, balance_id: int, customer_id: int, new_total: float, updated_by: int):
+    def update_balance_total(self, balance_id: int, customer_id: int, new_total: Decimal, updated_by: int, commit: bool = True):
         self.cursor.execute("""
             UPDATE balances SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP 
             WHERE id = %s AND customer_id = %s AND deleted_at IS NULL
         """, (new_total, updated_by, balance_id, customer_id))
-        self.conn.commit()
+        self.record_change("balances", "update", balance_id, {"total": new_total}, updated_by)
+        # Inside run_in_transaction the unit of work commits
+        if commit:
+            self.conn.commit()
 
     #Transaction balance
-    def adjust_balance_total(self, existing_balance: dict, existing_transaction: dict, values: dict) -> float:
-        # Get new type and amount from values or fallback to existing ones
+    def adjust_balance_total(self, existing_balance: dict, existing_transaction: dict, values: dict) -> Decimal:
+        # Get new type and amount from values or fallback to existing ones (both Decimal)
         new_type = values.get("type", existing_transaction["type"])
-        new_amount = Decimal(str(values.get("amount", existing_transaction["amount"])))
+        new_amount = values.get("amount", existing_transaction["amount"])
 
 
         # Undo the original transaction
@@ -138,6 +582,9 @@ class Queries:
         )
         else:    
             self.cursor.execute(f"DELETE FROM {table} WHERE id = %s", (table_id,))
+
+        if self.cursor.rowcount:
+            self.record_change(table, "delete", table_id)
     
     def soft_delete(self, table: str, user_id: int, table_id: int, customer_id: int = None, balance_id: int = None, order_id: int = None):
         if customer_id and balance_id:
@@ -157,4 +604,215 @@ class Queries:
         else:
             self.cursor.execute(f"UPDATE {table} SET deleted_at = CURRENT_TIMESTAMP, deleted_by = %s WHERE id = %s AND deleted_at IS NULL", (user_id, table_id))
 
+        if self.cursor.rowcount:
+            self.record_change(table, "soft_delete", table_id, changed_by=user_id)
+
+    #Sharded: the shard has no foreign key to customers, so what ON DELETE CASCADE removed on a
+    #single database is deleted here (order items and transactions go with their orders/balances)
+    def cascade_customer(self, customer_id: int):
+        if not sharding_enabled():
+            return
+
+        for table in ("orders", "balances"):
+            self.cursor.execute(f"DELETE FROM {table} WHERE customer_id = %s", (customer_id,))
+            if self.cursor.rowcount:
+                self.record_change(table, "delete", data={"customer_id": customer_id})
+        self.cursor.execute("DELETE FROM balance_statements WHERE customer_id = %s", (customer_id,))
+
+    #Sharded, order items have no foreign key to items on the shards; run on each shard with across_shards
+    def cascade_item(self, item_id: int):
+        self.cursor.execute("DELETE FROM order_items WHERE item_id = %s", (item_id,))
+        if self.cursor.rowcount:
+            self.record_change("order_items", "delete", data={"item_id": item_id})
+        self.conn.commit()
+
+    #Transactions have no foreign keys once partitioned (see Database.maintain_transaction_partitions)
+    def cascade_transactions(self, customer_id: int = None, balance_id: int = None):
+        if customer_id:
+            self.cursor.execute("DELETE FROM transactions WHERE customer_id = %s", (customer_id,))
+            scope = {"customer_id": customer_id}
+        elif balance_id:
+            self.cursor.execute("DELETE FROM transactions WHERE balance_id = %s", (balance_id,))
+            scope = {"balance_id": balance_id}
+        else:
+            return
+
+        # One entry for the whole cascade; row_id stays NULL and data says which rows went
+        if self.cursor.rowcount:
+            self.record_change("transactions", "delete", data=scope)
+
+    #CHANGE FEED
+    # Written on the same cursor as the change itself, so it commits or rolls back with it
+    def record_change(self, table: str, operation: str, row_id: int = None, data: dict = None, changed_by: int = None):
+        if table in CHANGE_FEED_TABLES:
+            self.cursor.execute(CHANGE_LOG_INSERT, change_values(table, operation, row_id, data, changed_by))
+
+        # Every write records a change, which keeps the identity map in step with it
+        if operation == "update":
+            merge(table, row_id, data, changed_by)
+        elif operation != "insert":
+            forget(table, row_id)
+
+    #For writes handed to the background write queue: the write and its change entry are one unit,
+    #so they commit in the same batch
+    def queue_write(self, sql: str, values: tuple, table: str, operation: str, row_id: int = None, data: dict = None, changed_by: int = None) -> bool:
+        statements = [(sql, values)]
+        if table in CHANGE_FEED_TABLES:
+            statements.append((CHANGE_LOG_INSERT, change_values(table, operation, row_id, data, changed_by)))
+        return write_queue.submit(*statements)
+
+    def get_changes(self, after: int, limit: int, table: str = None):
+        if table:
+            self.cursor.execute("SELECT * FROM change_log WHERE seq > %s AND table_name = %s ORDER BY seq LIMIT %s", (after, table, limit))
+        else:
+            self.cursor.execute("SELECT * FROM change_log WHERE seq > %s ORDER BY seq LIMIT %s", (after, limit))
+
+        changes = self.cursor.fetchall()
+        for change in changes:
+            change["data"] = json.loads(change["data"]) if change["data"] else None
+        return changes
+
+    #BEST SELLERS
+    def get_items_sold(self, since: date) -> list:
+        self.cursor.execute("""
+            SELECT oi.item_id, SUM(oi.quantity) AS sold FROM order_items oi
+            JOIN orders o ON o.id = oi.order_id
+            WHERE oi.created_at >= %s AND oi.deleted_at IS NULL AND o.deleted_at IS NULL
+            GROUP BY oi.item_id
+        """, (since,))
+        return self.cursor.fetchall()
+
+    #SYNC
+    # Operations a terminal already sent, by client_id; resending one is reported, not applied again
+    def get_sync_operations(self, client_ids: list) -> dict:
+        if not client_ids:
+            return {}
+
+        placeholders = ", ".join(["%s"] * len(client_ids))
+        self.cursor.execute(f"SELECT * FROM sync_operations WHERE client_id IN ({placeholders})", tuple(client_ids))
+        return {row["client_id"]: row for row in self.cursor.fetchall()}
+
+    def record_sync_operations(self, rows: list):
+        if rows:
+            self.cursor.executemany(SYNC_OPERATION_INSERT, rows)
+
+
+#Runs each call(query) on its own pooled connection, concurrently; results come back in call order.
+#The executor is no bigger than the pool, so it never waits on (or exhausts) connections.
+query_executor = ThreadPoolExecutor(max_workers=settings.database_pool_size, thread_name_prefix="queries")
+
+def parallel_queries(*calls) -> list:
+    def run(call):
+        db = Database(pooled=True)
+        try:
+            return call(Queries(db))
+        finally:
+            db.close()
+
+    # Each call runs in a copy of the request context (route class -> statement time limits)
+    futures = [query_executor.submit(copy_context().run, run, call) for call in calls]
+    return [future.result() for future in futures]
+
+#Runs call(query, shard) on every shard (or the given ones), concurrently; results come back in shard order
+def across_shards(call, shards=None) -> list:
+    def pinned(shard):
+        def run(query):
+            with use_shard(shard):
+                return call(query, shard)
+        return run
+
+    shards = range(shard_count()) if shards is None else shards
+    return parallel_queries(*(pinned(shard) for shard in shards))
+
+#Units sold per item since a day (midnight), summed over every shard when sharded
+def items_sold_since(since: date) -> dict:
+    if sharding_enabled():
+        results = across_shards(lambda query, shard: query.get_items_sold(since))
+    else:
+        results = parallel_queries(lambda query: query.get_items_sold(since))
+
+    sold = {}
+    for rows in results:
+        for row in rows:
+            sold[row["item_id"]] = sold.get(row["item_id"], 0) + int(row["sold"])
+    return {item_id: count for item_id, count in sold.items() if count > 0}
+
+#Every customer's orders with their items, the first limit in sort order. Sharded, each shard
+#returns its own first limit (items attached on that shard) and the pages are merged here.
+def recent_orders(created_from: datetime = None, created_to: datetime = None, payment_method: str = None, min_total: Decimal = None,
+                  max_total: Decimal = None, sort: str = "created_at", direction: str = "desc", limit: int = 50) -> list:
+    def page(query, shard=None):
+        return query.attach_order_items(query.get_orders(
+            created_from=created_from, created_to=created_to, payment_method=payment_method,
+            min_total=min_total, max_total=max_total, sort=sort, direction=direction, limit=limit
+        ))
+
+    if not sharding_enabled():
+        return parallel_queries(page)[0]
+
+    orders = [order for orders in across_shards(page) for order in orders]
+    column = sort if sort in SORTABLE_COLUMNS["orders"] else SORTABLE_COLUMNS["orders"][0]
+    orders.sort(key=lambda order: (order[column], order["id"]), reverse=direction != "asc")
+    return orders[:limit]
+
+#Each customer's first balance, read from every shard that holds one of the customers
+def customer_balances(customer_ids: list) -> dict:
+    by_shard = {}
+    for customer_id in customer_ids:
+        by_shard.setdefault(shard_for(customer_id), []).append(customer_id)
+
+    balances = {}
+    for rows in across_shards(lambda query, shard: query.get_balances_for(by_shard[shard]), sorted(by_shard)):
+        for row in rows:
+            balances.setdefault(row["customer_id"], row)
+    return balances
+
+NO_MOVEMENT = (ZERO, ZERO, ZERO)
+
+def movement(row: dict) -> tuple:
+    return as_money(row["deposits"]), as_money(row["withdrawals"]), as_money(row["balance_orders"])
+
+#The only columns the bulk item endpoint may write (quantity_delta becomes quantity)
+BULK_ITEM_COLUMNS = ("quantity", "orig_price", "selling_price")
+
+CHANGE_FEED_TABLES = ("customers", "balances", "transactions", "orders", "order_items", "items")
+
+CHANGE_LOG_INSERT = "INSERT INTO change_log (table_name, row_id, operation, data, changed_by) VALUES (%s, %s, %s, %s, %s)"
+
+def change_values(table: str, operation: str, row_id: int = None, data: dict = None, changed_by: int = None) -> tuple:
+    if data is not None:
+        data = json.dumps({key: value for key, value in data.items() if key != "password"}, default=json_default)
+
+    return (table, row_id, operation, data, changed_by)
+
+SYNC_OPERATION_INSERT = "INSERT INTO sync_operations (client_id, kind, status, row_id, detail, client_created_at, synced_by) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+
+ORDER_ITEM_COLUMNS = ("id", "order_id", "item_id", "quantity", "unit_price", "subtotal", "created_at", "updated_at", "deleted_at", "updated_by", "deleted_by")
+
+#Columns the list endpoints may sort by; anything else falls back to the first one
+SORTABLE_COLUMNS = {
+    "transactions": ("created_at", "amount", "id"),
+    "orders": ("created_at", "total", "id"),
+}
+
+def order_by(table: str, sort: str, direction: str) -> str:
+    column = sort if sort in SORTABLE_COLUMNS[table] else SORTABLE_COLUMNS[table][0]
+    direction = "ASC" if direction == "asc" else "DESC"
+
+    # id breaks ties so pages are stable
+    if column == "id":
+        return f" ORDER BY id {direction}"
+    return f" ORDER BY {column} {direction}, id {direction}"
+
+#Appends the (clause, value) pairs whose value was given, keeping every value parameterized
+def add_conditions(sql: str, values: tuple, conditions: tuple):
+    for clause, value in conditions:
+        if value is not None:
+            sql += f" AND {clause}"
+            values += (value,)
+
+    return sql, values
 
+#Escape LIKE wildcards so the prefix is matched literally and can use a range scan on the index
+def like_prefix(search: str) -> str:
+    return re.sub(r"([\\%_])", r"\\\1", search) + "%"
@@ -1,6 +1,7 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional, Literal
-from datetime import datetime
+from typing import Optional, Literal, List, Any
+from datetime import datetime, date
+from .money import MoneyOut
  
 #Customer's Responses
 class CustomerResponse(BaseModel):
@@ -13,19 +14,33 @@ class CustomerResponse(BaseModel):
 class BalanceResponse(BaseModel):
     id: int
     customer_id: int
-    total: float
+    total: MoneyOut
     created_at: datetime
 
 class CustomerBalanceResponse(BaseModel):
     customer: CustomerResponse
     balance: BalanceResponse
 
+class StatementPeriodResponse(BaseModel):
+    period: date
+    opening_balance: MoneyOut
+    deposits: MoneyOut
+    withdrawals: MoneyOut
+    balance_orders: MoneyOut
+    adjustments: MoneyOut       # direct edits of the balance total, not explained by the movements
+    closing_balance: MoneyOut
+
+class BalanceStatementResponse(BaseModel):
+    balance_id: int
+    customer_id: int
+    periods: List[StatementPeriodResponse]
+
 class TransactionResponse(BaseModel):
     id: int
     customer_id: int
     balance_id: int
     type: Literal["withdraw", "deposit"]
-    amount: int
+    amount: MoneyOut
     created_at: datetime
 
 #TRANSACTIONS POST
@@ -39,7 +54,7 @@ class OrderResponse(BaseModel):
     customer_id: int
     payment_method: Literal["cash", "balance"]
     note: str
-    total: float
+    total: MoneyOut
     store_notes: Optional[str] = None
     created_at: datetime
 
@@ -47,15 +62,38 @@ class ItemResponse(BaseModel):
     id: int
     name: str
     quantity: int
-    selling_price: float
+    selling_price: MoneyOut
+
+class ItemBulkResult(BaseModel):
+    id: int
+    status: Literal["updated", "not_found", "invalid"]
+    detail: Optional[str] = None
+    quantity: Optional[int] = None
+
+class ItemImportError(BaseModel):
+    row: int
+    detail: str
+
+class ItemImportSummary(BaseModel):
+    inserted: int
+    updated: int
+    failed: int
+    errors: List[ItemImportError]
 
 class OrderItemResponse(BaseModel):
     id: int
     order_id: int
     item_id: int
     quantity: int
-    unit_price: float
-    subtotal: float
+    unit_price: MoneyOut
+    subtotal: MoneyOut
+
+class OrderItemDetailResponse(OrderItemResponse):
+    item_name: Optional[str] = None
+    item_selling_price: Optional[MoneyOut] = None
+
+class OrderDetailResponse(OrderResponse):
+    order_items: List[OrderItemDetailResponse] = []
 
 
 #Admin's Responses
@@ -65,6 +103,10 @@ class CustomerAdminResponse(CustomerResponse):
     updated_by: Optional[str] = None
     deleted_by: Optional[str] = None
 
+class CustomerSearchResponse(CustomerAdminResponse):
+    balance_id: Optional[int] = None
+    balance_total: Optional[MoneyOut] = None
+
 class BalanceAdminResponse(BalanceResponse):
     updated_at: Optional[datetime] = None
     deleted_at: Optional[datetime] = None
@@ -96,11 +138,11 @@ class ItemAdminResponse(BaseModel):
     name: str
     quantity: int
     sold: int
-    orig_price: float
-    total_orig_price: float
-    selling_price: float
-    total_selling_price: float
-    profit: float
+    orig_price: MoneyOut
+    total_orig_price: MoneyOut
+    selling_price: MoneyOut
+    total_selling_price: MoneyOut
+    profit: MoneyOut
     created_at: datetime
     updated_at: Optional[datetime] = None
     deleted_at: Optional[datetime] = None
@@ -113,3 +155,65 @@ class OrderItemAdminResponse(OrderItemResponse):
     deleted_at: Optional[datetime] = None
     updated_by: Optional[str] = None
     deleted_by: Optional[str] = None
+
+class OrderItemDetailAdminResponse(OrderItemAdminResponse):
+    item_name: Optional[str] = None
+    item_selling_price: Optional[MoneyOut] = None
+
+class OrderDetailAdminResponse(OrderAdminResponse):
+    order_items: List[OrderItemDetailAdminResponse] = []
+
+#Dashboard
+class DashboardResponse(BaseModel):
+    customer: CustomerResponse
+    balance: Optional[BalanceResponse] = None
+    transactions: List[TransactionResponse]
+    orders: List[OrderResponse]
+
+class DashboardAdminResponse(BaseModel):
+    customer: CustomerAdminResponse
+    balance: Optional[BalanceAdminResponse] = None
+    transactions: List[TransactionAdminResponse]
+    orders: List[OrderAdminResponse]
+
+#Change feed
+class ChangeResponse(BaseModel):
+    seq: int
+    table_name: str
+    row_id: Optional[int] = None
+    operation: Literal["insert", "update", "soft_delete", "delete"]
+    data: Optional[dict[str, Any]] = None
+    changed_by: Optional[str] = None
+    created_at: datetime
+    shard: Optional[int] = None     # sharded: the feed the change came from (None: home)
+
+class ChangeFeedResponse(BaseModel):
+    changes: List[ChangeResponse]
+    last_seq: int
+    cursor: Optional[str] = None    # sharded: send back as cursor for the next page
+
+#Best sellers
+class BestSellerResponse(BaseModel):
+    item_id: int
+    item_name: Optional[str] = None
+    item_selling_price: Optional[MoneyOut] = None
+    sold: int
+
+class LeaderboardResponse(BaseModel):
+    period: Literal["today", "week"]
+    since: date
+    items: List[BestSellerResponse]
+
+#Sync
+class SyncOperationResult(BaseModel):
+    client_id: str
+    kind: Literal["order", "order_item", "transaction"]
+    status: Literal["applied", "duplicate", "conflict"]
+    row_id: Optional[int] = None
+    detail: Optional[str] = None
+
+class SyncBatchResponse(BaseModel):
+    applied: int
+    duplicates: int
+    conflicts: int
+    results: List[SyncOperationResult]
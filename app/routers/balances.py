@@ -1,15 +1,18 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Query
 from ..body import Balance, TokenData
 from ..queries import Queries
 from ..status_codes import Validator
-from ..response import BalanceAdminResponse, BalanceResponse
+from ..response import BalanceAdminResponse, BalanceResponse, BalanceStatementResponse
 from ..oauth2 import get_current_user
 from ..database import Database
+from ..profiling import ProfiledRoute
+from ..events import broker
 from typing import List, Union
 
 router = APIRouter(
     prefix="/customers/{customer_id}/balances",
-    tags=["Balances"]
+    tags=["Balances"],
+    route_class=ProfiledRoute
 )
 
 db = Database()
@@ -25,11 +28,30 @@ def get_balance(customer_id: int, current_user: TokenData = Depends(get_current_
     existing_customer = query.get_request("customers", customer_id)
     validate.customer_exists(existing_customer, customer_id)
 
-    existing_balance = query.get_request("balances", customer_id)
+    existing_balance = query.get_customer_balance(customer_id)
     validate.balance_exists(existing_balance, customer_id)
 
     return query.response(current_user, existing_balance, BalanceResponse, BalanceAdminResponse)
 
+@router.get("/{balance_id}/statement", response_model=BalanceStatementResponse)
+def get_statement(customer_id: int, balance_id: int, months: int = Query(12, ge=1, le=36), current_user: TokenData = Depends(get_current_user)):
+    validate.required_roles(current_user.role, ["admin","user"])
+    if current_user.role == "user":
+        validate.logged_in_user(current_user.id, customer_id)
+
+    existing_customer = query.get_request("customers", customer_id)
+    validate.customer_exists(existing_customer, customer_id)
+
+    existing_balance = query.get_request("balances", balance_id)
+    validate.balance_exists(existing_balance, balance_id)
+    validate.balance_owner(existing_balance, customer_id)
+
+    return {
+        "balance_id": balance_id,
+        "customer_id": customer_id,
+        "periods": query.balance_statement(existing_balance, months)
+    }
+
 @router.put("/", response_model=BalanceAdminResponse)
 def put_balance(customer_id: int, balance: Balance, current_user: TokenData = Depends(get_current_user)):
     try:
@@ -38,19 +60,20 @@ def put_balance(customer_id: int, balance: Balance, current_user: TokenData = De
         existing_customer = query.get_request("customers", customer_id)
         validate.customer_exists(existing_customer, customer_id)
 
-        existing_balance = query.get_request("balances", customer_id)
-        print(existing_balance)
+        existing_balance = query.get_customer_balance(customer_id)
         validate.balance_exists(existing_balance, customer_id)
 
         db.cursor.execute("UPDATE balances SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND deleted_at IS NULL", (
             balance.total,
             current_user.id,
-            customer_id,
+            existing_balance["id"],
             )
         )
+        query.record_change("balances", "update", existing_balance["id"], {"total": balance.total}, current_user.id)
         db.conn.commit()
 
-        updated_balance = query.get_request("balances", customer_id)
+        updated_balance = query.get_request("balances", existing_balance["id"])
+        broker.publish(customer_id, "balance", updated_balance)
 
         return BalanceAdminResponse(**updated_balance)
 
@@ -70,10 +93,11 @@ def hard_delete(customer_id: int, current_user: TokenData = Depends(get_current_
         existing_customer = query.get_request("customers", customer_id)
         validate.customer_exists(existing_customer, customer_id)
 
-        existing_balance = query.get_request("balances", customer_id)
+        existing_balance = query.get_customer_balance(customer_id)
         validate.balance_exists(existing_balance, customer_id)
 
-        query.hard_delete("balances", customer_id)
+        query.cascade_transactions(balance_id=existing_balance["id"])
+        query.hard_delete("balances", existing_balance["id"])
         db.conn.commit()
 
         return
@@ -96,13 +120,13 @@ def soft_delete(customer_id: int, current_user: TokenData = Depends(get_current_
         existing_customer = query.get_request("customers", customer_id)
         validate.customer_exists(existing_customer, customer_id)
 
-        existing_balance = query.get_request("balances", customer_id)
+        existing_balance = query.get_customer_balance(customer_id)
         validate.balance_exists(existing_balance, customer_id)
         
-        query.soft_delete("balances", current_user.id, customer_id)
+        query.soft_delete("balances", current_user.id, existing_balance["id"])
         db.conn.commit()
 
-        return {"detail": f"Balances with id {customer_id} softly deleted"}
+        return {"detail": f"Balances with id {existing_balance['id']} softly deleted"}
     
     except HTTPException:
         raise
@@ -0,0 +1,75 @@
+from fastapi import APIRouter, status, HTTPException, Depends, Query
+from ..body import TokenData
+from ..database import Database
+from ..queries import Queries, CHANGE_FEED_TABLES, across_shards
+from ..response import ChangeFeedResponse
+from ..status_codes import Validator
+from ..oauth2 import get_current_user
+from ..profiling import ProfiledRoute
+from ..sharding import sharding_enabled, shard_count
+from typing import Optional, Literal
+from itertools import islice
+import heapq
+
+router = APIRouter(
+    prefix="/changes",
+    tags=["Changes"],
+    route_class=ProfiledRoute
+)
+
+db = Database()
+validate = Validator()
+query = Queries(db)
+
+#Consumers keep last_seq and ask for the changes after it.
+#seq comes from AUTO_INCREMENT, so a write committing late can land behind a seq already read;
+#consumers that need every change should re-read a small window behind their cursor.
+#Sharded, the home database (customers, items) and every shard keep a feed of their own. They are
+#read in parallel and merged into one: consumers keep the returned cursor (one seq per feed,
+#home first) and send it back instead of after.
+@router.get("/", response_model=ChangeFeedResponse)
+def get_changes(
+    after: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=5000),
+    table: Optional[Literal[CHANGE_FEED_TABLES]] = None,
+    cursor: Optional[str] = Query(None, max_length=1000),
+    current_user: TokenData = Depends(get_current_user)
+):
+    validate.required_roles(current_user.role, ["admin"])
+
+    if sharding_enabled():
+        return merged_changes(after, limit, table, cursor)
+
+    changes = query.get_changes(after, limit, table)
+    db.conn.commit()    # end the read snapshot so the next poll sees new changes
+
+    return {
+        "changes": changes,
+        "last_seq": changes[-1]["seq"] if changes else after
+    }
+
+def merged_changes(after: int, limit: int, table: Optional[str], cursor: Optional[str]) -> dict:
+    feeds = [None, *range(shard_count())]
+    try:
+        positions = dict(zip(feeds, map(int, cursor.split(",")))) if cursor else {None: after}
+    except ValueError:
+        positions = None
+    if positions is None or (cursor and len(positions) != len(cursor.split(","))) or len(positions) > len(feeds):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"cursor takes {len(feeds)} comma-separated seqs")
+
+    # Each call runs on its own pooled connection, so every poll reads a fresh snapshot
+    results = across_shards(lambda pooled, feed: pooled.get_changes(positions.get(feed, 0), limit, table), feeds)
+    for feed, changes in zip(feeds, results):
+        for change in changes:
+            change["shard"] = feed
+
+    # heapq.merge keeps each feed in seq order, so what is returned is a prefix of every feed
+    changes = list(islice(heapq.merge(*results, key=lambda change: change["created_at"]), limit))
+    for change in changes:
+        positions[change["shard"]] = change["seq"]
+
+    return {
+        "changes": changes,
+        "last_seq": positions.get(None, 0),
+        "cursor": ",".join(str(positions.get(feed, 0)) for feed in feeds)
+    }
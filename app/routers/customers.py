@@ -1,16 +1,21 @@
-from fastapi import APIRouter, status, HTTPException, Depends
-from ..response import CustomerResponse, CustomerAdminResponse, CustomerBalanceResponse
+from fastapi import APIRouter, status, HTTPException, Depends, Query
+from ..response import CustomerResponse, CustomerAdminResponse, CustomerBalanceResponse, CustomerSearchResponse, DashboardResponse, DashboardAdminResponse, OrderDetailAdminResponse
 from ..body import Customer, TokenData, CustomerPatch
 from ..utils import hash
 from ..oauth2 import get_current_user
 from ..database import Database
-from ..queries import Queries
+from ..queries import Queries, parallel_queries, recent_orders
 from ..status_codes import Validator
-from typing import List, Union
+from ..profiling import ProfiledRoute
+from ..sharding import sharding_enabled, shard_for, use_shard
+from typing import List, Union, Optional, Literal
+from datetime import datetime
+from decimal import Decimal
 
 router = APIRouter(
     prefix="/customers",
-    tags=["Customers"]
+    tags=["Customers"],
+    route_class=ProfiledRoute
 )
 
 db = Database()
@@ -25,6 +30,42 @@ def get_customers(current_user: TokenData = Depends(get_current_user)):
 
     return query.response_list(current_user, customers, CustomerResponse, CustomerAdminResponse)
     
+@router.get("/search", response_model=List[CustomerSearchResponse])
+def search_customers(
+    email: Optional[str] = Query(None, min_length=1, max_length=64),
+    first_name: Optional[str] = Query(None, min_length=1, max_length=30),
+    last_name: Optional[str] = Query(None, min_length=1, max_length=30),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: TokenData = Depends(get_current_user)
+):
+    validate.required_roles(current_user.role, ["admin"])
+    if not (email or first_name or last_name):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Provide an email, first_name or last_name prefix")
+
+    customers = query.search_customers(email, first_name, last_name, limit, offset)
+
+    return [CustomerSearchResponse(**customer) for customer in customers]
+
+#Every customer's orders with their items (the ?expand=items shape), for the admin's order screen
+@router.get("/orders", response_model=List[OrderDetailAdminResponse])
+def get_all_orders(
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    payment_method: Optional[Literal["cash", "balance"]] = None,
+    min_total: Optional[Decimal] = Query(None, ge=0),
+    max_total: Optional[Decimal] = Query(None, ge=0),
+    sort: Literal["created_at", "total", "id"] = "created_at",
+    direction: Literal["asc", "desc"] = "desc",
+    limit: int = Query(50, ge=1, le=200),
+    current_user: TokenData = Depends(get_current_user)
+):
+    validate.required_roles(current_user.role, ["admin"])
+
+    orders = recent_orders(created_from, created_to, payment_method, min_total, max_total, sort, direction, limit)
+
+    return [OrderDetailAdminResponse(**order) for order in orders]
+
 @router.post("/", response_model=CustomerBalanceResponse, status_code=status.HTTP_201_CREATED)
 def create_customer(customer: Customer):
     try:
@@ -45,17 +86,22 @@ def create_customer(customer: Customer):
         )
 
         customer_id = db.cursor.lastrowid
-
-        db.cursor.execute("""INSERT INTO BALANCES (customer_id, total) 
-                        VALUES (%s, %s)""", (
-                        customer_id,
-                        0.00
+        query.record_change("customers", "insert", customer_id, {"email": customer.email, "first_name": customer.first_name, "last_name": customer.last_name, "role": "user"})
+
+        # The balance goes to the new customer's shard
+        with use_shard(shard_for(customer_id) if sharding_enabled() else None):
+            db.cursor.execute("""INSERT INTO BALANCES (customer_id, total) 
+                            VALUES (%s, %s)""", (
+                            customer_id,
+                            0.00
+                )
             )
-        )
-        db.conn.commit()
+            balance_id = db.cursor.lastrowid
+            query.record_change("balances", "insert", balance_id, {"customer_id": customer_id, "total": 0.00})
+            db.conn.commit()
 
-        created_customer = query.created_request("customers")
-        created_balance = query.created_request("balances")
+            created_customer = query.created_request("customers", customer_id)
+            created_balance = query.created_request("balances", balance_id)
 
         return {
             "customer": created_customer,
@@ -81,6 +127,30 @@ def get_customer(customer_id: int, current_user: TokenData = Depends(get_current
 
     return query.response(current_user, customer, CustomerResponse, CustomerAdminResponse)
 
+@router.get("/{customer_id}/dashboard", response_model=Union[DashboardResponse, DashboardAdminResponse])
+def get_dashboard(customer_id: int, limit: int = Query(10, ge=1, le=50), current_user: TokenData = Depends(get_current_user)):
+    validate.required_roles(current_user.role, ["admin", "user"])
+    if current_user.role == "user":
+        validate.logged_in_user(current_user.id, customer_id)
+
+    # Independent lookups, each on its own pooled connection
+    customer, balance, transactions, orders = parallel_queries(
+        lambda pooled: pooled.get_request("customers", customer_id),
+        lambda pooled: pooled.get_customer_balance(customer_id),
+        lambda pooled: pooled.get_transactions(customer_id=customer_id, limit=limit),
+        lambda pooled: pooled.get_orders(customer_id=customer_id, limit=limit),
+    )
+    validate.customer_exists(customer, customer_id)
+
+    dashboard = {
+        "customer": customer,
+        "balance": balance,
+        "transactions": transactions,
+        "orders": orders
+    }
+
+    return query.response(current_user, dashboard, DashboardResponse, DashboardAdminResponse)
+
 @router.put("/{customer_id}", response_model=Union[CustomerResponse, CustomerAdminResponse])
 def put_customer(customer_id: int, customer: Customer, current_user: TokenData = Depends(get_current_user)):
     try:
@@ -101,6 +171,7 @@ def put_customer(customer_id: int, customer: Customer, current_user: TokenData =
                 customer_id
             )
         )
+        query.record_change("customers", "update", customer_id, {"email": customer.email, "password": customer.password, "first_name": customer.first_name, "last_name": customer.last_name}, current_user.id)
         db.conn.commit()
 
         updated_customer = query.get_request("customers", customer_id)
@@ -154,6 +225,8 @@ def hard_delete(customer_id: int, current_user: TokenData = Depends(get_current_
         existing_customer = query.get_request("customers", customer_id)
         validate.customer_exists(existing_customer, customer_id)
 
+        query.cascade_transactions(customer_id=customer_id)
+        query.cascade_customer(customer_id)
         query.hard_delete("customers", customer_id)
         db.conn.commit()
 
@@ -178,7 +251,9 @@ def soft_delete(customer_id: int, current_user: TokenData = Depends(get_current_
         validate.customer_exists(existing_customer, customer_id)
 
         query.soft_delete("customers", current_user.id, customer_id)
-        query.soft_delete("balances", current_user.id, customer_id)
+        existing_balance = query.get_customer_balance(customer_id)
+        if existing_balance:
+            query.soft_delete("balances", current_user.id, existing_balance["id"])
         db.conn.commit()
 
         return {"detail": f"Customer with id {customer_id} and related resources softly deleted"}
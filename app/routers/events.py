@@ -0,0 +1,40 @@
+import asyncio
+from fastapi import APIRouter, Depends
+from fastapi.responses import StreamingResponse
+from ..body import TokenData
+from ..events import broker
+from ..config import settings
+from ..status_codes import Validator
+from ..oauth2 import get_current_user
+
+router = APIRouter(
+    prefix="/customers/{customer_id}/events",
+    tags=["Events"]
+)
+
+validate = Validator()
+
+@router.get("/")
+async def stream_events(customer_id: int, current_user: TokenData = Depends(get_current_user)):
+    validate.required_roles(current_user.role, ["admin", "user"])
+    if current_user.role == "user":
+        validate.logged_in_user(current_user.id, customer_id)
+
+    queue = broker.subscribe(customer_id)
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=settings.events_heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+        finally:
+            broker.unsubscribe(customer_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -1,29 +1,42 @@
 from functools import total_ordering
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Query, Request, UploadFile, File
+from pydantic import ValidationError
 from ..oauth2 import get_current_user
-from ..body import Item, ItemPatch, TokenData
+from ..body import Item, ItemPatch, ItemBulkUpdate, TokenData
 from ..database import Database
-from ..queries import Queries
-from ..response import ItemAdminResponse, ItemResponse
+from ..queries import Queries, across_shards
+from ..response import ItemAdminResponse, ItemResponse, ItemBulkResult, ItemImportSummary, LeaderboardResponse
 from ..status_codes import Validator
-from typing import List, Union
+from ..encoding import negotiated_response
+from ..profiling import ProfiledRoute
+from ..leaderboard import leaderboard
+from ..sharding import sharding_enabled
+from typing import List, Union, Literal, Optional
+from decimal import Decimal
+import csv
+import io
 
 router = APIRouter(
     prefix="/items",
-    tags=["Items"]
+    tags=["Items"],
+    route_class=ProfiledRoute
 )
 
 db = Database()
 validate = Validator()
 query = Queries(db)
 
+IMPORT_FIELDS = ("name", "quantity", "orig_price", "selling_price")
+IMPORT_BATCH_SIZE = 500
+IMPORT_MAX_ERRORS = 100
+
 @router.get("/", response_model=List[Union[ItemResponse, ItemAdminResponse]])
-def get_items(current_user: TokenData = Depends(get_current_user)):
+def get_items(request: Request, current_user: TokenData = Depends(get_current_user)):
     validate.required_roles(current_user.role, ["admin", "user"])
 
     items = query.get_request("items")
 
-    return query.response_list(current_user, items, ItemResponse, ItemAdminResponse)
+    return negotiated_response(request, query.response_list(current_user, items, ItemResponse, ItemAdminResponse))
 
  
 @router.post("/", response_model=ItemAdminResponse, status_code=status.HTTP_201_CREATED)
@@ -43,9 +56,11 @@ def create_customer(item: Item, current_user: TokenData = Depends(get_current_us
                 item.selling_price
             )
         )
+        item_id = db.cursor.lastrowid
+        query.record_change("items", "insert", item_id, item.dict(), current_user.id)
         db.conn.commit()
 
-        created_item = query.created_request("items")
+        created_item = query.created_request("items", item_id)
 
         return ItemAdminResponse(**created_item)
 
@@ -57,6 +72,132 @@ def create_customer(item: Item, current_user: TokenData = Depends(get_current_us
         db.conn.rollback()
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
     
+@router.get("/search", response_model=List[Union[ItemResponse, ItemAdminResponse]])
+def search_items(
+    request: Request,
+    q: str = Query(..., min_length=1, max_length=60),
+    mode: Literal["prefix", "fulltext"] = "prefix",
+    min_quantity: Optional[int] = Query(None, ge=0),
+    min_price: Optional[Decimal] = Query(None, ge=0),
+    max_price: Optional[Decimal] = Query(None, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    current_user: TokenData = Depends(get_current_user)
+):
+    validate.required_roles(current_user.role, ["admin", "user"])
+
+    items = query.search_items(q, mode, min_quantity, min_price, max_price, limit, offset)
+
+    return negotiated_response(request, query.response_list(current_user, items, ItemResponse, ItemAdminResponse))
+
+#Served from the in-memory leaderboard: the top entries plus one primary key lookup for their names
+@router.get("/best-sellers", response_model=LeaderboardResponse)
+def get_best_sellers(period: Literal["today", "week"] = "today", current_user: TokenData = Depends(get_current_user)):
+    validate.required_roles(current_user.role, ["admin", "user"])
+
+    top, since = leaderboard.top(period)
+    best_sellers = query.attach_item_details([{"item_id": item_id, "sold": sold} for item_id, sold in top])
+
+    return {
+        "period": period,
+        "since": since,
+        "items": best_sellers
+    }
+
+@router.patch("/bulk", response_model=List[ItemBulkResult])
+def bulk_update_items(items: List[ItemBulkUpdate], current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate.required_roles(current_user.role, ["admin"])
+
+        if not items:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No data was found for the update")
+        if len(items) > 1000:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="At most 1000 items per request")
+
+        results = query.bulk_update_items([item.dict() for item in items], current_user.id)
+        db.conn.commit()
+
+        return results
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        print(f"{e}")
+        db.conn.rollback()
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
+@router.post("/import", response_model=ItemImportSummary)
+def import_items(file: UploadFile = File(...), current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate.required_roles(current_user.role, ["admin"])
+
+        # Read row by row from the spooled upload; only one batch is held in memory at a time
+        reader = csv.DictReader(io.TextIOWrapper(file.file, encoding="utf-8-sig", newline=""))
+        summary = {"inserted": 0, "updated": 0, "failed": 0, "errors": []}
+        batch = {}
+
+        # Undecodable bytes or broken quoting: the batches already flushed stay committed, the open
+        # one (not written yet) is dropped, and the client learns how far the import got
+        def unreadable(e: Exception, last_line: int):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail={
+                "detail": f"Unreadable CSV after line {last_line}: {e}",
+                "last_line": last_line,
+                "committed": summary["inserted"] + summary["updated"],
+                "discarded": len(batch),
+                **summary
+            })
+
+        try:
+            fieldnames = reader.fieldnames
+        except (UnicodeDecodeError, csv.Error) as e:
+            unreadable(e, 0)
+
+        missing = set(IMPORT_FIELDS) - set(fieldnames or ())
+        if missing:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Missing CSV columns: {', '.join(sorted(missing))}")
+
+        def flush():
+            inserted, updated = query.upsert_items(batch, current_user.id)
+            db.conn.commit()
+            summary["inserted"] += inserted
+            summary["updated"] += updated
+            batch.clear()
+
+        try:
+            for row_number, row in enumerate(reader, start=2):
+                try:
+                    item = Item(**{field: (row[field] or "").strip() or None for field in IMPORT_FIELDS})
+                except ValidationError as e:
+                    summary["failed"] += 1
+                    if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+                        error = e.errors()[0]
+                        summary["errors"].append({"row": row_number, "detail": f"{'.'.join(map(str, error['loc']))}: {error['msg']}"})
+                    continue
+
+                # A name repeated within the batch keeps its last row
+                batch[item.name] = item
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush()
+        except UnicodeDecodeError as e:
+            # Decoding runs ahead in chunks, so the bad bytes are somewhere after the last line read
+            unreadable(e, reader.line_num)
+        except csv.Error as e:
+            unreadable(e, reader.line_num - 1)
+
+        if batch:
+            flush()
+
+        return summary
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        print(f"{e}")
+        db.conn.rollback()
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
+
 @router.get("/{item_id}", response_model=Union[ItemResponse, ItemAdminResponse])
 def get_customer(item_id: int, current_user: TokenData = Depends(get_current_user)):
     validate.required_roles(current_user.role, ["admin", "user"])
@@ -85,6 +226,7 @@ def put_customer(item_id: int, item: Item, current_user: TokenData = Depends(get
                 item_id
             )
         )
+        query.record_change("items", "update", item_id, item.dict(), current_user.id)
         db.conn.commit()
 
         updated_item = query.get_request("items", item_id)
@@ -133,8 +275,14 @@ def hard_delete(item_id: int, current_user: TokenData = Depends(get_current_user
         existing_item = query.get_request("items", item_id)
         validate.item_exists(existing_item, item_id)
 
+        # Shards first: an item left behind by a failure here can be deleted again, orphaned order items could not
+        if sharding_enabled():
+            across_shards(lambda pooled, shard: pooled.cascade_item(item_id))
+
         query.hard_delete("items", item_id)
-        db.conn.commit()
+        with leaderboard.recording():
+            db.conn.commit()
+            leaderboard.forget(item_id)
         return
 
     except HTTPException:
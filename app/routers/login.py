@@ -4,10 +4,12 @@ from ..body import LoggedInToken
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from ..utils import verify
 from ..oauth2 import create_token
+from ..profiling import ProfiledRoute
 
 router = APIRouter(
     prefix="/login",
-    tags=["Login"]
+    tags=["Login"],
+    route_class=ProfiledRoute
 )
 
 db = Database()
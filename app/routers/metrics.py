@@ -0,0 +1,20 @@
+from fastapi import APIRouter, Depends
+from ..body import TokenData
+from ..metrics import metrics
+from ..status_codes import Validator
+from ..oauth2 import get_current_user
+from ..profiling import ProfiledRoute
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["Metrics"],
+    route_class=ProfiledRoute
+)
+
+validate = Validator()
+
+@router.get("/")
+def get_metrics(current_user: TokenData = Depends(get_current_user)):
+    validate.required_roles(current_user.role, ["admin"])
+
+    return metrics.snapshot()
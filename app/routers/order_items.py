@@ -17,17 +17,75 @@ from ..database import Database
 from ..queries import Queries
 from ..status_codes import Validator
 from ..oauth2 import get_current_user
+from ..events import broker
+from ..unit_of_work import run_in_transaction
+from ..profiling import ProfiledRoute
+from ..leaderboard import leaderboard
 from typing import List, Union
 
 router = APIRouter(
     prefix="/customers/{customer_id}/orders/{order_id}/order_items",
-    tags=["Order Items"]
+    tags=["Order Items"],
+    route_class=ProfiledRoute
 )
 
 db = Database()
 validate = Validator()
 query = Queries(db)
 
+#PUT/PATCH: moves the line to new_item_id x new_quantity inside the caller's unit of work. The order
+#(and the balance, for balance orders) are already locked; both items are locked here, in id order.
+#The old item gets its stock back, the new one is decremented, and a line switched to another item
+#takes that item's current price; the order total and the balance move by the subtotal difference.
+def change_order_item(unit, customer_id: int, order: dict, balance: dict, previous: dict, new_item_id: int, new_quantity: int, updated_by: int) -> tuple:
+    old_item_id, old_quantity = previous["item_id"], previous["quantity"]
+    same_item = new_item_id == old_item_id
+
+    items = unit.lock("items", old_item_id, new_item_id)
+    new_item = items.get(new_item_id)
+    validate.item_exists(new_item, new_item_id)
+
+    available = new_item["quantity"] + (old_quantity if same_item else 0)
+    if new_quantity > available:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Ordered quantity exceeds available stock")
+
+    if same_item:
+        stock = {new_item_id: available - new_quantity}
+    else:
+        # A deleted old item is not locked and gets nothing back
+        stock = {new_item_id: new_item["quantity"] - new_quantity}
+        if old_item_id in items:
+            stock[old_item_id] = items[old_item_id]["quantity"] + old_quantity
+    for item_id, quantity in stock.items():
+        db.cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (quantity, item_id))
+        query.record_change("items", "update", item_id, {"quantity": quantity}, updated_by)
+
+    unit_price = previous["unit_price"] if same_item else new_item["selling_price"]
+    difference = new_quantity * unit_price - old_quantity * previous["unit_price"]
+
+    new_balance = None
+    if order["payment_method"] == "balance" and difference:
+        validate.balance_exists(balance, customer_id)
+        validate.balance_owner(balance, customer_id)
+        if balance["total"] < difference:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Customer balance not sufficient")
+        new_balance = balance["total"] - difference
+        db.cursor.execute("UPDATE balances SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (new_balance, updated_by, balance["id"]))
+        query.record_change("balances", "update", balance["id"], {"total": new_balance}, updated_by)
+
+    new_total = order["total"] + difference
+    db.cursor.execute("UPDATE orders SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (new_total, updated_by, order["id"]))
+    query.record_change("orders", "update", order["id"], {"total": new_total}, updated_by)
+
+    db.cursor.execute("""
+        UPDATE order_items SET item_id = %s, quantity = %s, unit_price = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s AND order_id = %s AND deleted_at IS NULL
+    """, (new_item_id, new_quantity, unit_price, updated_by, previous["id"], order["id"]))
+    query.record_change("order_items", "update", previous["id"], {"item_id": new_item_id, "quantity": new_quantity, "unit_price": unit_price}, updated_by)
+
+    query.invalidate_statements(customer_id, order["created_at"])
+    return new_total, new_balance
+
 @router.get("/", response_model=List[Union[OrderItemAdminResponse, OrderItemResponse]])
 def get_order_items(customer_id: int, order_id: int, current_user: TokenData = Depends(get_current_user)):
     validate.required_roles(current_user.role, ["admin", "user"])
@@ -54,45 +112,71 @@ def create_order_item(customer_id: int, order_id: int, order_item: OrderItem, cu
 
         existing_order = query.get_orders(order_id, customer_id)
         validate.order_exists(existing_order, order_id)
+        pays_from_balance = existing_order["payment_method"] == "balance"
+
+        # Locks balance -> order -> item (LOCK_ORDER); retried as a whole on deadlock
+        def create(unit):
+            balance = unit.lock_customer_balance(customer_id) if pays_from_balance else None
+            locked_order = unit.lock_one("orders", order_id)
+            validate.order_exists(locked_order, order_id)
+
+            existing_item = unit.lock_one("items", order_item.item_id)
+            validate.item_exists(existing_item, order_item.item_id)
+
+            if existing_item["quantity"] <= 0:
+                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Item out of stock")
+            if order_item.quantity > existing_item["quantity"]:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ordered quantity exceeds stock")
+
+            subtotal = order_item.quantity * existing_item["selling_price"]
+
+            new_balance = None
+            if pays_from_balance:
+                validate.balance_exists(balance, customer_id)
+                validate.balance_owner(balance, customer_id)
+                if balance["total"] < subtotal:
+                    # The client only needs the 422; the note is written by the background write queue
+                    store_notes = "Customer balance not sufficient"
+                    query.queue_write("UPDATE orders SET store_notes = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (
+                        store_notes, current_user.id, order_id
+                    ), "orders", "update", order_id, {"store_notes": store_notes}, current_user.id)
+                    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Customer balance not sufficient")
+                # Deduct balance
+                new_balance = balance["total"] - subtotal
+                db.cursor.execute("UPDATE balances SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (new_balance, current_user.id, balance["id"]))
+                query.record_change("balances", "update", balance["id"], {"total": new_balance}, current_user.id)
+
+            db.cursor.execute("""
+                INSERT INTO order_items (order_id, item_id, quantity, unit_price)
+                VALUES (%s, %s, %s, %s)
+            """, (order_id, order_item.item_id, order_item.quantity, existing_item["selling_price"]))
+            order_item_id = db.cursor.lastrowid
+            query.record_change("order_items", "insert", order_item_id, {"order_id": order_id, **order_item.dict(), "unit_price": existing_item["selling_price"]}, current_user.id)
+
+            # Decrease item stock
+            new_quantity = existing_item["quantity"] - order_item.quantity
+            db.cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (new_quantity, order_item.item_id))
+            query.record_change("items", "update", order_item.item_id, {"quantity": new_quantity}, current_user.id)
+
+            # Update order total
+            new_total = locked_order["total"] + subtotal
+            db.cursor.execute("UPDATE orders SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (new_total, current_user.id, order_id))
+            query.record_change("orders", "update", order_id, {"total": new_total}, current_user.id)
+
+            query.invalidate_statements(customer_id, locked_order["created_at"])
+
+            # Read before the commit: the sale is recorded with its created_at as it commits
+            created = query.created_request("order_items", order_item_id)
+            return created, new_total, balance, new_balance
+
+        created, new_total, balance, new_balance = run_in_transaction(db, create, commit=lambda result: leaderboard.commit(db, [
+            (order_item.item_id, order_item.quantity, result[0]["created_at"])
+        ]))
+
+        broker.publish(customer_id, "order", {"id": order_id, "total": new_total, "order_item": created})
+        if pays_from_balance:
+            broker.publish(customer_id, "balance", {"id": balance["id"], "customer_id": customer_id, "total": new_balance})
 
-        existing_item = query.get_request("items", order_item.item_id)
-        validate.item_exists(existing_item, order_item.item_id)
-
-        if existing_item["quantity"] <= 0:
-            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Item out of stock")
-        if order_item.quantity > existing_item["quantity"]:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ordered quantity exceeds stock")
-
-        subtotal = order_item.quantity * existing_item["selling_price"]
-
-        if existing_order["payment_method"] == "balance":
-            balance = query.get_request("balances", customer_id)
-            validate.balance_exists(balance, customer_id)
-            if balance["total"] < subtotal:
-                store_notes = "Customer balance not sufficient"
-                db.cursor.execute("UPDATE orders SET store_notes = %s WHERE id = %s", (store_notes, order_id))
-                db.conn.commit()
-                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Customer balance not sufficient")
-            # Deduct balance
-            new_balance = balance["total"] - subtotal
-            db.cursor.execute("UPDATE balances SET total = %s WHERE id = %s", (new_balance, balance["id"]))
-
-        db.cursor.execute("""
-            INSERT INTO order_items (order_id, item_id, quantity, unit_price)
-            VALUES (%s, %s, %s, %s)
-        """, (order_id, order_item.item_id, order_item.quantity, existing_item["selling_price"]))
-
-        # Decrease item stock
-        new_quantity = existing_item["quantity"] - order_item.quantity
-        db.cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (new_quantity, order_item.item_id))
-
-        # Update order total
-        new_total = existing_order["total"] + subtotal
-        db.cursor.execute("UPDATE orders SET total = %s WHERE id = %s", (new_total, order_id))
-
-        db.conn.commit()
-
-        created = query.created_request("order_items")
         return OrderItemAdminResponse(**created)
 
     except HTTPException:
@@ -131,26 +215,31 @@ def put_order_item(customer_id: int, order_id: int, order_item_id: int, order_it
         existing_order = query.get_orders(order_id, customer_id)
         validate.order_exists(existing_order, order_id)
 
-        existing_item = query.get_request("items", order_item.item_id)
-        validate.item_exists(existing_item, order_item.item_id)
+        pays_from_balance = existing_order["payment_method"] == "balance"
 
-        existing_order_item = query.get_order_items(order_item_id, order_id)
-        validate.order_item_exists(existing_order_item, order_item_id)
+        # Locks balance -> order -> order item -> both items (LOCK_ORDER); retried as a whole on deadlock
+        def put(unit):
+            balance = unit.lock_customer_balance(customer_id) if pays_from_balance else None
+            locked_order = unit.lock_one("orders", order_id)
+            validate.order_exists(locked_order, order_id)
+
+            existing_order_item = unit.lock_one("order_items", order_item_id)
+            if existing_order_item and existing_order_item["order_id"] != order_id:
+                existing_order_item = None
+            validate.order_item_exists(existing_order_item, order_item_id)
 
-        #Item quantity changes
-        restored_quantity = existing_item["quantity"] + existing_order_item["quantity"]
-        if order_item.quantity > restored_quantity:
-            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Ordered quantity exceeds available stock")
-        new_quantity = restored_quantity - order_item.quantity
-        db.cursor.execute("UPDATE items SET quantity = %s WHERE id = %s", (new_quantity, order_item.item_id))
+            new_total, new_balance = change_order_item(unit, customer_id, locked_order, balance, existing_order_item, order_item.item_id, order_item.quantity, current_user.id)
+            return existing_order_item, new_total, balance, new_balance
 
-        db.cursor.execute("""
-            UPDATE order_items SET item_id = %s, quantity = %s, updated_at = CURRENT_TIMESTAMP
-            WHERE id = %s AND order_id = %s AND deleted_at IS NULL
-        """, (order_item.item_id, order_item.quantity, order_item_id, order_id))
-        db.conn.commit()
+        previous, new_total, balance, new_balance = run_in_transaction(db, put, commit=lambda result: leaderboard.commit(db, [
+            (result[0]["item_id"], -result[0]["quantity"], result[0]["created_at"]),
+            (order_item.item_id, order_item.quantity, result[0]["created_at"]),
+        ]))
 
         updated = query.get_order_items(order_item_id, order_id)
+        broker.publish(customer_id, "order", {"id": order_id, "total": new_total, "order_item": updated})
+        if new_balance is not None:
+            broker.publish(customer_id, "balance", {"id": balance["id"], "customer_id": customer_id, "total": new_balance})
         return OrderItemAdminResponse(**updated)
 
     except HTTPException:
@@ -171,40 +260,36 @@ def patch_order_item(customer_id: int, order_id: int, order_item_id: int, order_
         existing_order = query.get_orders(order_id, customer_id)
         validate.order_exists(existing_order, order_id)
 
-        existing_item = query.get_request("items", order_item.item_id)
-        validate.item_exists(existing_item, order_item.item_id)
-
-        existing_order_item = query.get_order_items(order_item_id, order_id)
-        validate.order_item_exists(existing_order_item, order_item_id)
-
         excluded_values = order_item.dict(exclude_unset=True)
         validate.excluded_values(excluded_values)
 
-        old_quantity = existing_order_item["quantity"]
-        old_item_id = existing_order_item["item_id"]
+        pays_from_balance = existing_order["payment_method"] == "balance"
 
-        # Determine updated quantity
-        new_quantity = excluded_values.get("quantity", old_quantity)
-        new_item_id = excluded_values.get("item_id", old_item_id)
+        # Locks balance -> order -> order item -> both items (LOCK_ORDER); retried as a whole on deadlock
+        def patch(unit):
+            balance = unit.lock_customer_balance(customer_id) if pays_from_balance else None
+            locked_order = unit.lock_one("orders", order_id)
+            validate.order_exists(locked_order, order_id)
 
-        # If item_id or quantity changed, do adjustments
-        if new_quantity != old_quantity or new_item_id != old_item_id:
-            # Step 1: Restore stock of old item
-            old_item = query.get_request("items", old_item_id)
-            db.cursor.execute("UPDATE items SET quantity = quantity + %s WHERE id = %s", (old_quantity, old_item_id))
+            existing_order_item = unit.lock_one("order_items", order_item_id)
+            if existing_order_item and existing_order_item["order_id"] != order_id:
+                existing_order_item = None
+            validate.order_item_exists(existing_order_item, order_item_id)
 
-            # Step 2: Deduct stock from new item
-            new_item = old_item if old_item_id == new_item_id else query.get_request("items", new_item_id)
+            new_item_id = excluded_values.get("item_id", existing_order_item["item_id"])
+            new_quantity = excluded_values.get("quantity", existing_order_item["quantity"])
+            new_total, new_balance = change_order_item(unit, customer_id, locked_order, balance, existing_order_item, new_item_id, new_quantity, current_user.id)
+            return existing_order_item, new_item_id, new_quantity, new_total, balance, new_balance
 
-            if new_item["quantity"] < new_quantity:
-                raise HTTPException(status_code=400, detail="Ordered quantity exceeds available stock")
-
-            db.cursor.execute("UPDATE items SET quantity = quantity - %s WHERE id = %s", (new_quantity, new_item_id))
-        
-        query.dynamic_patch_query("order_items", excluded_values, order_item_id, current_user.id, order_id)
-        db.conn.commit()
+        previous, new_item_id, new_quantity, new_total, balance, new_balance = run_in_transaction(db, patch, commit=lambda result: leaderboard.commit(db, [
+            (result[0]["item_id"], -result[0]["quantity"], result[0]["created_at"]),
+            (result[1], result[2], result[0]["created_at"]),
+        ]))
 
         updated = query.get_order_items(order_item_id, order_id)
+        broker.publish(customer_id, "order", {"id": order_id, "total": new_total, "order_item": updated})
+        if new_balance is not None:
+            broker.publish(customer_id, "balance", {"id": balance["id"], "customer_id": customer_id, "total": new_balance})
         return OrderItemAdminResponse(**updated)
 
     except HTTPException:
@@ -229,14 +314,18 @@ def hard_delete_order_item(customer_id: int, order_id: int, order_item_id: int,
         validate.order_item_exists(existing_order_item, order_item_id)
 
         query.hard_delete("order_items", order_item_id, order_id=order_id)
-        db.conn.commit()
+        leaderboard.commit(db, [(existing_order_item["item_id"], -existing_order_item["quantity"], existing_order_item["created_at"])])
+        broker.publish(customer_id, "order", {"id": order_id, "total": existing_order["total"], "deleted_order_item": order_item_id})
 
         return
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         print(e)
         db.conn.rollback()
-        raise HTTPException(status_code=500, detail="Internal Server Error")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
 
 @router.delete("/{order_item_id}/delete", status_code=status.HTTP_200_OK)
 def soft_delete_order_item(customer_id: int, order_id: int, order_item_id: int, current_user: TokenData = Depends(get_current_user)):
@@ -253,10 +342,14 @@ def soft_delete_order_item(customer_id: int, order_id: int, order_item_id: int,
         validate.order_item_exists(existing_order_item, order_item_id)
 
         query.soft_delete("order_items", current_user.id, order_item_id, order_id=order_id)
-        db.conn.commit()
+        leaderboard.commit(db, [(existing_order_item["item_id"], -existing_order_item["quantity"], existing_order_item["created_at"])])
+        broker.publish(customer_id, "order", {"id": order_id, "total": existing_order["total"], "deleted_order_item": order_item_id})
 
         return {"detail": f"Order item with id {order_item_id} softly deleted."}
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         print(e)
         db.conn.rollback()
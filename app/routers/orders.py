@@ -1,23 +1,41 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Query, Request
 from ..oauth2 import get_current_user
 from ..body import TokenData, Order, OrderPatch
 from ..database import Database
 from ..queries import Queries
-from ..response import OrderAdminResponse, OrderResponse
+from ..response import OrderAdminResponse, OrderResponse, OrderDetailAdminResponse, OrderDetailResponse
 from ..status_codes import Validator
-from typing import List, Union
+from ..encoding import negotiated_response
+from ..profiling import ProfiledRoute
+from ..events import broker
+from typing import List, Union, Optional, Literal
+from datetime import datetime
+from decimal import Decimal
 
 router = APIRouter(
     prefix="/customers/{customer_id}/orders",
-    tags=["Orders"]
+    tags=["Orders"],
+    route_class=ProfiledRoute
 )
 
 db = Database()
 validate = Validator()
 query = Queries(db)
 
-@router.get("/", response_model=List[Union[OrderAdminResponse, OrderResponse]])
-def get_orders(customer_id: int, current_user: TokenData = Depends(get_current_user)):
+@router.get("/", response_model=List[Union[OrderDetailAdminResponse, OrderDetailResponse, OrderAdminResponse, OrderResponse]])
+def get_orders(
+    request: Request,
+    customer_id: int,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    payment_method: Optional[Literal["cash", "balance"]] = None,
+    min_total: Optional[Decimal] = Query(None, ge=0),
+    max_total: Optional[Decimal] = Query(None, ge=0),
+    sort: Literal["created_at", "total", "id"] = "created_at",
+    direction: Literal["asc", "desc"] = "desc",
+    expand: Optional[Literal["items"]] = None,
+    current_user: TokenData = Depends(get_current_user)
+):
     validate.required_roles(current_user.role, ["admin", "user"])
     if current_user.role == "user":
         validate.logged_in_user(current_user.id, customer_id)
@@ -25,9 +43,16 @@ def get_orders(customer_id: int, current_user: TokenData = Depends(get_current_u
     existing_customer = query.get_request("customers", customer_id)
     validate.customer_exists(existing_customer, customer_id)
 
-    orders = query.get_orders(customer_id=customer_id)
+    orders = query.get_orders(
+        customer_id=customer_id, created_from=created_from, created_to=created_to,
+        payment_method=payment_method, min_total=min_total, max_total=max_total, sort=sort, direction=direction
+    )
 
-    return query.response_list(current_user, orders, OrderResponse, OrderAdminResponse)
+    if expand == "items":
+        orders = query.attach_order_items(orders)
+        return query.response_list(current_user, orders, OrderDetailResponse, OrderDetailAdminResponse)
+
+    return negotiated_response(request, query.response_list(current_user, orders, OrderResponse, OrderAdminResponse))
 
 @router.post("/", response_model=OrderResponse, status_code=status.HTTP_201_CREATED)
 def create_order(customer_id: int, order: Order, current_user: TokenData = Depends(get_current_user)):
@@ -42,9 +67,12 @@ def create_order(customer_id: int, order: Order, current_user: TokenData = Depen
             customer_id, order.payment_method, order.note
             )
         )
+        order_id = db.cursor.lastrowid
+        query.record_change("orders", "insert", order_id, {"customer_id": customer_id, **order.dict()}, current_user.id)
         db.conn.commit()
 
-        created_order= query.created_request("orders")
+        created_order= query.created_request("orders", order_id)
+        broker.publish(customer_id, "order", created_order)
 
         return OrderResponse(**created_order)
     
@@ -55,12 +83,18 @@ def create_order(customer_id: int, order: Order, current_user: TokenData = Depen
         print(f"{e}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
     
-@router.get("/{order_id}", response_model=Union[OrderAdminResponse, OrderResponse])
-def get_order(customer_id: int, order_id: int, current_user: TokenData = Depends(get_current_user)):
+@router.get("/{order_id}", response_model=Union[OrderDetailAdminResponse, OrderDetailResponse, OrderAdminResponse, OrderResponse])
+def get_order(customer_id: int, order_id: int, expand: Optional[Literal["items"]] = None, current_user: TokenData = Depends(get_current_user)):
     validate.required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate.logged_in_user(current_user.id, customer_id)
 
+    if expand == "items":
+        order_detail = query.get_order_detail(order_id, customer_id)
+        if order_detail:
+            return query.response(current_user, order_detail, OrderDetailResponse, OrderDetailAdminResponse)
+        # Nothing joined: fall through so the lookups below report what is missing
+
     existing_customer = query.get_request("customers", customer_id)
     validate.customer_exists(existing_customer, customer_id)
 
@@ -86,13 +120,16 @@ def put_orders(customer_id: int, order_id: int, order: Order, current_user: Toke
         #check if balance.total > subtotal
         #deduct balance
 
-        db.cursor.execute("UPDATE orders SET payment_method = %s, note = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND customer_id = %s AND deleted_at IS NULL", (
-            order.payment_method, order.note, order_id, customer_id
+        db.cursor.execute("UPDATE orders SET payment_method = %s, note = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND customer_id = %s AND deleted_at IS NULL", (
+            order.payment_method, order.note, current_user.id, order_id, customer_id
             )
         )
+        query.record_change("orders", "update", order_id, order.dict(), current_user.id)
+        query.invalidate_statements(customer_id, existing_order["created_at"])
         db.conn.commit()
 
         updated_order = query.get_orders(order_id, customer_id)
+        broker.publish(customer_id, "order", updated_order)
 
         return query.response(current_user, updated_order, OrderResponse, OrderAdminResponse)
     
@@ -127,9 +164,11 @@ def patch_orders(customer_id: int, order_id: int, order: OrderPatch, current_use
         #deduct balance
 
         query.dynamic_patch_query("orders", excluded_values, order_id, current_user.id, customer_id)
+        query.invalidate_statements(customer_id, existing_order["created_at"])
         db.conn.commit()
 
         updated_order = query.get_orders(order_id, customer_id)
+        broker.publish(customer_id, "order", updated_order)
 
         return query.response(current_user, updated_order, OrderResponse, OrderAdminResponse)
     
@@ -153,7 +192,9 @@ def hard_delete(customer_id: int, order_id: int, current_user: TokenData = Depen
         validate.order_exists(existing_order, order_id)
 
         query.hard_delete("orders", order_id, customer_id)
+        query.invalidate_statements(customer_id, existing_order["created_at"])
         db.conn.commit()
+        broker.publish(customer_id, "order", {"id": order_id, "deleted": True})
         
         return 
     
@@ -179,7 +220,9 @@ def soft_delete(customer_id: int, order_id: int, current_user: TokenData = Depen
         validate.order_exists(existing_order, order_id)
 
         query.soft_delete("orders", current_user.id, order_id, customer_id)
+        query.invalidate_statements(customer_id, existing_order["created_at"])
         db.conn.commit()
+        broker.publish(customer_id, "order", {"id": order_id, "deleted": True})
         
         return {"detail": f"Order with {order_id} softly deleted successfully"}
     
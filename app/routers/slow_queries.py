@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends, Query
+from ..body import TokenData
+from ..slowlog import slow_queries
+from ..status_codes import Validator
+from ..oauth2 import get_current_user
+from ..profiling import ProfiledRoute
+
+router = APIRouter(
+    prefix="/slow-queries",
+    tags=["Slow Queries"],
+    route_class=ProfiledRoute
+)
+
+validate = Validator()
+
+@router.get("/")
+def get_slow_queries(limit: int = Query(20, ge=1, le=200), current_user: TokenData = Depends(get_current_user)):
+    validate.required_roles(current_user.role, ["admin"])
+
+    return {
+        "threshold_ms": slow_queries.threshold_ms,
+        "top": slow_queries.top(limit),
+        "recent": slow_queries.latest(limit)
+    }
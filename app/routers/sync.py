@@ -0,0 +1,224 @@
+from fastapi import APIRouter, status, HTTPException, Depends
+from ..body import SyncBatch, TokenData
+from ..response import SyncBatchResponse
+from ..database import Database
+from ..queries import Queries
+from ..status_codes import Validator
+from ..oauth2 import get_current_user
+from ..events import broker
+from ..unit_of_work import run_in_transaction
+from ..profiling import ProfiledRoute
+from ..leaderboard import leaderboard
+from ..sharding import sharding_enabled, shard_for, use_shard
+from ..money import ZERO
+
+router = APIRouter(
+    prefix="/sync",
+    tags=["Sync"],
+    route_class=ProfiledRoute
+)
+
+db = Database()
+validate = Validator()
+query = Queries(db)
+
+MAX_SYNC_OPERATIONS = 1000
+
+#Stock or balance shortfall (or a missing row) for one operation: reported, the rest of the batch still applies
+class SyncConflict(Exception):
+    pass
+
+#Store-and-forward from the terminals: a batch of operations queued offline, applied in order in
+#one transaction. client_id makes resending a batch safe; conflicts are reported per operation.
+@router.post("/", response_model=SyncBatchResponse)
+def sync_operations(batch: SyncBatch, current_user: TokenData = Depends(get_current_user)):
+    try:
+        validate.required_roles(current_user.role, ["admin"])
+
+        if not batch.operations:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No operations to sync")
+        if len(batch.operations) > MAX_SYNC_OPERATIONS:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=f"At most {MAX_SYNC_OPERATIONS} operations per batch")
+
+        def apply(unit, operations):
+            seen = query.get_sync_operations([str(operation.client_id) for operation in operations])
+            pending = [operation for operation in operations if str(operation.client_id) not in seen]
+
+            # Orders created offline, by client_id, for the order items that reference them: this
+            # batch's resent ones plus those synced in earlier batches
+            referenced = query.get_sync_operations(list({str(operation.order_client_id) for operation in pending if operation.kind == "order_item" and operation.order_client_id}))
+            created_orders = {client_id: row["row_id"] for client_id, row in {**referenced, **seen}.items() if row["kind"] == "order" and row["status"] == "applied"}
+
+            # Everything the batch can touch is locked once, up front, in LOCK_ORDER; order items
+            # paid from the balance use the customer's first balance (as create_order_item does)
+            balances = unit.lock(
+                "balances",
+                *(operation.balance_id for operation in pending if operation.kind == "transaction"),
+                customer_id=[operation.customer_id for operation in pending if operation.kind == "order_item"]
+            )
+            customer_balances = {}
+            for balance in balances.values():
+                customer_balances.setdefault(balance["customer_id"], balance)
+            orders = unit.lock("orders", *(operation.order_id for operation in pending if operation.kind == "order_item" and operation.order_id), *created_orders.values())
+            items = unit.lock("items", *(operation.item_id for operation in pending if operation.kind == "order_item"))
+
+            changed = {"balances": set(), "orders": set(), "items": set()}
+            sold = []
+            # Statements from the earliest month the batch wrote to are recomputed, per customer
+            changed_since = {}
+
+            def touch(customer_id, changed_at):
+                changed_since[customer_id] = min(changed_since.get(customer_id, changed_at), changed_at)
+
+            def apply_order(operation):
+                customer = query.get_request("customers", operation.customer_id)
+                if not customer:
+                    raise SyncConflict(f"Customer with id {operation.customer_id} not found")
+
+                db.cursor.execute("INSERT INTO orders (customer_id, payment_method, note, created_at) VALUES (%s, %s, %s, %s)", (
+                    operation.customer_id, operation.payment_method, operation.note, operation.created_at
+                ))
+                order_id = db.cursor.lastrowid
+                query.record_change("orders", "insert", order_id, {"customer_id": operation.customer_id, "payment_method": operation.payment_method, "note": operation.note}, current_user.id)
+
+                orders[order_id] = {"id": order_id, "customer_id": operation.customer_id, "payment_method": operation.payment_method, "total": ZERO, "created_at": operation.created_at}
+                created_orders[str(operation.client_id)] = order_id
+                return order_id
+
+            def apply_order_item(operation):
+                order_id = operation.order_id or created_orders.get(str(operation.order_client_id))
+                order = orders.get(order_id)
+                if not order or order["customer_id"] != operation.customer_id:
+                    raise SyncConflict("Order not found")
+
+                item = items.get(operation.item_id)
+                if not item:
+                    raise SyncConflict(f"Item with id {operation.item_id} not found")
+                if item["quantity"] < operation.quantity:
+                    raise SyncConflict(f"Insufficient stock for item {operation.item_id}: {item['quantity']} left")
+
+                subtotal = operation.quantity * item["selling_price"]
+
+                if order["payment_method"] == "balance":
+                    balance = customer_balances.get(operation.customer_id)
+                    if not balance or balance["customer_id"] != operation.customer_id or balance["total"] < subtotal:
+                        raise SyncConflict("Customer balance not sufficient")
+                    balance["total"] -= subtotal
+                    changed["balances"].add(balance["id"])
+
+                db.cursor.execute("INSERT INTO order_items (order_id, item_id, quantity, unit_price, created_at) VALUES (%s, %s, %s, %s, %s)", (
+                    order_id, operation.item_id, operation.quantity, item["selling_price"], operation.created_at
+                ))
+                order_item_id = db.cursor.lastrowid
+                query.record_change("order_items", "insert", order_item_id, {"order_id": order_id, "item_id": operation.item_id, "quantity": operation.quantity, "unit_price": item["selling_price"]}, current_user.id)
+
+                item["quantity"] -= operation.quantity
+                order["total"] += subtotal
+                changed["items"].add(item["id"])
+                changed["orders"].add(order_id)
+                sold.append((operation.item_id, operation.quantity, operation.created_at))
+                touch(operation.customer_id, order["created_at"])
+                return order_item_id
+
+            def apply_transaction(operation):
+                balance = balances.get(operation.balance_id)
+                if not balance or balance["customer_id"] != operation.customer_id:
+                    raise SyncConflict(f"Balance with id {operation.balance_id} not found")
+
+                amount = operation.amount
+                if operation.type == "withdraw" and balance["total"] < amount:
+                    raise SyncConflict("Total balance not sufficient")
+
+                db.cursor.execute("INSERT INTO transactions (customer_id, balance_id, type, amount, created_at) VALUES (%s, %s, %s, %s, %s)", (
+                    operation.customer_id, operation.balance_id, operation.type, operation.amount, operation.created_at
+                ))
+                transaction_id = db.cursor.lastrowid
+                query.record_change("transactions", "insert", transaction_id, {"customer_id": operation.customer_id, "balance_id": operation.balance_id, "type": operation.type, "amount": operation.amount}, current_user.id)
+
+                balance["total"] += amount if operation.type == "deposit" else -amount
+                changed["balances"].add(balance["id"])
+                touch(operation.customer_id, operation.created_at)
+                return transaction_id
+
+            appliers = {"order": apply_order, "order_item": apply_order_item, "transaction": apply_transaction}
+
+            results, records = [], []
+            for operation in operations:
+                client_id = str(operation.client_id)
+                if client_id in seen:
+                    previous = seen[client_id]
+                    results.append({"client_id": client_id, "kind": operation.kind, "status": "duplicate", "row_id": previous["row_id"], "detail": previous["detail"]})
+                    continue
+
+                try:
+                    row_id, outcome, detail = appliers[operation.kind](operation), "applied", None
+                except SyncConflict as conflict:
+                    row_id, outcome, detail = None, "conflict", str(conflict)
+
+                seen[client_id] = {"kind": operation.kind, "status": outcome, "row_id": row_id, "detail": detail}
+                results.append({"client_id": client_id, "kind": operation.kind, "status": outcome, "row_id": row_id, "detail": detail})
+                records.append((client_id, operation.kind, outcome, row_id, detail, operation.created_at, current_user.id))
+
+            # Running totals are written once per row, not once per operation
+            db.cursor.executemany("UPDATE balances SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", [
+                (balances[balance_id]["total"], current_user.id, balance_id) for balance_id in changed["balances"]
+            ])
+            db.cursor.executemany("UPDATE orders SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", [
+                (orders[order_id]["total"], current_user.id, order_id) for order_id in changed["orders"]
+            ])
+            db.cursor.executemany("UPDATE items SET quantity = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", [
+                (items[item_id]["quantity"], current_user.id, item_id) for item_id in changed["items"]
+            ])
+            for balance_id in changed["balances"]:
+                query.record_change("balances", "update", balance_id, {"total": balances[balance_id]["total"]}, current_user.id)
+            for order_id in changed["orders"]:
+                query.record_change("orders", "update", order_id, {"total": orders[order_id]["total"]}, current_user.id)
+            for item_id in changed["items"]:
+                query.record_change("items", "update", item_id, {"quantity": items[item_id]["quantity"]}, current_user.id)
+
+            for customer_id, changed_at in changed_since.items():
+                query.invalidate_statements(customer_id, changed_at)
+
+            query.record_sync_operations(records)
+            return results, [balances[balance_id] for balance_id in changed["balances"]], [orders[order_id] for order_id in changed["orders"]], sold
+
+        # Sharded, each shard's customers are applied in a transaction of their own on that shard;
+        # operations keep their order within a customer, results keep the batch's order
+        groups = {}
+        for position, operation in enumerate(batch.operations):
+            groups.setdefault(shard_for(operation.customer_id) if sharding_enabled() else None, []).append((position, operation))
+
+        results, changed_balances, changed_orders = [None] * len(batch.operations), [], []
+        for shard, group in groups.items():
+            with use_shard(shard):
+                group_results, group_balances, group_orders, _ = run_in_transaction(
+                    db, lambda unit: apply(unit, [operation for _, operation in group]), commit=lambda result: leaderboard.commit(db, result[3])
+                )
+
+            for (position, _), result in zip(group, group_results):
+                results[position] = result
+            changed_balances += group_balances
+            changed_orders += group_orders
+
+        for balance in changed_balances:
+            broker.publish(balance["customer_id"], "balance", {"id": balance["id"], "customer_id": balance["customer_id"], "total": balance["total"]})
+        for order in changed_orders:
+            broker.publish(order["customer_id"], "order", {"id": order["id"], "total": order["total"]})
+
+        return {
+            "applied": sum(result["status"] == "applied" for result in results),
+            "duplicates": sum(result["status"] == "duplicate" for result in results),
+            "conflicts": sum(result["status"] == "conflict" for result in results),
+            "results": results
+        }
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        # The same client_ids committed by a concurrent request: resending is safe, whatever did
+        # commit (sharded, the shards done before this one) comes back as duplicates
+        if getattr(e, "errno", None) == 1062 or getattr(e, "sqlite_errorname", None) == "SQLITE_CONSTRAINT_PRIMARYKEY":
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Batch overlaps one being synced, resend it")
+        print(f"{e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Internal Server Error")
@@ -1,16 +1,22 @@
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Query, Request
 from ..body import Transaction, TransactionPatch, TokenData
 from ..response import TransactionAdminResponse, TransactionResponse, TransactionBalanceAdminResponse, TransactionBalanceResponse
 from ..status_codes import Validator
 from ..queries import Queries
 from ..database import Database
 from ..oauth2 import get_current_user
-from typing import List, Union
+from ..events import broker
+from ..encoding import negotiated_response
+from ..unit_of_work import run_in_transaction
+from ..profiling import ProfiledRoute
+from typing import List, Union, Optional, Literal
 from decimal import Decimal
+from datetime import datetime
 
 router = APIRouter(
     prefix="/customers/{customer_id}/balances/{balance_id}/transactions",
-    tags=["Transactions"]
+    tags=["Transactions"],
+    route_class=ProfiledRoute
 )
 
 db = Database()
@@ -19,7 +25,19 @@ query = Queries(db)
 
 
 @router.get("/", response_model=List[Union[TransactionResponse, TransactionAdminResponse]])
-def get_transactions(customer_id: int, balance_id: int, current_user: TokenData = Depends(get_current_user)):
+def get_transactions(
+    request: Request,
+    customer_id: int,
+    balance_id: int,
+    created_from: Optional[datetime] = None,
+    created_to: Optional[datetime] = None,
+    type: Optional[Literal["withdraw", "deposit"]] = None,
+    min_amount: Optional[Decimal] = Query(None, ge=0),
+    max_amount: Optional[Decimal] = Query(None, ge=0),
+    sort: Literal["created_at", "amount", "id"] = "created_at",
+    direction: Literal["asc", "desc"] = "desc",
+    current_user: TokenData = Depends(get_current_user)
+):
     validate.required_roles(current_user.role, ["user", "admin"])
     if current_user.role == "user":
         validate.logged_in_user(current_user.id, customer_id)
@@ -30,9 +48,12 @@ def get_transactions(customer_id: int, balance_id: int, current_user: TokenData
     existing_balance = query.get_request("balances", balance_id)
     validate.balance_exists(existing_balance, balance_id)
 
-    existing_transactions = query.get_transactions(customer_id=customer_id, balance_id=balance_id)
+    existing_transactions = query.get_transactions(
+        customer_id=customer_id, balance_id=balance_id, created_from=created_from, created_to=created_to,
+        type=type, min_amount=min_amount, max_amount=max_amount, sort=sort, direction=direction
+    )
     
-    return query.response_list(current_user, existing_transactions, TransactionResponse, TransactionAdminResponse)
+    return negotiated_response(request, query.response_list(current_user, existing_transactions, TransactionResponse, TransactionAdminResponse))
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=TransactionBalanceResponse)
 def create_transaction(customer_id: int, balance_id: int, transaction: Transaction, current_user: TokenData = Depends(get_current_user)):
@@ -43,33 +64,44 @@ def create_transaction(customer_id: int, balance_id: int, transaction: Transacti
         existing_customer = query.get_request("customers", customer_id)
         validate.customer_exists(existing_customer, customer_id)
 
-        existing_balance = query.get_request("balances", balance_id)
-        validate.balance_exists(existing_balance, balance_id)
-
-        db.cursor.execute("INSERT INTO transactions (customer_id, balance_id, type, amount) VALUES (%s, %s, %s, %s)", (
-                customer_id,
-                balance_id,
-                transaction.type,
-                transaction.amount
+        # Locks the balance before writing the transaction (LOCK_ORDER); retried as a whole on deadlock
+        def create(unit):
+            existing_balance = unit.lock_one("balances", balance_id)
+            validate.balance_exists(existing_balance, balance_id)
+            validate.balance_owner(existing_balance, customer_id)
+
+            db.cursor.execute("INSERT INTO transactions (customer_id, balance_id, type, amount) VALUES (%s, %s, %s, %s)", (
+                    customer_id,
+                    balance_id,
+                    transaction.type,
+                    transaction.amount
+                )
             )
-        )
+            transaction_id = db.cursor.lastrowid
 
-        total_balance = existing_balance["total"]
-        transaction_amount = Decimal(str(transaction.amount))
+            total_balance = existing_balance["total"]
+            transaction_amount = transaction.amount
 
-        if transaction.type == "deposit":
-            new_balance =  total_balance + transaction_amount
-        else:
-            if total_balance - transaction_amount < 0:
-                raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Total balance not sufficient")
+            if transaction.type == "deposit":
+                new_balance =  total_balance + transaction_amount
             else:
-                new_balance = total_balance - transaction_amount
+                if total_balance - transaction_amount < 0:
+                    raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Total balance not sufficient")
+                else:
+                    new_balance = total_balance - transaction_amount
 
-        db.cursor.execute("UPDATE balances SET total = %s WHERE id = %s", (new_balance, customer_id))    
-        db.conn.commit()
+            db.cursor.execute("UPDATE balances SET total = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (new_balance, current_user.id, balance_id))
+            query.record_change("transactions", "insert", transaction_id, {"customer_id": customer_id, "balance_id": balance_id, **transaction.dict()}, current_user.id)
+            query.record_change("balances", "update", balance_id, {"total": new_balance}, current_user.id)
+            return transaction_id
+
+        transaction_id = run_in_transaction(db, create)
+
+        created_transaction = query.created_request("transactions", transaction_id)
+        updated_balance = query.get_request("balances", balance_id)
 
-        created_transaction = query.created_request("transactions")
-        updated_balance = query.get_request("balances", customer_id)
+        broker.publish(customer_id, "transaction", created_transaction)
+        broker.publish(customer_id, "balance", updated_balance)
         
         return {
             "transaction": created_transaction,
@@ -110,25 +142,34 @@ def put_transaction(customer_id: int, balance_id: int, transaction_id: int, tran
         existing_customer = query.get_request("customers", customer_id)
         validate.customer_exists(existing_customer, customer_id)
 
-        existing_balance = query.get_request("balances", balance_id)
-        validate.balance_exists(existing_balance, balance_id)
+        # Locks balance -> transaction (LOCK_ORDER) so the balance and the transaction change together
+        def put(unit):
+            existing_balance = unit.lock_one("balances", balance_id)
+            validate.balance_exists(existing_balance, balance_id)
 
-        existing_transaction = query.get_transactions(transaction_id, customer_id, balance_id)
-        validate.transaction_exists(existing_transaction, transaction_id)
+            existing_transaction = unit.lock_one("transactions", transaction_id)
+            if existing_transaction and (existing_transaction["customer_id"], existing_transaction["balance_id"]) != (customer_id, balance_id):
+                existing_transaction = None
+            validate.transaction_exists(existing_transaction, transaction_id)
 
-        #reset balance before the transaction
-        existing_balance["total"] = query.adjust_balance_total(existing_balance, existing_transaction, transaction.dict())
+            #reset balance before the transaction
+            existing_balance["total"] = query.adjust_balance_total(existing_balance, existing_transaction, transaction.dict())
 
-        db.cursor.execute("UPDATE transactions SET type = %s, amount = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND customer_id = %s AND balance_id = %s", (
-                transaction.type, transaction.amount, current_user.id, transaction_id, customer_id, balance_id
+            db.cursor.execute("UPDATE transactions SET type = %s, amount = %s, updated_by = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s AND customer_id = %s AND balance_id = %s", (
+                    transaction.type, transaction.amount, current_user.id, transaction_id, customer_id, balance_id
+                )
             )
-        )
-        db.conn.commit()
-        updated_transaction = query.get_transactions(transaction_id, customer_id, balance_id)
+            query.record_change("transactions", "update", transaction_id, transaction.dict(), current_user.id)
+            query.invalidate_statements(customer_id, existing_transaction["created_at"])
+            query.update_balance_total(balance_id, customer_id, existing_balance["total"], current_user.id, commit=False)
 
-        query.update_balance_total(balance_id, customer_id, existing_balance["total"], current_user.id)
+        run_in_transaction(db, put)
+        updated_transaction = query.get_transactions(transaction_id, customer_id, balance_id)
         updated_balance = query.get_request("balances", balance_id)
 
+        broker.publish(customer_id, "transaction", updated_transaction)
+        broker.publish(customer_id, "balance", updated_balance)
+
         return {
             "transaction": updated_transaction,
             "balance": updated_balance
@@ -150,24 +191,32 @@ def patch_transaction(customer_id: int, balance_id: int, transaction_id: int, tr
         existing_customer = query.get_request("customers", customer_id)
         validate.customer_exists(existing_customer, customer_id)
 
-        existing_balance = query.get_request("balances", balance_id)
-        validate.balance_exists(existing_balance, balance_id)
-
-        existing_transaction = query.get_transactions(transaction_id, customer_id, balance_id)
-        validate.transaction_exists(existing_transaction, transaction_id)
-
         excluded_values = transaction.dict(exclude_unset=True)
         validate.excluded_values(excluded_values)
 
-        existing_balance["total"] = query.adjust_balance_total(existing_balance, existing_transaction, excluded_values)
+        # Locks balance -> transaction (LOCK_ORDER) so the balance and the transaction change together
+        def patch(unit):
+            existing_balance = unit.lock_one("balances", balance_id)
+            validate.balance_exists(existing_balance, balance_id)
 
-        query.dynamic_patch_query("transactions", excluded_values, transaction_id, current_user.id, customer_id, balance_id)
-        db.conn.commit()
-        updated_transaction = query.get_transactions(transaction_id, customer_id, balance_id)
+            existing_transaction = unit.lock_one("transactions", transaction_id)
+            if existing_transaction and (existing_transaction["customer_id"], existing_transaction["balance_id"]) != (customer_id, balance_id):
+                existing_transaction = None
+            validate.transaction_exists(existing_transaction, transaction_id)
+
+            existing_balance["total"] = query.adjust_balance_total(existing_balance, existing_transaction, excluded_values)
 
-        query.update_balance_total(balance_id, customer_id, existing_balance["total"], current_user.id)
+            query.dynamic_patch_query("transactions", excluded_values, transaction_id, current_user.id, customer_id, balance_id)
+            query.invalidate_statements(customer_id, existing_transaction["created_at"])
+            query.update_balance_total(balance_id, customer_id, existing_balance["total"], current_user.id, commit=False)
+
+        run_in_transaction(db, patch)
+        updated_transaction = query.get_transactions(transaction_id, customer_id, balance_id)
         updated_balance = query.get_request("balances", balance_id)
 
+        broker.publish(customer_id, "transaction", updated_transaction)
+        broker.publish(customer_id, "balance", updated_balance)
+
         return {
             "transaction": updated_transaction,
             "balance": updated_balance
@@ -196,7 +245,9 @@ def hard_delete_transaction(customer_id: int, balance_id: int, transaction_id: i
         validate.transaction_exists(existing_transaction, transaction_id)
 
         query.hard_delete("transactions", transaction_id, customer_id, balance_id)
+        query.invalidate_statements(customer_id, existing_transaction["created_at"])
         db.conn.commit()
+        broker.publish(customer_id, "transaction", {"id": transaction_id, "balance_id": balance_id, "deleted": True})
 
         return 
 
@@ -223,7 +274,9 @@ def soft_delete_transaction(customer_id: int, balance_id: int, transaction_id: i
         validate.transaction_exists(existing_transaction, transaction_id)
 
         query.soft_delete("transactions", current_user.id, transaction_id, customer_id, balance_id)
+        query.invalidate_statements(customer_id, existing_transaction["created_at"])
         db.conn.commit()
+        broker.publish(customer_id, "transaction", {"id": transaction_id, "balance_id": balance_id, "deleted": True})
 
         return {"detail": "Transaction soft deleted successfully"}
 
@@ -0,0 +1,189 @@
+import re
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from threading import Lock
+from .config import settings
+
+#Shard the current request's customer lives on (None: the home database only). Set by ShardMiddleware
+#from the /customers/{customer_id}/... path, or pinned with use_shard() by code working for a customer.
+current_shard = ContextVar("current_shard", default=None)
+
+#Customer-owned tables: every row belongs to exactly one customer and lives on that customer's shard.
+#Everything else (customers, items, change_log for them) stays on the home database (the database_* settings).
+SHARDED_TABLES = {
+    "balances", "transactions", "transactions_archive", "orders", "order_items",
+    "balance_statements", "sync_operations",
+}
+SHARED_TABLES = {"customers", "items"}
+
+TABLES = re.compile(r"\b(?:FROM|JOIN|INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+CUSTOMER_PATH = re.compile(r"^/customers/(\d+)(?:/|$)")
+
+class ShardingError(Exception):
+    pass
+
+def sharding_enabled() -> bool:
+    return settings.database_backend == "mysql" and bool(settings.database_shards)
+
+def shard_count() -> int:
+    return len(settings.database_shards)
+
+#Fixed modulo map: adding shards means moving customers, so pick the shard count with room to grow
+def shard_for(customer_id: int) -> int:
+    return customer_id % shard_count()
+
+@contextmanager
+def use_shard(shard: int):
+    token = current_shard.set(shard)
+    try:
+        yield
+    finally:
+        current_shard.reset(token)
+
+@lru_cache(maxsize=1024)
+def statement_tables(sql: str) -> frozenset:
+    return frozenset(table.lower() for table in TABLES.findall(sql))
+
+#None routes to the home database, an int to that shard
+def route(sql: str, values) -> int:
+    tables = statement_tables(sql)
+
+    if tables & SHARDED_TABLES:
+        if tables & SHARED_TABLES:
+            raise ShardingError(f"Statement joins shared and customer tables: {' '.join(sql.split())[:120]}")
+        return required_shard()
+
+    if "change_log" in tables:
+        # A change is logged next to the row it describes, so it commits (or rolls back) with it
+        if sql.lstrip()[:6].upper() == "INSERT" and values:
+            return required_shard() if values[0] in SHARDED_TABLES else None
+        return current_shard.get()
+
+    return None
+
+def required_shard() -> int:
+    shard = current_shard.get()
+    if shard is None:
+        raise ShardingError("No shard selected for a customer table statement")
+    return shard
+
+
+#Database lookalike over the home database and one lazily opened MySQLDatabase per shard. Queries,
+#the routers and run_in_transaction use it unchanged: each statement goes to the connection its
+#tables live on, and commit/rollback cover every connection the work touched.
+class ShardedDatabase:
+    def __init__(self, pooled: bool = False, use_pure: bool = None, prepared: bool = None):
+        # Prepared statements are per connection; the routing cursor does not keep one set per shard
+        self.options = {"pooled": pooled, "use_pure": use_pure, "prepared": False}
+        self.databases = {}
+        self.lock = Lock()
+        self.cursor = RoutingCursor(self)
+        self.conn = RoutingConnection(self)
+        self.statements = None
+
+    def database(self, shard: int = None):
+        from .database import MySQLDatabase
+
+        with self.lock:
+            if shard not in self.databases:
+                self.databases[shard] = MySQLDatabase(shard=shard, **self.options)
+            return self.databases[shard]
+
+    def opened(self) -> list:
+        # Shards first, home last (see RoutingConnection)
+        with self.lock:
+            return [self.databases[shard] for shard in sorted(self.databases, key=lambda shard: shard_count() if shard is None else shard)]
+
+    def each(self) -> list:
+        return [self.database(None)] + [self.database(shard) for shard in range(shard_count())]
+
+    def close(self):
+        for database in self.opened():
+            database.close()
+        with self.lock:
+            self.databases.clear()
+
+    def reconnect(self):
+        for database in self.opened():
+            database.reconnect()
+
+    def create_tables(self):
+        # create_tables closes each connection when it is done
+        for database in self.each():
+            database.create_tables()
+        with self.lock:
+            self.databases.clear()
+
+    def purge_change_log(self):
+        for database in self.each():
+            database.purge_change_log()
+
+    def maintain_transaction_partitions(self):
+        for database in self.each():
+            database.maintain_transaction_partitions()
+
+
+class RoutingCursor:
+    def __init__(self, db: ShardedDatabase):
+        self.db = db
+        self.last = None
+
+    def execute(self, sql: str, values: tuple = ()):
+        self.last = self.db.database(route(sql, values)).cursor
+        return self.last.execute(sql, values)
+
+    def executemany(self, sql: str, rows):
+        rows = list(rows)
+        self.last = self.db.database(route(sql, rows[0] if rows else ())).cursor
+        return self.last.executemany(sql, rows)
+
+    # fetchone/fetchall/lastrowid/rowcount come from the cursor the last statement ran on
+    def __getattr__(self, name):
+        if self.last is None:
+            raise AttributeError(name)
+        return getattr(self.last, name)
+
+    def close(self):
+        self.db.close()
+
+
+#Commits are per connection: each shard, then home. This is not two-phase: a failure between two
+#commits keeps the earlier ones. Shards hold the money and the sales, so they commit first: the worst
+#case is a sale whose item stock was not taken, or a new customer's balance without its customer row,
+#never stock taken for a sale that rolled back. Work for one customer (an order, a sync batch) touches
+#one shard and commits there in one transaction.
+class RoutingConnection:
+    def __init__(self, db: ShardedDatabase):
+        self.db = db
+
+    def commit(self):
+        for database in self.db.opened():
+            database.conn.commit()
+
+    def rollback(self):
+        for database in self.db.opened():
+            database.conn.rollback()
+
+    def close(self):
+        self.db.close()
+
+
+#Routes /customers/{customer_id}/... requests to the customer's shard
+class ShardMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not sharding_enabled():
+            return await self.app(scope, receive, send)
+
+        match = CUSTOMER_PATH.match(scope["path"])
+        if not match:
+            return await self.app(scope, receive, send)
+
+        token = current_shard.set(shard_for(int(match.group(1))))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_shard.reset(token)
@@ -0,0 +1,155 @@
+import json
+import queue
+import re
+import time
+from collections import deque
+from threading import Lock, Thread
+from .config import settings
+from .instrumentation import query_observers, current_route
+from .sharding import current_shard, use_shard
+
+#Literals, numbers and IN lists collapse so one query shape is one entry
+NORMALIZERS = (
+    (re.compile(r"'(?:[^'\\]|\\.|'')*'"), "?"),
+    (re.compile(r"\b\d+(\.\d+)?\b"), "?"),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\(\s*\?(\s*,\s*\?)*\s*\)"), "(?+)"),
+    (re.compile(r"\s+"), " "),
+)
+
+EXPLAINABLE = re.compile(r"^\s*(/\*.*?\*/\s*)?(SELECT|UPDATE|DELETE|INSERT)\b", re.IGNORECASE | re.DOTALL)
+
+def normalize(sql: str) -> str:
+    sql = re.sub(r"/\*\+.*?\*/", "", sql)     # optimizer hints (e.g. MAX_EXECUTION_TIME)
+    for pattern, replacement in NORMALIZERS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+def parameter_shape(values) -> str:
+    if isinstance(values, list):
+        first = values[0] if values else ()
+        return f"{len(values)} x ({', '.join(type(value).__name__ for value in first)})"
+    if isinstance(values, dict):
+        return "{" + ", ".join(f"{key}: {type(value).__name__}" for key, value in values.items()) + "}"
+    return "(" + ", ".join(type(value).__name__ for value in values or ()) + ")"
+
+#Statements slower than slow_query_ms: the last slow_query_buffer of them in a ring buffer, plus
+#per-statement totals (at most slow_query_max_statements) with an EXPLAIN captured once each
+class SlowQueryLog:
+    def __init__(self, threshold_ms: float, buffer_size: int, max_statements: int):
+        self.threshold_ms = threshold_ms
+        self.max_statements = max_statements
+        self.recent = deque(maxlen=buffer_size)
+        self.statements = {}
+        self.lock = Lock()
+        self.explains = queue.Queue(maxsize=100)
+        self.explainer = None
+
+    def __call__(self, sql, values, seconds: float):
+        duration_ms = seconds * 1000
+        if duration_ms < self.threshold_ms or sql.lstrip()[:7].upper() == "EXPLAIN":
+            return
+
+        normalized = normalize(sql)
+        route = current_route.get()
+        shape = parameter_shape(values)
+
+        with self.lock:
+            self.recent.append({
+                "sql": normalized, "parameters": shape, "route": route,
+                "duration_ms": round(duration_ms, 2), "at": time.time()
+            })
+
+            statement = self.statements.get(normalized)
+            if statement is None:
+                if len(self.statements) >= self.max_statements:
+                    return
+                statement = self.statements[normalized] = {
+                    "sql": normalized, "parameters": shape, "count": 0, "total_ms": 0.0,
+                    "max_ms": 0.0, "routes": [], "plan": None
+                }
+                explain = not isinstance(values, list) and EXPLAINABLE.match(sql)
+            else:
+                explain = False
+
+            statement["count"] += 1
+            statement["total_ms"] += duration_ms
+            statement["max_ms"] = max(statement["max_ms"], duration_ms)
+            if route and route not in statement["routes"] and len(statement["routes"]) < 10:
+                statement["routes"].append(route)
+
+        # EXPLAIN needs a connection of its own: the request's cursor still holds its results
+        if explain:
+            self.start_explainer()
+            try:
+                self.explains.put_nowait((normalized, current_shard.get(), sql, values))
+            except queue.Full:
+                pass
+
+    def start_explainer(self):
+        with self.lock:
+            if self.explainer is None:
+                self.explainer = Thread(target=self.explain_worker, name="slow-query-explain", daemon=True)
+                self.explainer.start()
+
+    #Connects on first use and again after a failure, so a database that is down costs the plans
+    #queued meanwhile, not the thread. Each statement is explained on the shard it ran on.
+    def explain_worker(self):
+        from .database import Database
+        db = None
+
+        while True:
+            normalized, shard, sql, values = self.explains.get()
+            try:
+                if db is None:
+                    db = Database(prepared=False)
+
+                with use_shard(shard):
+                    if settings.database_backend == "sqlite":
+                        db.cursor.execute(f"EXPLAIN QUERY PLAN {sql}", values)
+                        plan = db.cursor.fetchall()
+                    else:
+                        db.cursor.execute(f"EXPLAIN FORMAT=JSON {sql}", values)
+                        row = db.cursor.fetchone()
+                        plan = json.loads(next(iter(row.values())))
+                    db.conn.rollback()
+            except Exception as e:
+                plan = {"error": str(e)}
+                db = self.reset(db)
+
+            with self.lock:
+                self.statements[normalized]["plan"] = plan
+
+    #The connection after a failed EXPLAIN: rolled back (and reconnected if it was lost), or None
+    #so the next statement opens a new one
+    def reset(self, db):
+        if db is None:
+            return None
+        try:
+            db.conn.rollback()
+            db.reconnect()
+            return db
+        except Exception as e:
+            print(f"Slow query EXPLAIN connection failed: {e}")
+            try:
+                db.close()
+            except Exception:
+                pass
+            return None
+
+    def top(self, limit: int) -> list:
+        with self.lock:
+            statements = sorted(self.statements.values(), key=lambda statement: statement["total_ms"], reverse=True)[:limit]
+            return [
+                {**statement, "avg_ms": round(statement["total_ms"] / statement["count"], 2), "total_ms": round(statement["total_ms"], 2), "max_ms": round(statement["max_ms"], 2)}
+                for statement in statements
+            ]
+
+    def latest(self, limit: int) -> list:
+        with self.lock:
+            return list(self.recent)[-limit:]
+
+
+slow_queries = SlowQueryLog(settings.slow_query_ms, settings.slow_query_buffer, settings.slow_query_max_statements)
+if settings.slow_query_ms > 0:
+    query_observers.append(slow_queries)
@@ -0,0 +1,453 @@
+import re
+import sqlite3
+from datetime import date, datetime
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
+from .config import settings
+from .instrumentation import TimedCursor
+
+#Embedded backend for single-terminal stores (database_backend = "sqlite"). It takes the SQL
+#Queries and the routers already send (MySQL dialect, %s placeholders) and translates it per
+#statement, so nothing above Database has to know which backend it runs on.
+
+CENTS = Decimal("0.01")
+
+#Money is stored as INTEGER cents: a DECIMAL(10, 2) column has NUMERIC affinity, which would turn a
+#decimal string into a REAL, and SUMs and generated columns would add floats. Every Decimal the app
+#binds is an amount, so it is written as cents and DECIMAL columns are read back from cents.
+def to_cents(value: Decimal) -> int:
+    return int(value.scaleb(2).to_integral_value(ROUND_HALF_UP))
+
+def from_cents(value: bytes) -> Decimal:
+    # quantize: a REAL written by an old schema default (0.00) reads back as "0.0"
+    return Decimal(value.decode()).scaleb(-2).quantize(CENTS)
+
+#Money columns the app writes, migrated to cents by create_tables (generated ones follow their inputs)
+MONEY_COLUMNS = {
+    "balances": ("total",),
+    "transactions": ("amount",),
+    "transactions_archive": ("amount",),
+    "orders": ("total",),
+    "items": ("orig_price", "selling_price"),
+    "order_items": ("unit_price",),
+    "balance_statements": ("deposits", "withdrawals", "balance_orders", "closing_balance"),
+}
+#Computed money (SUM(amount) AS deposits, ...) has no declared type, so it comes back as plain cents
+COMPUTED_MONEY = {"deposits", "withdrawals", "balance_orders"}
+
+#The transactions columns, in the same order (so INSERT ... SELECT * fits) and with the same
+#declared types (so amount goes through the DECIMAL converter). No foreign keys, as with MySQL's
+#CREATE TABLE ... LIKE: archived rows outlive their customer.
+TRANSACTIONS_ARCHIVE = """
+    CREATE TABLE IF NOT EXISTS transactions_archive (
+        id INTEGER PRIMARY KEY,
+        customer_id INT NOT NULL,
+        balance_id INT NOT NULL,
+        type TEXT NOT NULL CHECK (type IN ('withdraw', 'deposit')),
+        amount DECIMAL(10, 2) NOT NULL DEFAULT 0,
+
+        created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+        updated_at TIMESTAMP NULL,
+        deleted_at TIMESTAMP NULL,
+        updated_by VARCHAR(30),
+        deleted_by VARCHAR(30)
+    )
+"""
+
+#PRAGMA user_version: 1 = money in cents
+SCHEMA_VERSION = 1
+
+# Dates the way MySQL prints them
+sqlite3.register_adapter(Decimal, to_cents)
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" ", "seconds"))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter("DECIMAL", from_cents)
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+#MySQL-only syntax used by Queries/routers -> SQLite equivalent. Placeholders go last.
+TRANSLATIONS = (
+    (re.compile(r"MATCH\((\w+)\) AGAINST \(%s IN BOOLEAN MODE\)"), r"MATCH_AGAINST(\1, %s)"),
+    (re.compile(r"\bINSERT IGNORE\b"), "INSERT OR IGNORE"),
+    (re.compile(r"\bLAST_INSERT_ID\(\)"), "last_insert_rowid()"),
+    (re.compile(r"\bCURRENT_TIMESTAMP\b"), "datetime('now', 'localtime')"),
+    # like_prefix escapes with a backslash, MySQL's default LIKE escape character
+    (re.compile(r"\bLIKE %s"), r"LIKE %s ESCAPE '\\'"),
+    (re.compile(r"%s"), "?"),
+)
+FOR_UPDATE = re.compile(r"\s+FOR UPDATE\b")
+
+@lru_cache(maxsize=1024)
+def translate(sql: str) -> tuple:
+    locking = bool(FOR_UPDATE.search(sql))
+    sql = FOR_UPDATE.sub("", sql)
+    for pattern, replacement in TRANSLATIONS:
+        sql = pattern.sub(replacement, sql)
+    return sql, locking
+
+#Generated columns (SQLite 3.31+); older libraries get plain columns kept up to date by triggers
+GENERATED_COLUMNS = {
+    "items": {
+        "total_orig_price": "quantity * orig_price",
+        "total_selling_price": "quantity * selling_price",
+        "profit": "-(quantity * orig_price)",
+    },
+    "order_items": {
+        "subtotal": "quantity * unit_price",
+    },
+}
+HAS_GENERATED_COLUMNS = sqlite3.sqlite_version_info >= (3, 31, 0)
+
+def generated_columns(table: str) -> str:
+    if HAS_GENERATED_COLUMNS:
+        return ",\n".join(f"{name} DECIMAL(10, 2) GENERATED ALWAYS AS ({expression}) STORED" for name, expression in GENERATED_COLUMNS[table].items())
+    return ",\n".join(f"{name} DECIMAL(10, 2)" for name in GENERATED_COLUMNS[table])
+
+def generated_triggers(table: str) -> list:
+    assignments = ", ".join(f"{name} = {expression}" for name, expression in GENERATED_COLUMNS[table].items())
+    inputs = "quantity, orig_price, selling_price" if table == "items" else "quantity, unit_price"
+    return [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_generated_{name} AFTER {event} ON {table}
+        BEGIN
+            UPDATE {table} SET {assignments} WHERE id = NEW.id;
+        END
+        """
+        for name, event in (("insert", "INSERT"), ("update", f"UPDATE OF {inputs}"))
+    ]
+
+#SQL functions MySQL has built in
+def year(value):
+    return int(value[:4]) if value else None
+
+def month(value):
+    return int(value[5:7]) if value else None
+
+#MATCH ... AGAINST in BOOLEAN MODE, as search_items uses it: +term is required, term* matches as a
+#prefix. Returns the number of matched terms (0 when a required one is missing), used as the score.
+def match_against(text, search):
+    if not text or not search:
+        return 0
+
+    words = re.findall(r"\w+", text.lower())
+    score = 0
+    for term in search.lower().split():
+        required, prefix = term.startswith("+"), term.endswith("*")
+        term = term.strip("+*")
+        if any(word.startswith(term) if prefix else word == term for word in words):
+            score += 1
+        elif required:
+            return 0
+    return score
+
+#DB-API cursor with the mysql.connector dictionary cursor interface the rest of the app uses
+class SQLiteCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+    def execute(self, sql, values=()):
+        sql, locking = translate(sql)
+        # FOR UPDATE: take the write lock up front, as InnoDB would take the row locks
+        if locking and not self.conn.in_transaction:
+            self.cursor.execute("BEGIN IMMEDIATE")
+        self.cursor.execute(sql, tuple(values))
+
+    def executemany(self, sql, rows):
+        self.cursor.executemany(translate(sql)[0], rows)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return self.row(row) if row is not None else None
+
+    def fetchall(self) -> list:
+        return [self.row(row) for row in self.cursor.fetchall()]
+
+    # Declared columns go through the converters; computed money comes back as integer cents
+    def row(self, row) -> dict:
+        return {
+            column[0]: Decimal(value).scaleb(-2) if isinstance(value, int) and column[0] in COMPUTED_MONEY else value
+            for column, value in zip(self.cursor.description, row)
+        }
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteDatabase:
+    #Same signature as the MySQL Database; pooling and prepared statements do not apply (sqlite3
+    #caches compiled statements per connection and opening one is a file open)
+    def __init__(self, pooled: bool = False, use_pure: bool = None, prepared: bool = None):
+        self.conn = sqlite3.connect(
+            settings.sqlite_path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        self.conn.create_function("YEAR", 1, year, deterministic=True)
+        self.conn.create_function("MONTH", 1, month, deterministic=True)
+        self.conn.create_function("MATCH_AGAINST", 2, match_against, deterministic=True)
+
+        # WAL: readers never block the writer; NORMAL sync is durable across app crashes
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.execute(f"PRAGMA busy_timeout = {int(settings.lock_wait_timeout_seconds * 1000)}")
+
+        self.cursor = TimedCursor(SQLiteCursor(self.conn))
+        self.statements = None
+
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+    #A file connection is not lost the way a server connection is
+    def reconnect(self):
+        pass
+
+    def create_tables(self):
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        existing = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+        commands = [
+            """
+            CREATE TABLE IF NOT EXISTS customers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email VARCHAR(64) NOT NULL UNIQUE,
+                password VARCHAR(120) NOT NULL,
+                first_name VARCHAR(30) NOT NULL,
+                last_name VARCHAR(30) NOT NULL,
+                role TEXT NOT NULL CHECK (role IN ('user', 'admin')),
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                updated_at TIMESTAMP NULL,
+                deleted_at TIMESTAMP NULL,
+                updated_by VARCHAR(30),
+                deleted_by VARCHAR(30)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS balances (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                customer_id INT NOT NULL,
+                total DECIMAL(10, 2) NOT NULL DEFAULT 0,
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                updated_at TIMESTAMP NULL,
+                deleted_at TIMESTAMP NULL,
+                updated_by VARCHAR(30),
+                deleted_by VARCHAR(30),
+
+                FOREIGN KEY (customer_id) REFERENCES customers(id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                customer_id INT NOT NULL,
+                balance_id INT NOT NULL,
+                type TEXT NOT NULL CHECK (type IN ('withdraw', 'deposit')),
+                amount DECIMAL(10, 2) NOT NULL DEFAULT 0,
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                updated_at TIMESTAMP NULL,
+                deleted_at TIMESTAMP NULL,
+                updated_by VARCHAR(30),
+                deleted_by VARCHAR(30),
+
+                FOREIGN KEY (customer_id) REFERENCES customers(id)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+                FOREIGN KEY (balance_id) REFERENCES balances(id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS orders (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                customer_id INT NOT NULL,
+                payment_method TEXT NOT NULL CHECK (payment_method IN ('cash', 'balance')),
+                note TEXT,
+                total DECIMAL(10, 2) DEFAULT 0,
+                store_notes TEXT,
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                updated_at TIMESTAMP NULL,
+                deleted_at TIMESTAMP NULL,
+                updated_by VARCHAR(30),
+                deleted_by VARCHAR(30),
+
+                FOREIGN KEY (customer_id) REFERENCES customers(id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name VARCHAR(60) NOT NULL,
+                quantity INT NOT NULL,
+                sold INT NOT NULL DEFAULT 0,
+                orig_price DECIMAL(10, 2) NOT NULL,
+                selling_price DECIMAL(10, 2) NOT NULL,
+                {generated_columns("items")},
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                updated_at TIMESTAMP NULL,
+                deleted_at TIMESTAMP NULL,
+                updated_by VARCHAR(30),
+                deleted_by VARCHAR(30)
+            )
+            """,
+            f"""
+            CREATE TABLE IF NOT EXISTS order_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                order_id INT NOT NULL,
+                item_id INT NOT NULL,
+                quantity INT NOT NULL,
+                unit_price DECIMAL(10, 2) NOT NULL,
+                {generated_columns("order_items")},
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+                updated_at TIMESTAMP NULL,
+                deleted_at TIMESTAMP NULL,
+                updated_by VARCHAR(30),
+                deleted_by VARCHAR(30),
+
+                FOREIGN KEY (order_id) REFERENCES orders(id)
+                ON UPDATE CASCADE ON DELETE CASCADE,
+                FOREIGN KEY (item_id) REFERENCES items(id)
+                ON UPDATE CASCADE ON DELETE CASCADE
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS change_log (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name VARCHAR(30) NOT NULL,
+                row_id INT NULL,
+                operation TEXT NOT NULL CHECK (operation IN ('insert', 'update', 'soft_delete', 'delete')),
+                data TEXT NULL,
+                changed_by VARCHAR(30),
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS balance_statements (
+                balance_id INT NOT NULL,
+                customer_id INT NOT NULL,
+                period DATE NOT NULL,
+                deposits DECIMAL(12, 2) NOT NULL DEFAULT 0,
+                withdrawals DECIMAL(12, 2) NOT NULL DEFAULT 0,
+                balance_orders DECIMAL(12, 2) NOT NULL DEFAULT 0,
+                closing_balance DECIMAL(12, 2) NULL,
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime')),
+
+                PRIMARY KEY (balance_id, period)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS sync_operations (
+                client_id CHAR(36) PRIMARY KEY,
+                kind TEXT NOT NULL CHECK (kind IN ('order', 'order_item', 'transaction')),
+                status TEXT NOT NULL CHECK (status IN ('applied', 'conflict')),
+                row_id INT NULL,
+                detail VARCHAR(255) NULL,
+                client_created_at TIMESTAMP NULL,
+                synced_by VARCHAR(30),
+
+                created_at TIMESTAMP DEFAULT (datetime('now', 'localtime'))
+            )
+            """,
+        ]
+        if not HAS_GENERATED_COLUMNS:
+            commands += generated_triggers("items") + generated_triggers("order_items")
+
+        # Same indexes as the MySQL schema; item name search has no FULLTEXT index (MATCH_AGAINST scans)
+        commands += [
+            "CREATE INDEX IF NOT EXISTS idx_items_name ON items (name)",
+            "CREATE INDEX IF NOT EXISTS idx_customers_first_name ON customers (first_name)",
+            "CREATE INDEX IF NOT EXISTS idx_customers_last_name ON customers (last_name)",
+            "CREATE INDEX IF NOT EXISTS idx_transactions_customer_created ON transactions (customer_id, balance_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_orders_customer_created ON orders (customer_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_order_items_created ON order_items (created_at, item_id, quantity, deleted_at)",
+            "CREATE INDEX IF NOT EXISTS idx_change_log_created ON change_log (created_at)",
+            "CREATE INDEX IF NOT EXISTS idx_balance_statements_customer ON balance_statements (customer_id, period)",
+        ]
+
+        for command in commands:
+            self.conn.execute(command)
+
+        # Columns added after the table was first shipped
+        statement_columns = {row[1] for row in self.conn.execute("PRAGMA table_info(balance_statements)")}
+        if "closing_balance" not in statement_columns:
+            self.conn.execute("ALTER TABLE balance_statements ADD COLUMN closing_balance DECIMAL(12, 2) NULL")
+
+        # Archives created with CREATE TABLE ... AS SELECT declared amount as NUM, which reads back as
+        # plain cents; rebuilt with the declared schema, the rows themselves are already cents
+        archive_columns = {row[1]: row[2] for row in self.conn.execute("PRAGMA table_info(transactions_archive)")}
+        if archive_columns and archive_columns.get("amount") != "DECIMAL(10, 2)":
+            self.conn.execute("ALTER TABLE transactions_archive RENAME TO transactions_archive_old")
+            self.conn.execute(TRANSACTIONS_ARCHIVE)
+            self.conn.execute("INSERT INTO transactions_archive SELECT * FROM transactions_archive_old")
+            self.conn.execute("DROP TABLE transactions_archive_old")
+
+        # Databases from before the cents schema stored money as units (REAL, or INTEGER when whole)
+        if version < SCHEMA_VERSION:
+            for table, columns in MONEY_COLUMNS.items():
+                if table in existing:
+                    assignments = ", ".join(f"{column} = CAST(ROUND({column} * 100) AS INTEGER)" for column in columns)
+                    self.conn.execute(f"UPDATE {table} SET {assignments}")
+            self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.conn.commit()
+
+        if settings.transactions_partitioning:
+            self.maintain_transaction_partitions()
+
+        self.purge_change_log()
+
+        self.conn.close()
+
+    #CHANGE LOG RETENTION
+    def purge_change_log(self):
+        if settings.change_log_retention_days <= 0:
+            return
+
+        while True:
+            self.cursor.execute("""
+                DELETE FROM change_log WHERE seq IN (
+                    SELECT seq FROM change_log WHERE created_at < datetime('now', 'localtime', %s) LIMIT 5000
+                )
+            """, (f"-{settings.change_log_retention_days} days",))
+            self.conn.commit()
+            if self.cursor.rowcount < 5000:
+                break
+
+    #TRANSACTIONS RETENTION
+    # SQLite has no partitioning; the retention window is applied with a plain (archiving) delete
+    def maintain_transaction_partitions(self):
+        if settings.transactions_retention_months <= 0:
+            return
+
+        cutoff = f"-{settings.transactions_retention_months} months"
+        if settings.transactions_archive_expired:
+            self.conn.execute(TRANSACTIONS_ARCHIVE)
+            self.cursor.execute("""
+                INSERT INTO transactions_archive
+                SELECT * FROM transactions WHERE created_at < datetime('now', 'localtime', 'start of month', %s)
+            """, (cutoff,))
+
+        self.cursor.execute("DELETE FROM transactions WHERE created_at < datetime('now', 'localtime', 'start of month', %s)", (cutoff,))
+        self.conn.commit()
@@ -0,0 +1,35 @@
+from .instrumentation import TimedCursor, with_timeout
+
+#Server-side prepared statements for the fixed queries in Queries.
+#mysql.connector re-prepares whenever a prepared cursor runs a different statement, so each
+#statement keeps its own cursor: it is prepared once per connection and only executed after that.
+class Statements:
+    def __init__(self, conn, reconnect=None):
+        self.conn = conn
+        self.reconnect = reconnect
+        self.cursors = {}
+
+    def fetchall(self, sql: str, values: tuple = ()) -> list:
+        # Keyed by the statement as sent (with its time limit hint), which is what gets prepared
+        sql = with_timeout(sql)
+        cursor = self.cursors.get(sql)
+        if cursor is None:
+            cursor = TimedCursor(self.conn.cursor(prepared=True, dictionary=True), self.reconnect)
+            self.cursors[sql] = cursor
+
+        cursor.execute(sql, values)
+        # Prepared cursors are unbuffered: read everything before the connection is used again
+        return cursor.fetchall()
+
+    def fetchone(self, sql: str, values: tuple = ()):
+        rows = self.fetchall(sql, values)
+        return rows[0] if rows else None
+
+    def close(self):
+        for cursor in self.cursors.values():
+            cursor.close()
+        self.cursors = {}
+
+    #A new session has none of the old one's prepared statements; they are prepared again on first use
+    def forget(self):
+        self.cursors = {}
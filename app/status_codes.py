@@ -52,6 +52,13 @@ class Validator:
                 detail=detail
             )
 
+    def balance_owner(self, balance, customer_id: int):
+        if balance["customer_id"] != customer_id:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Balance for customer with id {customer_id} was not found"
+            )
+
     def transaction_exists(self, transaction, transaction_id: int = None):
         if not transaction:
             if transaction_id:
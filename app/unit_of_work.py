@@ -0,0 +1,90 @@
+import random
+import time
+from .config import settings
+from .metrics import metrics
+from .identity import remember, clear
+
+#ER_LOCK_DEADLOCK and ER_LOCK_WAIT_TIMEOUT: InnoDB rolled back (part of) the transaction, a retry can succeed.
+#SQLITE_BUSY is the SQLite backend's lock wait timeout (busy_timeout ran out).
+RETRY_ERRNOS = {1213: "deadlock", 1205: "lock_wait_timeout", "SQLITE_BUSY": "lock_wait_timeout"}
+
+#Every write path locks its rows in this table order (and by id within a table), so two requests
+#never wait on each other's locks in opposite directions
+LOCK_ORDER = ("customers", "balances", "orders", "order_items", "items", "transactions")
+
+class LockOrderError(RuntimeError):
+    pass
+
+#One attempt of a write transaction: rows are locked up front with SELECT ... FOR UPDATE, which
+#also re-reads them, so a retried attempt never works from values read before the rollback
+class UnitOfWork:
+    def __init__(self, db):
+        self.cursor = db.cursor
+        self.position = -1
+
+    #Locks the rows with the given ids, plus (as keywords) the rows whose column holds one of the
+    #given values, e.g. lock("balances", customer_id=[customer_id]); rows come back in id order
+    def lock(self, table: str, *ids, **columns) -> dict:
+        position = LOCK_ORDER.index(table)
+        if position <= self.position:
+            raise LockOrderError(f"{table} locked after {LOCK_ORDER[self.position]}")
+        self.position = position
+
+        conditions, values = [], ()
+        for column, column_values in (("id", ids), *columns.items()):
+            column_values = sorted(set(column_values))
+            if column_values:
+                conditions.append(f"{column} IN ({', '.join(['%s'] * len(column_values))})")
+                values += tuple(column_values)
+        if not conditions:
+            return {}
+
+        self.cursor.execute(f"SELECT * FROM {table} WHERE ({' OR '.join(conditions)}) AND deleted_at IS NULL ORDER BY id FOR UPDATE", values)
+        rows = {row["id"]: row for row in self.cursor.fetchall()}
+
+        # Locked rows are the freshest copy; later reads in the request are served from them
+        for row in rows.values():
+            remember(table, row)
+        return rows
+
+    def lock_one(self, table: str, table_id: int):
+        return self.lock(table, table_id).get(table_id)
+
+    #A customer's balance is found by customer_id, never by reusing the customer id as a balance id
+    #(ids differ once balances live on shards); the first one, as get_customer_balance reads it
+    def lock_customer_balance(self, customer_id: int):
+        return next(iter(self.lock("balances", customer_id=[customer_id]).values()), None)
+
+#Runs body(unit_of_work) and commits. Anything raised rolls back; deadlocks and lock wait timeouts
+#are retried with jittered exponential backoff up to transaction_attempts times. commit(result), when
+#given, replaces the plain commit (e.g. to record what the transaction did as it commits).
+def run_in_transaction(db, body, attempts: int = None, commit=None):
+    attempts = attempts or settings.transaction_attempts
+
+    for attempt in range(1, attempts + 1):
+        try:
+            result = body(UnitOfWork(db))
+            if commit:
+                commit(result)
+            else:
+                db.conn.commit()
+            if attempt > 1:
+                metrics.increment("transactions.recovered")
+            return result
+
+        except Exception as error:
+            db.conn.rollback()
+            # Rows merged from rolled-back writes are no longer true
+            clear()
+
+            reason = RETRY_ERRNOS.get(getattr(error, "errno", None) or getattr(error, "sqlite_errorname", None))
+            if reason is None:
+                raise
+
+            metrics.increment(f"transactions.{reason}")
+            if attempt == attempts:
+                metrics.increment("transactions.exhausted")
+                raise
+
+            metrics.increment("transactions.retried")
+            time.sleep(random.uniform(0, settings.transaction_backoff_ms * 2 ** (attempt - 1)) / 1000)
@@ -0,0 +1,39 @@
+#Payload size and encode time of the list formats against plain JSON, on synthetic catalog rows.
+#python -m benchmarks.encoding [rows]
+import sys
+import time
+from datetime import datetime
+from app.response import ItemAdminResponse
+from app.encoding import encode_json, encode_csv, encode_msgpack, compress, msgpack, brotli
+
+def timed(function, *args, repeat: int = 20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(*args)
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    items = [
+        ItemAdminResponse(
+            id=i, name=f"Item {i}", quantity=i % 500, sold=i % 37, orig_price=10.25, total_orig_price=(i % 500) * 10.25,
+            selling_price=12.50, total_selling_price=(i % 500) * 12.50, profit=-(i % 500) * 10.25, created_at=datetime.now()
+        )
+        for i in range(count)
+    ]
+
+    formats = [("json", encode_json), ("csv", lambda content: encode_csv(content).encode())]
+    if msgpack:
+        formats.append(("msgpack", encode_msgpack))
+
+    json_body, _ = timed(encode_json, items, repeat=1)
+    print(f"{count} items")
+    print(f"{'format':<16}{'bytes':>12}{'vs json':>10}{'encode ms':>12}")
+
+    for name, encoder in formats:
+        body, encode_ms = timed(encoder, items)
+        print(f"{name:<16}{len(body):>12}{len(body) / len(json_body):>10.2f}{encode_ms:>12.2f}")
+
+        for encoding in ("gzip", "br") if brotli else ("gzip",):
+            compressed, compress_ms = timed(compress, body, encoding)
+            print(f"{name + '+' + encoding:<16}{len(compressed):>12}{len(compressed) / len(json_body):>10.2f}{encode_ms + compress_ms:>12.2f}")
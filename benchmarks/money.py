@@ -0,0 +1,70 @@
+#Cost of the money representations on the response path, on synthetic transaction rows as the
+#driver returns them (DECIMAL -> Decimal): validate + JSON-serialize a list response with the old
+#float fields, with MoneyOut (Decimal, written as a number) and with integer cents; then summing
+#the amounts as Decimal, as cents converted from Decimal, and as cents already.
+#python -m benchmarks.money [rows]
+#
+#With 5000 rows, summing as Decimal took 0.194 ms and converting to cents then summing 2.475 ms: the
+#DECIMAL columns arrive as Decimal, so the app keeps Decimal arithmetic (app/money.py).
+import sys
+import time
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+from typing import List
+from pydantic import BaseModel, TypeAdapter
+from app.money import MoneyOut
+
+def to_cents(value: Decimal) -> int:
+    return int((value * 100).to_integral_value(ROUND_HALF_UP))
+
+def sum_cents(values) -> int:
+    return sum(map(to_cents, values))
+
+class FloatTransaction(BaseModel):
+    id: int
+    amount: float
+    created_at: datetime
+
+class DecimalTransaction(BaseModel):
+    id: int
+    amount: MoneyOut
+    created_at: datetime
+
+class CentsTransaction(BaseModel):
+    id: int
+    amount: int
+    created_at: datetime
+
+def timed(function, *args, repeat: int = 20):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(*args)
+    return result, (time.perf_counter() - start) / repeat * 1000
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    now = datetime.now()
+    rows = [{"id": i, "amount": Decimal(f"{i % 100000 / 100:.2f}"), "created_at": now} for i in range(count)]
+    cents_rows = [{**row, "amount": to_cents(row["amount"])} for row in rows]
+
+    print(f"{count} rows")
+    print(f"{'response':<16}{'validate ms':>14}{'json ms':>10}{'bytes':>10}")
+
+    for name, model, source in (("float", FloatTransaction, rows), ("decimal", DecimalTransaction, rows), ("cents", CentsTransaction, cents_rows)):
+        adapter = TypeAdapter(List[model])
+        validated, validate_ms = timed(adapter.validate_python, source)
+        body, json_ms = timed(adapter.dump_json, validated)
+        print(f"{name:<16}{validate_ms:>14.2f}{json_ms:>10.2f}{len(body):>10}")
+
+    amounts = [row["amount"] for row in rows]
+    cents = [row["amount"] for row in cents_rows]
+    decimal_total, decimal_ms = timed(sum, amounts, Decimal("0.00"))
+    converted_total, converted_ms = timed(sum_cents, amounts)
+    cents_total, cents_ms = timed(sum, cents)
+    assert to_cents(decimal_total) == converted_total == cents_total
+
+    print()
+    print(f"{'sum':<16}{'ms':>14}")
+    print(f"{'decimal':<16}{decimal_ms:>14.3f}")
+    print(f"{'decimal->cents':<16}{converted_ms:>14.3f}")
+    print(f"{'cents':<16}{cents_ms:>14.3f}")
@@ -0,0 +1,61 @@
+#Microbenchmark of the main Queries methods per driver/statement mode (needs the configured database).
+#python -m benchmarks.queries [iterations]
+import sys
+import time
+from mysql.connector import HAVE_CEXT
+from app.database import Database
+from app.queries import Queries
+from app.config import settings
+
+MODES = [
+    ("pure / text", True, False),
+    ("pure / prepared", True, True),
+]
+if HAVE_CEXT:
+    MODES += [
+        ("cext / text", False, False),
+        ("cext / prepared", False, True),
+    ]
+# Driver and statement mode do not apply to the embedded backend
+if settings.database_backend == "sqlite":
+    MODES = [("sqlite", None, None)]
+
+def sample_ids(query: Queries) -> dict:
+    query.cursor.execute("SELECT id, customer_id, balance_id FROM transactions WHERE deleted_at IS NULL LIMIT 1")
+    transaction = query.cursor.fetchone() or {"id": 1, "customer_id": 1, "balance_id": 1}
+    query.cursor.execute("SELECT id, customer_id FROM orders WHERE deleted_at IS NULL LIMIT 1")
+    order = query.cursor.fetchone() or {"id": 1, "customer_id": 1}
+    query.cursor.execute("SELECT id FROM items WHERE deleted_at IS NULL LIMIT 1")
+    item = query.cursor.fetchone() or {"id": 1}
+    return {"transaction": transaction, "order": order, "item": item}
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    print(f"{'method':<28}" + "".join(f"{name:>18}" for name, _, _ in MODES) + "   (us/call)")
+
+    results = {}
+    for name, use_pure, prepared in MODES:
+        db = Database(use_pure=use_pure, prepared=prepared)
+        query = Queries(db)
+        ids = sample_ids(query)
+
+        calls = {
+            "get_request(customers, id)": lambda: query.get_request("customers", ids["transaction"]["customer_id"]),
+            "get_request(items, id)": lambda: query.get_request("items", ids["item"]["id"]),
+            "get_transactions(id)": lambda: query.get_transactions(ids["transaction"]["id"], ids["transaction"]["customer_id"], ids["transaction"]["balance_id"]),
+            "get_orders(id)": lambda: query.get_orders(ids["order"]["id"], ids["order"]["customer_id"]),
+            "get_order_items(order)": lambda: query.get_order_items(order_id=ids["order"]["id"]),
+        }
+
+        for method, call in calls.items():
+            call()      # warm up (prepares the statement once)
+            start = time.perf_counter()
+            for _ in range(iterations):
+                call()
+            results.setdefault(method, []).append((time.perf_counter() - start) / iterations * 1_000_000)
+
+        db.close()
+
+    for method, timings in results.items():
+        print(f"{method:<28}" + "".join(f"{timing:>18.1f}" for timing in timings))